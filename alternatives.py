@@ -0,0 +1,276 @@
+"""
+Alternative routes
+
+Calling find_fast_path again with the edges of the first route taken out
+costs one full search per alternative and changes the map.  alternative_paths
+finds up to k routes from one forward and one backward search instead, with
+the via-node method on plateaus:
+
+    1. A Dijkstra search from the start (forward tree) and one from the end
+       over the reversed edges (backward tree), both stopped once their
+       costs pass (1 + max_stretch) times the cost of the best route.
+    2. Every node v reached by both trees gives the via route start -> v ->
+       end, costing forward[v] + backward[v].  Nodes where the two trees
+       share their edges form plateaus, and every node of a plateau gives
+       the same route, so only one route per plateau is looked at.
+    3. Routes are taken in order of their cost minus their plateau length
+       (a long plateau is a long stretch that is locally the best way, so
+       the route makes sense to a driver), skipping routes that are longer
+       than (1 + max_stretch) times the best one, that visit a node twice,
+       or that share more than max_overlap of their cost with a route
+       already taken.
+
+method='penalty' finds the routes by repeated searches instead, each with the
+costs of the edges of the routes found so far multiplied by 1 + penalty
+(through a wrapper around the edges function, so the map is not changed),
+and applies the same filters to the true costs.
+
+Typical use:
+
+    map_rep = lab.build_internal_representation(nodes_filename, ways_filename)
+    routes = alternatives.alternative_paths(map_rep, loc1, loc2, k=3)
+    routes[0]   # the route find_fast_path gives, or one just as fast
+"""
+
+import heapq
+
+import lab
+
+
+DEFAULT_MAX_STRETCH = 0.25
+DEFAULT_MAX_OVERLAP = 0.7
+DEFAULT_PENALTY = 0.5
+
+# Searches the penalty method runs per route asked for, at most
+PENALTY_ROUNDS = 3
+
+INFINITY = float('inf')
+
+
+def _tree(edges, source, limit=INFINITY, target=None, stretch=0.0):
+    """
+    Dijkstra search from source, returning (costs, parents) of every node
+    settled with a cost of at most limit
+
+    When target is given, limit is first set once target is settled, to
+    (1 + stretch) times its cost.
+    """
+    costs = {source: 0.0}
+    parents = {source: None}
+    settled = {}
+    queue = [(0.0, 0, source)]
+    pushes = 1
+    while queue:
+        cost, order, node = heapq.heappop(queue)
+        if cost > limit:
+            break
+        if node in settled:
+            continue
+        settled[node] = cost
+        if node == target:
+            limit = cost * (1 + stretch)
+        for child, edgeCost in edges(node):
+            childCost = cost + edgeCost
+            if child not in settled and childCost < costs.get(child, INFINITY):
+                costs[child] = childCost
+                parents[child] = node
+                heapq.heappush(queue, (childCost, pushes, child))
+                pushes += 1
+    return settled, {node: parents[node] for node in settled}
+
+
+def _path_cost(edges, path):
+    """
+    Return the cost of a path and a dictionary mapping each of its edges
+    (node, child) to its cost
+    """
+    costs = {}
+    for node, child in zip(path, path[1:]):
+        costs[(node, child)] = min(cost for other, cost in edges(node) if other == child)
+    return sum(costs.values()), costs
+
+
+class _Filter:
+    """
+    The routes taken so far, and the checks a new route has to pass
+    """
+
+    def __init__(self, best, max_stretch, max_overlap):
+        self.limit = best * (1 + max_stretch)
+        self.max_overlap = max_overlap
+        self.paths = []
+        self.edges = {}
+        self.seen = set()
+
+    def accept(self, path, cost, edgeCosts):
+        """
+        Take a route if it passes the checks, returning whether it did
+        """
+        key = tuple(path)
+        if key in self.seen or cost > self.limit * (1 + 1e-12) or len(set(path)) != len(path):
+            return False
+        self.seen.add(key)
+        if self.paths:
+            shared = sum(edgeCost for edge, edgeCost in edgeCosts.items() if edge in self.edges)
+            if shared > self.max_overlap * cost:
+                return False
+        self.paths.append(path)
+        self.edges.update(edgeCosts)
+        return True
+
+
+def _via_paths(graph, node1, node2, metric, k, max_stretch, max_overlap, stats):
+    """
+    Alternative routes between two node handles with the via-node method
+    """
+    forward, forwardParents = _tree(graph.edges(metric), node1, target=node2, stretch=max_stretch)
+    if node2 not in forward:
+        return []
+    best = forward[node2]
+    limit = best * (1 + max_stretch)
+    backward, backwardParents = _tree(graph.reverse_edges(metric), node2, limit)
+
+    # Groups the nodes reached by both trees into plateaus: a node joins the
+    # plateau of its forward parent when the edge between them is in the
+    # backward tree too.  Parents come before their children in forward
+    # cost order.
+    candidates = sorted((cost, node) for node, cost in forward.items()
+                        if node in backward and cost + backward[node] <= limit)
+    plateau = {}
+    plateaus = {}
+    for cost, node in candidates:
+        parent = forwardParents[node]
+        if parent is not None and parent in plateau and backwardParents.get(parent) == node:
+            start = plateau[node] = plateau[parent]
+        else:
+            start = plateau[node] = node
+        plateaus[start] = node
+    if stats is not None:
+        stats.update(forward_settled=len(forward), backward_settled=len(backward), plateaus=len(plateaus))
+
+    # Looks at one route per plateau, longest plateaus first among routes of
+    # the same cost
+    order = sorted(plateaus.items(),
+                   key=lambda item: forward[item[0]] + backward[item[0]] - (forward[item[1]] - forward[item[0]]))
+    accepted = _Filter(best, max_stretch, max_overlap)
+    for start, end in order:
+        prefix = lab._rebuild_path(forwardParents, end)
+        node = backwardParents[end]
+        while node is not None:
+            prefix.append(node)
+            node = backwardParents[node]
+        edgeCosts = {}
+        for u, v in zip(prefix, prefix[1:]):
+            if u in forward and v in forward and forwardParents[v] == u:
+                edgeCosts[(u, v)] = forward[v] - forward[u]
+            else:
+                edgeCosts[(u, v)] = backward[u] - backward[v]
+        accepted.accept(prefix, forward[start] + backward[start], edgeCosts)
+        if len(accepted.paths) == k:
+            break
+    return accepted.paths
+
+
+def _penalty_paths(graph, node1, node2, metric, k, max_stretch, max_overlap, penalty, stats):
+    """
+    Alternative routes between two node handles with the penalty method
+    """
+    edges = graph.edges(metric)
+    penalized = {}
+
+    def penalizedEdges(node):
+        return [(child, cost * penalized.get((node, child), 1.0)) for child, cost in edges(node)]
+
+    accepted = None
+    searches = 0
+    for _ in range(k * PENALTY_ROUNDS):
+        path, expanded = lab._search(penalizedEdges, node1, node2)
+        searches += 1
+        if path is None:
+            break
+        cost, edgeCosts = _path_cost(edges, path)
+        if accepted is None:
+            accepted = _Filter(cost, max_stretch, max_overlap)
+        accepted.accept(path, cost, edgeCosts)
+        if len(accepted.paths) == k:
+            break
+        for edge in edgeCosts:
+            penalized[edge] = penalized.get(edge, 1.0) * (1 + penalty)
+    if stats is not None:
+        stats['searches'] = searches
+    return [] if accepted is None else accepted.paths
+
+
+def alternative_paths_nodes(map_rep, node1, node2, k=3, metric='time', method='via',
+                            max_stretch=DEFAULT_MAX_STRETCH, max_overlap=DEFAULT_MAX_OVERLAP,
+                            penalty=DEFAULT_PENALTY, stats=None):
+    """
+    Return up to k routes between two nodes, the best one first
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation, a
+                 compact.CompactMap or a simplify.SimplifiedMap (whose full
+                 map is searched)
+        node1: OSM ID of the start node
+        node2: OSM ID of the end node
+        k: most routes returned, counting the best one
+        metric: 'time' or 'distance'
+        method: 'via' for the via-node method over two shortest path trees
+                or 'penalty' for repeated searches with penalized edges
+        max_stretch: routes may cost at most (1 + max_stretch) times the
+                     best one
+        max_overlap: routes may share at most this fraction of their cost
+                     with a route returned before them
+        penalty: cost increase of the edges of every route found, for the
+                 penalty method
+        stats: optional dictionary filled with the size of the trees and
+               number of plateaus ('via') or the number of searches
+               ('penalty')
+
+    Returns:
+        a list of up to k lists of OSM node IDs, empty if there is no path
+    """
+    if method not in ('via', 'penalty'):
+        raise ValueError('unknown method: %r' % (method,))
+    # The search runs on a simplify.SimplifiedMap's full map, but the
+    # components (see components.py) are attached to the map passed in
+    graph = lab._as_graph(map_rep)
+    components = getattr(graph, 'components', None)
+    graph = getattr(graph, 'base', graph)
+    if components is None:
+        components = getattr(graph, 'components', None)
+    start, end = graph.internal_id(node1), graph.internal_id(node2)
+
+    if components is not None and not components.reachable(start, end):
+        return []
+    if method == 'via':
+        paths = _via_paths(graph, start, end, metric, k, max_stretch, max_overlap, stats)
+    else:
+        paths = _penalty_paths(graph, start, end, metric, k, max_stretch, max_overlap, penalty, stats)
+    return [[graph.external_id(node) for node in path] for path in paths]
+
+
+def alternative_paths(map_rep, loc1, loc2, k=3, metric='time', **options):
+    """
+    Return up to k routes between two locations, the best one first
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation, a
+                 compact.CompactMap or a simplify.SimplifiedMap
+        loc1, loc2: (latitude, longitude) of the start and end, snapped to
+                    the nearest nodes
+        k: most routes returned, counting the best one
+        metric: 'time' (as find_fast_path) or 'distance' (as
+                find_short_path)
+        options: method, max_stretch, max_overlap, penalty and stats, as for
+                 alternative_paths_nodes
+
+    Returns:
+        a list of up to k lists of (latitude, longitude) tuples, empty if
+        there is no path
+    """
+    graph = lab._as_graph(map_rep)
+    node1 = lab.nearest_node(graph, loc1)
+    node2 = lab.nearest_node(graph, loc2)
+    paths = alternative_paths_nodes(graph, node1, node2, k, metric, **options)
+    return [lab._path_locations(graph, path) for path in paths]
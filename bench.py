@@ -0,0 +1,916 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the routing code in lab.py
+
+Run from the directory that holds lab.py and the resources folder:
+
+    python bench.py [dataset ...]
+
+Each dataset is the name of a resources/<name>.nodes / resources/<name>.ways
+pair.  Datasets whose files are missing are skipped.
+"""
+
+import io
+import os
+import sys
+import time
+import random
+import tempfile
+import contextlib
+import tracemalloc
+
+import lab
+import compact
+import graph_cache
+import ch
+import landmarks
+import matrix
+import bulk
+import ingest
+import simplify
+import route_cache
+import instrument
+import geo
+import traffic
+import updates
+import components
+import isochrone
+import tiles
+import alternatives
+
+
+DEFAULT_DATASETS = ('mit', 'cambridge')
+QUERIES_PER_DATASET = 20
+MATRIX_SIZE = 10
+BULK_QUERIES = 200
+SEED = 6009
+RUSH_HOURS = (8.0, 17.5)
+ISOCHRONE_MINUTES = (5, 10)
+TILE_DEGREES = 0.005
+TILE_BUDGET = 256 << 10
+ALTERNATIVES = 3
+
+
+def load_dataset(name):
+    """
+    Build the map representation for a bundled dataset
+
+    Returns:
+        the map representation, or None if the dataset files are missing
+    """
+    nodes_filename = os.path.join('resources', name + '.nodes')
+    ways_filename = os.path.join('resources', name + '.ways')
+    if not (os.path.exists(nodes_filename) and os.path.exists(ways_filename)):
+        return None
+    return lab.build_internal_representation(nodes_filename, ways_filename)
+
+
+def random_node_pairs(map_rep, count, seed=SEED):
+    """
+    Return a fixed list of (start, end) node ID pairs for the given map
+    """
+    nodes = sorted(map_rep[0])
+    rnd = random.Random(seed)
+    return [(rnd.choice(nodes), rnd.choice(nodes)) for _ in range(count)]
+
+
+def bench_expansion(map_rep, pairs):
+    """
+    Measure how many nodes per second the shared search engine expands
+
+    Returns:
+        a dictionary mapping each search kind to (expanded, seconds)
+    """
+    results = {}
+    for kind in ('distance', 'time'):
+        edges = map_rep.edges(kind)
+        expanded_total = 0
+        start = time.perf_counter()
+        for node1, node2 in pairs:
+            path, expanded = lab._search(edges, node1, node2)
+            expanded_total += expanded
+        results[kind] = (expanded_total, time.perf_counter() - start)
+    return results
+
+
+def bench_relaxations(map_rep):
+    """
+    Measure edge relaxations per second with edge weights computed on the fly
+    (the old behavior) and with the weights precomputed at build time
+
+    Every edge of the map is relaxed once per metric: its cost is added to a
+    running cost and compared with the best cost seen.
+
+    Returns:
+        a dictionary mapping 'on the fly' and 'precomputed' to relaxations
+        per second
+    """
+    nodes, neighbors, waySet = map_rep
+    location = map_rep.location
+
+    def on_the_fly(metric):
+        def edges(node):
+            here = location(node)
+            if metric == 'distance':
+                return [(child, lab.great_circle_distance(here, location(child))) for child in neighbors.get(node, ())]
+            return [(child, lab.great_circle_distance(here, location(child)) / speed)
+                    for child, speed in neighbors.get(node, {}).items()]
+        return edges
+
+    results = {}
+    for kind, make_edges in (('on the fly', on_the_fly), ('precomputed', map_rep.edges)):
+        relaxations = 0
+        start = time.perf_counter()
+        for metric in ('distance', 'time'):
+            edges = make_edges(metric)
+            best = float('inf')
+            for node in neighbors:
+                for child, cost in edges(node):
+                    relaxations += 1
+                    if cost + 1.0 < best:
+                        best = cost + 1.0
+        seconds = time.perf_counter() - start
+        results[kind] = relaxations / seconds if seconds else float('inf')
+    return results
+
+
+def bench_path_memory(map_rep, pairs):
+    """
+    Compare path bookkeeping with a predecessor map against copying the path
+    into every agenda entry
+
+    Returns:
+        a dictionary mapping 'parents' and 'copies' to a tuple
+        (seconds, peak traced bytes, largest peak_path_nodes)
+    """
+    edges = map_rep.edges('distance')
+    results = {}
+    for kind, copy_paths in (('parents', False), ('copies', True)):
+        peak_bytes = 0
+        peak_path_nodes = 0
+        seconds = 0
+        for node1, node2 in pairs:
+            stats = {}
+            tracemalloc.start()
+            start = time.perf_counter()
+            lab._search(edges, node1, node2, stats=stats, copy_paths=copy_paths)
+            seconds += time.perf_counter() - start
+            peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            peak_path_nodes = max(peak_path_nodes, stats['peak_path_nodes'])
+        results[kind] = (seconds, peak_bytes, peak_path_nodes)
+    return results
+
+
+def random_locations(map_rep, count, seed=SEED):
+    """
+    Return a fixed list of (lat, lon) locations inside the map's bounding box
+    """
+    nodes = map_rep[0]
+    lats = [node['lat'] for node in nodes.values()]
+    lons = [node['lon'] for node in nodes.values()]
+    rnd = random.Random(seed)
+    return [(rnd.uniform(min(lats), max(lats)), rnd.uniform(min(lons), max(lons))) for _ in range(count)]
+
+
+def bench_snapping(map_rep, locations):
+    """
+    Compare snapping with the spatial index against a full scan of the nodes
+
+    Returns:
+        a dictionary mapping 'scan' and 'index' to seconds per location
+    """
+    nodes = map_rep[0]
+
+    def scan(loc):
+        return min(nodes, key=lambda node: lab.great_circle_distance(loc, (nodes[node]['lat'], nodes[node]['lon'])))
+
+    results = {}
+    for kind, snap in (('scan', scan), ('index', lambda loc: lab.nearest_node(map_rep, loc))):
+        start = time.perf_counter()
+        for loc in locations:
+            snap(loc)
+        results[kind] = (time.perf_counter() - start) / len(locations)
+    return results
+
+
+def bench_memory(name):
+    """
+    Compare the memory held by the usual map representation of a dataset
+    with the memory held by its CompactMap
+
+    Returns:
+        a tuple (dictionary bytes, compact bytes) of traced memory, or None if
+        the dataset files are missing
+    """
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        map_rep = load_dataset(name)
+    if map_rep is None:
+        tracemalloc.stop()
+        return None
+    dictionary_bytes = tracemalloc.get_traced_memory()[0]
+    compact_map = compact.compact_representation(map_rep)
+    compact_bytes = tracemalloc.get_traced_memory()[0] - dictionary_bytes
+    tracemalloc.stop()
+    return dictionary_bytes, compact_bytes
+
+
+def bench_ingestion(name):
+    """
+    Compare the peak memory and time of building a CompactMap through
+    build_internal_representation with the streaming ingestion
+
+    Returns:
+        a dictionary mapping each method to a tuple (peak bytes, seconds,
+        records per second of the streaming passes)
+    """
+    nodes_filename = os.path.join('resources', name + '.nodes')
+    ways_filename = os.path.join('resources', name + '.ways')
+    records = []
+    builders = {
+        'dict': lambda: compact.build_compact_representation(nodes_filename, ways_filename),
+        'stream': lambda: ingest.stream_compact_representation(
+            nodes_filename, ways_filename,
+            progress=lambda stage, count, seconds: records.append(count / seconds if seconds else 0.0)),
+    }
+    results = {}
+    for method, build in builders.items():
+        del records[:]
+        tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            build()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[method] = (peak, seconds, min(records) if records else 0.0)
+    return results
+
+
+def bench_cache(name):
+    """
+    Compare building a dataset's map from the OSM files with loading it
+    from a fresh graph cache
+
+    Returns:
+        a tuple (build seconds, cached load seconds)
+    """
+    nodes_filename = os.path.join('resources', name + '.nodes')
+    ways_filename = os.path.join('resources', name + '.ways')
+    with tempfile.TemporaryDirectory() as directory:
+        cache_filename = os.path.join(directory, name + '.graph')
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            graph_cache.load_map(nodes_filename, ways_filename, cache_filename)
+            build_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            graph_cache.load_map(nodes_filename, ways_filename, cache_filename)
+            load_seconds = time.perf_counter() - start
+    return build_seconds, load_seconds
+
+
+def bench_hierarchy(map_rep, pairs):
+    """
+    Measure contraction hierarchy preprocessing time, and compare its query
+    latency with the plain search
+
+    Returns:
+        a dictionary mapping each metric to a tuple (preprocessing seconds,
+        search seconds per query, hierarchy seconds per query)
+    """
+    results = {}
+    for metric in ('distance', 'time'):
+        start = time.perf_counter()
+        hierarchy = ch.ContractionHierarchy(map_rep, metric)
+        preprocessing = time.perf_counter() - start
+
+        edges = map_rep.edges(metric)
+        start = time.perf_counter()
+        for node1, node2 in pairs:
+            lab._search(edges, node1, node2)
+        search = (time.perf_counter() - start) / len(pairs)
+
+        start = time.perf_counter()
+        for node1, node2 in pairs:
+            hierarchy.query(node1, node2)
+        query = (time.perf_counter() - start) / len(pairs)
+
+        results[metric] = (preprocessing, search, query)
+    return results
+
+
+def bench_landmarks(map_rep, pairs):
+    """
+    Compare the nodes expanded by A* with landmark heuristics against the
+    searches without them
+
+    Returns:
+        a dictionary mapping each metric to a tuple (expanded without
+        landmarks, expanded with landmarks, preprocessing seconds)
+    """
+    location = map_rep.location
+    results = {}
+    for metric in ('distance', 'time'):
+        start = time.perf_counter()
+        table = landmarks.LandmarkTable(map_rep, metric)
+        preprocessing = time.perf_counter() - start
+
+        edges = map_rep.edges(metric)
+        before = after = 0
+        for node1, node2 in pairs:
+            if metric == 'distance':
+                # The straight-line heuristic of find_short_path_nodes_heuristics
+                goal = location(node2)
+                straight = lambda node: lab.great_circle_distance(location(node), goal)
+            else:
+                # find_fast_path had no heuristic
+                straight = None
+            before += lab._search(edges, node1, node2, straight)[1]
+
+            bound = table.heuristic(node1, node2)
+            if straight is None:
+                heuristic = bound
+            else:
+                heuristic = lambda node: max(bound(node), straight(node))
+            after += lab._search(edges, node1, node2, heuristic)[1]
+        results[metric] = (before, after, preprocessing)
+    return results
+
+
+def bench_bidirectional(map_rep, pairs):
+    """
+    Compare the nodes expanded and the time taken by one-way and
+    bidirectional Dijkstra searches
+
+    Returns:
+        a dictionary mapping each metric to a tuple (one-way expanded,
+        one-way seconds, bidirectional expanded, bidirectional seconds)
+    """
+    results = {}
+    for metric in ('distance', 'time'):
+        edges = map_rep.edges(metric)
+        reverseEdges = map_rep.reverse_edges(metric)
+        oneWay = both = 0
+        start = time.perf_counter()
+        for node1, node2 in pairs:
+            oneWay += lab._search(edges, node1, node2)[1]
+        oneWaySeconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for node1, node2 in pairs:
+            both += lab._bidirectional_search(edges, reverseEdges, node1, node2)[1]
+        bothSeconds = time.perf_counter() - start
+        results[metric] = (oneWay, oneWaySeconds, both, bothSeconds)
+    return results
+
+
+def bench_matrix(map_rep, locations):
+    """
+    Compare the time taken to fill a travel time matrix by calling
+    find_fast_path for every pair, by one-to-many searches and by buckets
+    over a contraction hierarchy
+
+    Returns:
+        a dictionary mapping each method to its seconds
+    """
+    results = {}
+    start = time.perf_counter()
+    for loc1 in locations:
+        for loc2 in locations:
+            lab.find_fast_path(map_rep, loc1, loc2)
+    results['pairwise'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matrix.travel_time_matrix(map_rep, locations, locations, method='dijkstra')
+    results['dijkstra'] = time.perf_counter() - start
+
+    map_rep.hierarchies['time'] = ch.ContractionHierarchy(map_rep, 'time')
+    try:
+        start = time.perf_counter()
+        matrix.travel_time_matrix(map_rep, locations, locations, method='buckets')
+        results['buckets'] = time.perf_counter() - start
+    finally:
+        del map_rep.hierarchies['time']
+    return results
+
+
+def bench_parallel(map_rep, queries, max_processes=None):
+    """
+    Measure bulk routing throughput with 1 to max_processes workers
+
+    Returns:
+        a dictionary mapping each number of processes to queries per second
+    """
+    if max_processes is None:
+        max_processes = os.cpu_count() or 1
+    results = {}
+    for processes in range(1, max_processes + 1):
+        start = time.perf_counter()
+        bulk.route_many(map_rep, queries, 'fast', processes, chunk_size=8)
+        seconds = time.perf_counter() - start
+        results[processes] = len(queries) / seconds
+    return results
+
+
+def bench_simplify(map_rep, pairs):
+    """
+    Compare the size of a map and the nodes its searches expand before and
+    after collapsing chains of shape points
+
+    Returns:
+        a dictionary mapping 'full' and 'simplified' to a tuple (search
+        nodes, expanded, seconds)
+    """
+    start = time.perf_counter()
+    simplified = simplify.simplify(map_rep)
+    preprocessing = time.perf_counter() - start
+    results = {}
+    for kind, graph in (('full', map_rep), ('simplified', simplified)):
+        expanded = 0
+        start = time.perf_counter()
+        for node1, node2 in pairs:
+            expanded += lab._route(graph, node1, node2, 'time')[1]
+        results[kind] = (len(graph.node_handles()), expanded, time.perf_counter() - start)
+    results['preprocessing'] = (0, 0, preprocessing)
+    return results
+
+
+def bench_query_cache(map_rep, origins, destinations, count=200, seed=SEED):
+    """
+    Compare a repetitive workload (a few origins to a few destinations)
+    without and with the query cache
+
+    Returns:
+        a dictionary mapping 'uncached' and 'cached' to a tuple (seconds,
+        counters of the cache or None)
+    """
+    rnd = random.Random(seed)
+    queries = [(rnd.choice(origins), rnd.choice(destinations)) for _ in range(count)]
+    results = {}
+    for kind in ('uncached', 'cached'):
+        if kind == 'cached':
+            route_cache.enable(map_rep)
+        start = time.perf_counter()
+        for node1, node2 in queries:
+            lab._route(map_rep, node1, node2, 'time')
+        seconds = time.perf_counter() - start
+        cache = getattr(map_rep, 'query_cache', None)
+        results[kind] = (seconds, cache.counters() if cache else None)
+        route_cache.disable(map_rep)
+    return results
+
+
+def bench_instrumentation(map_rep, locations):
+    """
+    Measure the cost of collecting query statistics, and gather them
+
+    Returns:
+        a tuple (seconds without stats, seconds with stats, Recorder)
+    """
+    queries = list(zip(locations[::2], locations[1::2]))
+    disabled = instrument.Recorder(enabled=False)
+    start = time.perf_counter()
+    for loc1, loc2 in queries:
+        lab.find_fast_path(map_rep, loc1, loc2, stats=disabled.new())
+    without = time.perf_counter() - start
+
+    recorder = instrument.Recorder()
+    start = time.perf_counter()
+    for loc1, loc2 in queries:
+        lab.find_fast_path(map_rep, loc1, loc2, stats=recorder.new())
+    return without, time.perf_counter() - start, recorder
+
+
+def bench_distance_kernel(map_rep, locations):
+    """
+    Compare great circle distance throughput of the scalar function, the
+    pure-Python kernel and (when installed) the numpy kernel, and snapping
+    with and without the kernel
+
+    Returns:
+        a tuple (dictionary mapping each method to distances per second,
+        dictionary mapping 'scalar' and 'kernel' to seconds per snap)
+    """
+    compact_map = compact.compact_representation(map_rep)
+    lats, lons = compact_map.lats, compact_map.lons
+    kernels = {
+        'scalar': lambda point: [lab.great_circle_distance(point, other) for other in zip(lats, lons)],
+        'python': lambda point: geo._python_distances(point, lats, lons),
+    }
+    if geo.numpy is not None:
+        kernels['numpy'] = lambda point: geo._numpy_distances(point, lats, lons)
+    rates = {}
+    for kind, kernel in kernels.items():
+        start = time.perf_counter()
+        for point in locations:
+            kernel(point)
+        rates[kind] = len(lats) * len(locations) / (time.perf_counter() - start)
+
+    snapping = {}
+    for kind, kernel in (('scalar', None), ('kernel', geo.distances_from)):
+        compact_map.build_spatial_index(kernel)
+        start = time.perf_counter()
+        for point in locations:
+            compact_map.nearest(point, 10)
+        snapping[kind] = (time.perf_counter() - start) / len(locations)
+    return rates, snapping
+
+
+def rush_hour_profiles(map_rep):
+    """
+    Return SpeedProfiles slowing every edge of a map down to half its static
+    speed at RUSH_HOURS, recovering linearly over 90 minutes either side
+    """
+    factors = []
+    for bucket in range(traffic.BUCKETS):
+        hour = bucket * traffic.BUCKET_HOURS
+        factors.append(1 - 0.5 * max(max(0.0, 1 - abs(hour - peak) / 1.5) for peak in RUSH_HOURS))
+    nodes, neighbors, waySet = map_rep
+    rows = [(node, child, [speed * factor for factor in factors])
+            for node, children in neighbors.items() for child, speed in children.items()]
+    return traffic.build_profiles(rows)
+
+
+def bench_time_dependent(map_rep, locations):
+    """
+    Compare static travel times with time-dependent ones at night and at
+    rush hour, on a compact copy of a map with rush_hour_profiles attached
+
+    Returns:
+        a tuple (dictionary mapping each kind of query to (seconds, mean
+        travel time in minutes), bytes the profiles add per edge)
+    """
+    queries = list(zip(locations[::2], locations[1::2]))
+    compact_map = compact.compact_representation(map_rep)
+    results = {}
+    for kind, profiles, departure in (('static', traffic.build_profiles([]), 0.0),
+                                      ('03:00', rush_hour_profiles(map_rep), 3.0),
+                                      ('08:00', None, 8.0)):
+        if profiles is not None:
+            traffic.enable(compact_map, profiles)
+        start = time.perf_counter()
+        times = [traffic.travel_time(compact_map, loc1, loc2, departure) for loc1, loc2 in queries]
+        times = [hours for hours in times if hours is not None]
+        results[kind] = (time.perf_counter() - start, 60 * sum(times) / max(len(times), 1))
+    return results, compact_map.traffic.nbytes() / max(len(compact_map.targets), 1)
+
+
+def bench_updates(name, count=20, seed=SEED):
+    """
+    Compare applying a batch of road closures and speed changes with
+    building the map again, on a map with landmark tables for both metrics
+
+    Returns:
+        a tuple (seconds to build the map, update report)
+    """
+    start = time.perf_counter()
+    map_rep = load_dataset(name)
+    build_seconds = time.perf_counter() - start
+    landmarks.prepare(map_rep)
+    rnd = random.Random(seed)
+    nodes, neighbors, waySet = map_rep
+    edges = sorted((node, child) for node, children in neighbors.items() for child in children)
+    changes = [('close', node, child) if position % 2 else ('speed', node, child, 15)
+               for position, (node, child) in enumerate(rnd.sample(edges, min(count, len(edges))))]
+    return build_seconds, updates.apply_updates(map_rep, changes)
+
+
+def bench_components(map_rep, count=QUERIES_PER_DATASET, seed=SEED):
+    """
+    Time queries whose end cannot be reached from their start, without and
+    with strongly connected components
+
+    Returns:
+        a tuple (seconds to compute the components, number of components,
+        dictionary mapping 'search' and 'components' to seconds per query),
+        or None if every node can reach every other
+    """
+    start = time.perf_counter()
+    labels = components.Components(map_rep)
+    preprocessing = time.perf_counter() - start
+    handles = list(map_rep.node_handles())
+    rnd = random.Random(seed)
+    queries = []
+    for _ in range(100 * count):
+        node1, node2 = rnd.choice(handles), rnd.choice(handles)
+        if not labels.reachable(node1, node2):
+            queries.append((node1, node2))
+            if len(queries) == count:
+                break
+    if not queries:
+        return None
+
+    results = {}
+    for kind in ('search', 'components'):
+        if kind == 'components':
+            map_rep.components = labels
+        start = time.perf_counter()
+        for node1, node2 in queries:
+            lab.find_short_path_nodes(map_rep, node1, node2)
+        results[kind] = (time.perf_counter() - start) / len(queries)
+    del map_rep.components
+    return preprocessing, len(labels), results
+
+
+def bench_isochrone(map_rep, locations, sample=QUERIES_PER_DATASET, seed=SEED):
+    """
+    Compare one bounded search against calling find_fast_path for every
+    node it reaches, and time isochrones for many origins in one batch
+
+    The per-node cost is measured on a sample of the reached nodes and
+    scaled up to all of them.
+
+    Returns:
+        a dictionary with the nodes reached from the first location and the
+        seconds taken by the 'isochrone', the estimated 'per_node' calls and
+        the 'batch' of every location
+    """
+    budgets = [minutes / 60 for minutes in ISOCHRONE_MINUTES]
+    start = time.perf_counter()
+    area = isochrone.isochrone(map_rep, locations[0], max_time=budgets)
+    results = {'nodes': len(area), 'isochrone': time.perf_counter() - start}
+
+    rnd = random.Random(seed)
+    reached = sorted(area.costs)
+    targets = [map_rep.location(map_rep.internal_id(node)) for node in rnd.sample(reached, min(sample, len(reached)))]
+    start = time.perf_counter()
+    for loc in targets:
+        lab.find_fast_path(map_rep, locations[0], loc)
+    results['per_node'] = (time.perf_counter() - start) / len(targets) * len(reached)
+
+    start = time.perf_counter()
+    isochrone.isochrones(map_rep, locations, max_time=budgets, processes=1)
+    results['batch'] = time.perf_counter() - start
+    return results
+
+
+def bench_tiles(name, count=QUERIES_PER_DATASET, seed=SEED):
+    """
+    Compare loading a dataset in full with opening it as a tile file, and
+    measure the tiles its queries read within a small memory budget
+
+    Returns:
+        a dictionary with the 'build' and 'open' seconds, the 'tiles' in
+        the file, the mean 'hits' and 'misses' per query, and the most
+        bytes of tiles held ('resident') against the full 'compact' map
+    """
+    nodes_filename = os.path.join('resources', name + '.nodes')
+    ways_filename = os.path.join('resources', name + '.ways')
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        compact_map = compact.build_compact_representation(nodes_filename, ways_filename)
+    results = {'build': time.perf_counter() - start, 'compact': compact_map.nbytes()}
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, name + '.tiles')
+        results['tiles'] = tiles.write_tiles(compact_map, filename, TILE_DEGREES)
+        start = time.perf_counter()
+        tiled = tiles.open_tiles(filename, TILE_BUDGET)
+        results['open'] = time.perf_counter() - start
+
+        rnd = random.Random(seed)
+        hits = misses = resident = 0
+        for _ in range(count):
+            node1, node2 = rnd.choice(compact_map.ids), rnd.choice(compact_map.ids)
+            stats = {}
+            lab.find_short_path_nodes(tiled, node1, node2, stats=stats)
+            hits += stats['tile_hits']
+            misses += stats['tile_misses']
+            resident = max(resident, tiled.nbytes())
+        results.update(hits=hits / count, misses=misses / count, resident=resident)
+        del tiled
+    return results
+
+
+def naive_alternatives(map_rep, node1, node2, k):
+    """
+    Find up to k routes by searching again with the edges of every route
+    found so far left out, one full search per route
+    """
+    edges = map_rep.edges('time')
+    removed = set()
+
+    def remaining(node):
+        return [(child, cost) for child, cost in edges(node) if (node, child) not in removed]
+
+    paths = []
+    for _ in range(k):
+        path, expanded = lab._search(remaining, node1, node2)
+        if path is None:
+            break
+        paths.append(path)
+        removed.update(zip(path, path[1:]))
+    return paths
+
+
+def bench_alternatives(map_rep, pairs, k=ALTERNATIVES):
+    """
+    Compare finding k alternative routes by naive repeated searches with
+    the via-node and penalty methods of alternatives.py
+
+    Returns:
+        a dictionary mapping each method to a tuple (seconds per query, mean
+        routes found)
+    """
+    results = {}
+    start = time.perf_counter()
+    found = sum(len(naive_alternatives(map_rep, map_rep.internal_id(node1), map_rep.internal_id(node2), k))
+                for node1, node2 in pairs)
+    results['naive'] = ((time.perf_counter() - start) / len(pairs), found / len(pairs))
+    for method in ('via', 'penalty'):
+        start = time.perf_counter()
+        found = sum(len(alternatives.alternative_paths_nodes(map_rep, node1, node2, k, method=method))
+                    for node1, node2 in pairs)
+        results[method] = ((time.perf_counter() - start) / len(pairs), found / len(pairs))
+    return results
+
+
+def main(datasets):
+    maps = {}
+    for name in datasets:
+        with contextlib.redirect_stdout(io.StringIO()):
+            maps[name] = load_dataset(name)
+        if maps[name] is None:
+            print('%-12s skipped (missing resources)' % name)
+            del maps[name]
+
+    print('%-12s %8s %-9s %10s %10s %14s' % ('dataset', 'nodes', 'metric', 'expanded', 'seconds', 'expanded/sec'))
+    for name, map_rep in maps.items():
+        pairs = random_node_pairs(map_rep, QUERIES_PER_DATASET)
+        for kind, (expanded, seconds) in bench_expansion(map_rep, pairs).items():
+            rate = expanded / seconds if seconds else float('inf')
+            print('%-12s %8d %-9s %10d %10.3f %14.0f' % (name, len(map_rep[0]), kind, expanded, seconds, rate))
+
+    print()
+    print('%-12s %-12s %16s' % ('dataset', 'edge weights', 'relaxations/sec'))
+    for name, map_rep in maps.items():
+        for kind, rate in bench_relaxations(map_rep).items():
+            print('%-12s %-12s %16.0f' % (name, kind, rate))
+
+    print()
+    print('%-12s %-9s %10s %14s %16s' % ('dataset', 'paths', 'seconds', 'peak bytes', 'peak path nodes'))
+    for name, map_rep in maps.items():
+        pairs = random_node_pairs(map_rep, QUERIES_PER_DATASET)
+        for kind, (seconds, peak_bytes, peak_path_nodes) in bench_path_memory(map_rep, pairs).items():
+            print('%-12s %-9s %10.3f %14d %16d' % (name, kind, seconds, peak_bytes, peak_path_nodes))
+
+    print()
+    print('%-12s %-9s %16s' % ('dataset', 'snapping', 'usec/location'))
+    for name, map_rep in maps.items():
+        locations = random_locations(map_rep, QUERIES_PER_DATASET)
+        for kind, seconds in bench_snapping(map_rep, locations).items():
+            print('%-12s %-9s %16.1f' % (name, kind, seconds * 1e6))
+
+    print()
+    print('%-12s %14s %14s %8s' % ('dataset', 'dict bytes', 'compact bytes', 'ratio'))
+    for name in maps:
+        dictionary_bytes, compact_bytes = bench_memory(name)
+        print('%-12s %14d %14d %8.1f' % (name, dictionary_bytes, compact_bytes, dictionary_bytes / compact_bytes))
+
+    print()
+    print('%-12s %-9s %14s %10s %14s' % ('dataset', 'ingestion', 'peak bytes', 'seconds', 'records/sec'))
+    for name in maps:
+        for method, (peak, seconds, rate) in bench_ingestion(name).items():
+            print('%-12s %-9s %14d %10.3f %14.0f' % (name, method, peak, seconds, rate))
+
+    print()
+    print('%-12s %14s %14s' % ('dataset', 'build seconds', 'cache seconds'))
+    for name in maps:
+        build_seconds, load_seconds = bench_cache(name)
+        print('%-12s %14.3f %14.4f' % (name, build_seconds, load_seconds))
+
+    print()
+    print('%-12s %-9s %14s %14s %8s %14s' % ('dataset', 'metric', 'expanded', 'with ALT', 'ratio', 'preprocess s'))
+    for name, map_rep in maps.items():
+        pairs = random_node_pairs(map_rep, QUERIES_PER_DATASET)
+        for metric, (before, after, preprocessing) in bench_landmarks(map_rep, pairs).items():
+            print('%-12s %-9s %14d %14d %8.1f %14.2f' % (name, metric, before, after, before / max(after, 1), preprocessing))
+
+    print()
+    print('%-12s %-9s %14s %12s %12s' % ('dataset', 'metric', 'preprocess s', 'search ms', 'ch ms'))
+    for name, map_rep in maps.items():
+        pairs = random_node_pairs(map_rep, QUERIES_PER_DATASET)
+        for metric, (preprocessing, search, query) in bench_hierarchy(map_rep, pairs).items():
+            print('%-12s %-9s %14.2f %12.3f %12.3f' % (name, metric, preprocessing, search * 1e3, query * 1e3))
+
+    print()
+    print('%-12s %-9s %12s %10s %12s %10s' % ('dataset', 'metric', 'one-way', 'seconds', 'two-way', 'seconds'))
+    for name, map_rep in maps.items():
+        pairs = random_node_pairs(map_rep, QUERIES_PER_DATASET)
+        for metric, (oneWay, oneWaySeconds, both, bothSeconds) in bench_bidirectional(map_rep, pairs).items():
+            print('%-12s %-9s %12d %10.3f %12d %10.3f' % (name, metric, oneWay, oneWaySeconds, both, bothSeconds))
+
+
+    print()
+    print('%-12s %-9s %12s' % ('dataset', 'matrix', 'seconds'))
+    for name, map_rep in maps.items():
+        locations = random_locations(map_rep, MATRIX_SIZE)
+        for method, seconds in bench_matrix(map_rep, locations).items():
+            print('%-12s %-9s %12.3f' % (name, method, seconds))
+
+
+    print()
+    print('%-12s %9s %14s %8s' % ('dataset', 'processes', 'queries/sec', 'speedup'))
+    for name, map_rep in maps.items():
+        locations = random_locations(map_rep, 2 * BULK_QUERIES)
+        queries = list(zip(locations[::2], locations[1::2]))
+        rates = bench_parallel(map_rep, queries)
+        for processes, rate in rates.items():
+            print('%-12s %9d %14.1f %8.2f' % (name, processes, rate, rate / rates[1]))
+
+
+    print()
+    print('%-12s %-13s %10s %12s %10s' % ('dataset', 'graph', 'nodes', 'expanded', 'seconds'))
+    for name, map_rep in maps.items():
+        pairs = random_node_pairs(map_rep, QUERIES_PER_DATASET)
+        for kind, (nodes, expanded, seconds) in bench_simplify(map_rep, pairs).items():
+            print('%-12s %-13s %10d %12d %10.3f' % (name, kind, nodes, expanded, seconds))
+
+
+    print()
+    print('%-12s %-9s %10s %8s %10s %8s' % ('dataset', 'cache', 'seconds', 'hits', 'tree hits', 'misses'))
+    for name, map_rep in maps.items():
+        pairs = random_node_pairs(map_rep, 8)
+        origins = [node1 for node1, node2 in pairs[:4]]
+        destinations = [node2 for node1, node2 in pairs]
+        for kind, (seconds, counters) in bench_query_cache(map_rep, origins, destinations).items():
+            counters = counters or {'hits': 0, 'tree_hits': 0, 'misses': 0}
+            print('%-12s %-9s %10.3f %8d %10d %8d' % (name, kind, seconds, counters['hits'],
+                                                      counters['tree_hits'], counters['misses']))
+
+
+    for name, map_rep in maps.items():
+        without, with_stats, recorder = bench_instrumentation(map_rep, random_locations(map_rep, 4 * QUERIES_PER_DATASET))
+        print()
+        print('%s: %.3f s without stats, %.3f s with stats' % (name, without, with_stats))
+        recorder.report()
+
+
+    print()
+    print('%-12s %-9s %16s' % ('dataset', 'distances', 'per second'))
+    for name, map_rep in maps.items():
+        rates, snapping = bench_distance_kernel(map_rep, random_locations(map_rep, QUERIES_PER_DATASET))
+        for kind, rate in rates.items():
+            print('%-12s %-9s %16.0f' % (name, kind, rate))
+        for kind, seconds in snapping.items():
+            print('%-12s %-9s %13.1f us per 10-nearest snap' % (name, kind, seconds * 1e6))
+
+
+    print()
+    print('%-12s %-9s %10s %12s' % ('dataset', 'departure', 'seconds', 'mean min'))
+    for name, map_rep in maps.items():
+        results, perEdge = bench_time_dependent(map_rep, random_locations(map_rep, 2 * QUERIES_PER_DATASET))
+        for kind, (seconds, minutes) in results.items():
+            print('%-12s %-9s %10.3f %12.2f' % (name, kind, seconds, minutes))
+        print('%-12s profiles add %.1f bytes per edge' % (name, perEdge))
+
+
+    print()
+    print('%-12s %10s %10s %8s %10s %10s' % ('dataset', 'build s', 'update s', 'edges', 'landmarks', 'kept'))
+    for name in maps:
+        with contextlib.redirect_stdout(io.StringIO()):
+            build_seconds, report = bench_updates(name)
+        print('%-12s %10.3f %10.3f %8d %10d %10d' % (name, build_seconds, report['seconds'],
+                                                     report['changed'] + report['closed'],
+                                                     report['landmarks_rebuilt'], report['landmarks_kept']))
+
+
+    print()
+    print('%-12s %10s %14s %16s %16s' % ('dataset', 'components', 'preprocess s', 'unreachable ms', 'with labels ms'))
+    for name, map_rep in maps.items():
+        found = bench_components(map_rep)
+        if found is not None:
+            preprocessing, count, results = found
+            print('%-12s %10d %14.3f %16.3f %16.4f' % (name, count, preprocessing, results['search'] * 1e3,
+                                                       results['components'] * 1e3))
+
+
+    print()
+    print('%-12s %8s %12s %14s %10s %12s' % ('dataset', 'reached', 'isochrone s', 'per-node s', 'origins', 'batch s'))
+    for name, map_rep in maps.items():
+        locations = random_locations(map_rep, 10 * QUERIES_PER_DATASET)
+        results = bench_isochrone(map_rep, locations)
+        print('%-12s %8d %12.4f %14.3f %10d %12.3f' % (name, results['nodes'], results['isochrone'],
+                                                      results['per_node'], len(locations), results['batch']))
+
+
+    print()
+    print('%-12s %8s %10s %10s %10s %10s %12s %12s' % ('dataset', 'tiles', 'build s', 'open ms', 'hits', 'misses',
+                                                       'resident KB', 'compact KB'))
+    for name in maps:
+        results = bench_tiles(name)
+        print('%-12s %8d %10.3f %10.3f %10.1f %10.1f %12.1f %12.1f'
+              % (name, results['tiles'], results['build'], results['open'] * 1e3, results['hits'],
+                 results['misses'], results['resident'] / 1024, results['compact'] / 1024))
+
+
+    print()
+    print('%-12s %-9s %10s %10s' % ('dataset', 'routes', 'ms', 'found'))
+    for name, map_rep in maps.items():
+        results = bench_alternatives(map_rep, random_node_pairs(map_rep, QUERIES_PER_DATASET))
+        for method, (seconds, found) in results.items():
+            print('%-12s %-9s %10.2f %10.2f' % (name, method, seconds * 1e3, found))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or DEFAULT_DATASETS)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Reproducible benchmark suite with a stored baseline
+
+bench.py compares implementation choices against each other.  This suite
+instead times the public entry points on fixed, seeded query sets so runs
+can be compared over time:
+
+    build        build_internal_representation
+    snapping     nearest_node for every query location
+    short        find_short_path_nodes for every query pair
+    heuristics   find_short_path_nodes_heuristics for every query pair
+    fast         find_fast_path for every pair of query locations
+
+Every task is timed (best of REPEATS runs) and then run once more under
+tracemalloc for its peak memory.  Run from the directory that holds lab.py
+and the resources folder:
+
+    python bench_suite.py --save-baseline bench_baseline.json
+    ... change something ...
+    python bench_suite.py --baseline bench_baseline.json
+
+With --baseline, tasks that got slower (or used more memory) by more than
+the tolerance are listed as regressions and the exit status is 1.
+"""
+
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+import lab
+import bench
+
+
+DEFAULT_DATASETS = ('mit', 'cambridge', 'midwest')
+QUERIES = 50
+REPEATS = 3
+DEFAULT_TOLERANCE = 0.15
+
+# Times below this many seconds are too noisy to call a regression
+MINIMUM_SECONDS = 0.005
+
+
+def _measure(task):
+    """
+    Return (best seconds over REPEATS runs, peak traced bytes of one more
+    run) of a function taking no arguments
+    """
+    best = float('inf')
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        task()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    task()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def tasks(name, map_rep):
+    """
+    Return a dictionary mapping each task name to a function running it on
+    a dataset's fixed query set
+    """
+    nodes_filename, ways_filename = 'resources/%s.nodes' % name, 'resources/%s.ways' % name
+    pairs = bench.random_node_pairs(map_rep, QUERIES)
+    locations = bench.random_locations(map_rep, 2 * QUERIES)
+    locationPairs = list(zip(locations[::2], locations[1::2]))
+
+    def build():
+        lab.build_internal_representation(nodes_filename, ways_filename)
+
+    def snapping():
+        for loc in locations:
+            lab.nearest_node(map_rep, loc)
+
+    def short():
+        for node1, node2 in pairs:
+            lab.find_short_path_nodes(map_rep, node1, node2)
+
+    def heuristics():
+        for node1, node2 in pairs:
+            lab.find_short_path_nodes_heuristics(map_rep, node1, node2)
+
+    def fast():
+        for loc1, loc2 in locationPairs:
+            lab.find_fast_path(map_rep, loc1, loc2)
+
+    return {'build': build, 'snapping': snapping, 'short': short, 'heuristics': heuristics, 'fast': fast}
+
+
+def run(datasets):
+    """
+    Run every task on every dataset whose files exist
+
+    Returns:
+        a dictionary with the settings of the run and, under 'results', a
+        dictionary mapping dataset name to task name to
+        {'seconds': ..., 'peak_bytes': ...}
+    """
+    results = {}
+    for name in datasets:
+        map_rep = bench.load_dataset(name)
+        if map_rep is None:
+            print('%-12s skipped (missing resources)' % name, file=sys.stderr)
+            continue
+        results[name] = {}
+        for task, function in tasks(name, map_rep).items():
+            seconds, peak = _measure(function)
+            results[name][task] = {'seconds': seconds, 'peak_bytes': peak}
+    return {
+        'seed': bench.SEED,
+        'queries': QUERIES,
+        'repeats': REPEATS,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def compare(current, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare a run with a baseline run
+
+    Returns:
+        a list of (dataset, task, measure, baseline value, current value)
+        tuples for every measure that grew by more than tolerance
+    """
+    regressions = []
+    for name, taskResults in current['results'].items():
+        for task, measures in taskResults.items():
+            before = baseline['results'].get(name, {}).get(task)
+            if before is None:
+                continue
+            for measure, value in measures.items():
+                if measure == 'seconds' and value < MINIMUM_SECONDS:
+                    continue
+                if value > before[measure] * (1 + tolerance):
+                    regressions.append((name, task, measure, before[measure], value))
+    return regressions
+
+
+def report(current, baseline=None, file=sys.stdout):
+    """
+    Print a run as a table, with the change from the baseline if given
+    """
+    print('%-12s %-11s %12s %14s %9s %9s' % ('dataset', 'task', 'ms', 'peak bytes', 'time', 'memory'), file=file)
+    for name, taskResults in current['results'].items():
+        for task, measures in taskResults.items():
+            before = baseline['results'].get(name, {}).get(task) if baseline else None
+            changes = ['', '']
+            if before is not None:
+                changes = ['%+8.1f%%' % (100.0 * (measures[measure] / before[measure] - 1))
+                           if before[measure] else '' for measure in ('seconds', 'peak_bytes')]
+            print('%-12s %-11s %12.2f %14d %9s %9s' % (name, task, measures['seconds'] * 1e3,
+                                                      measures['peak_bytes'], changes[0], changes[1]), file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the routing entry points on fixed query sets.')
+    parser.add_argument('datasets', nargs='*', default=list(DEFAULT_DATASETS))
+    parser.add_argument('--baseline', help='compare with the run stored in this JSON file')
+    parser.add_argument('--save-baseline', help='store this run in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='relative growth reported as a regression (default %(default)s)')
+    args = parser.parse_args(argv)
+
+    current = run(args.datasets)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline.get('seed'), baseline.get('queries')) != (current['seed'], current['queries']):
+            print('warning: baseline used a different query set', file=sys.stderr)
+    report(current, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(current, baseline, args.tolerance)
+        for name, task, measure, before, after in regressions:
+            print('regression: %s %s %s %.6g -> %.6g' % (name, task, measure, before, after))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
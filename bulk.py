@@ -0,0 +1,140 @@
+"""
+Bulk routing across several processes
+
+The search functions in lab.py are CPU-bound and run on one core.
+route_many spreads a long list of queries over a pool of worker processes.
+The map is not pickled for every task: on systems that can fork, the
+workers inherit it from the parent, and their pages are shared with it
+until written to.  Elsewhere every worker receives the map once, when it
+starts.
+
+Typical use:
+
+    map_rep = lab.build_internal_representation(nodes_filename, ways_filename)
+    paths = bulk.route_many(map_rep, [(loc1, loc2), (loc3, loc4), ...], 'fast')
+
+map_chunks does the same for any function that works on a list of items
+against the map (see isochrone.isochrones).
+"""
+
+import gc
+import os
+import functools
+import multiprocessing
+
+import lab
+
+
+QUERY_FUNCTIONS = {
+    'short': lab.find_short_path,
+    'short_heuristics': lab.find_short_path_heuristics,
+    'fast': lab.find_fast_path,
+}
+
+# Queries sent to a worker at a time.  Larger chunks cost less in messages,
+# smaller chunks keep the workers evenly loaded towards the end of a job.
+DEFAULT_CHUNK_SIZE = 64
+
+# The map used by the queries in this process, set before the workers are
+# started (fork) or by _initialize in every worker (spawn)
+_graph = None
+
+
+def _initialize(graph):
+    global _graph
+    _graph = graph
+
+
+def _run_chunk(task):
+    """
+    Run a function on a chunk of items against the map of this process
+    """
+    function, items = task
+    return function(_graph, items)
+
+
+def _route_chunk(kind, graph, queries):
+    """
+    Answer a chunk of (loc1, loc2) queries of one kind
+    """
+    function = QUERY_FUNCTIONS[kind]
+    return [function(graph, loc1, loc2) for loc1, loc2 in queries]
+
+
+def _chunks(queries, size):
+    for start in range(0, len(queries), size):
+        yield queries[start:start + size]
+
+
+def route_many(map_rep, queries, kind='fast', processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Answer many routing queries in parallel
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation, or a
+                 compact.CompactMap
+        queries: list of (loc1, loc2) tuples of (latitude, longitude) tuples
+        kind: 'short' for find_short_path, 'short_heuristics' for
+              find_short_path_heuristics or 'fast' for find_fast_path
+        processes: number of worker processes; defaults to the number of
+                   cores.  With 1 the queries are answered in this process.
+        chunk_size: number of queries handed to a worker at a time
+
+    Returns:
+        a list holding the result of every query, in the order of queries
+    """
+    if kind not in QUERY_FUNCTIONS:
+        raise ValueError('unknown query kind: %r' % (kind,))
+    return map_chunks(map_rep, functools.partial(_route_chunk, kind), queries, processes, chunk_size)
+
+
+def map_chunks(map_rep, function, items, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Run a function over chunks of a list of items in parallel
+
+    Parameters:
+        map_rep: the map the function works on
+        function: function taking the map and a list of items and returning
+                  a list of results, one per item; it must be picklable (a
+                  module-level function, or a functools.partial of one)
+        items: list of items
+        processes: number of worker processes; defaults to the number of
+                   cores.  With 1 the function runs in this process.
+        chunk_size: number of items handed to a worker at a time
+
+    Returns:
+        a list holding the result for every item, in the order of items
+    """
+    global _graph
+    graph = lab._as_graph(map_rep)
+    items = list(items)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, -(-len(items) // chunk_size)))
+
+    if processes == 1:
+        return function(graph, items)
+
+    # Builds the lazily created parts of the map before the workers start,
+    # so they are shared instead of being rebuilt by every worker
+    if getattr(graph, 'spatial_index', None) is None:
+        graph.build_spatial_index()
+
+    tasks = ((function, chunk) for chunk in _chunks(items, chunk_size))
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        _graph = graph
+        # Moves the map out of the reach of the cyclic garbage collector, so
+        # collections in the workers do not write to (and so copy) its pages
+        gc.freeze()
+        try:
+            with context.Pool(processes) as pool:
+                chunks = list(pool.imap(_run_chunk, tasks))
+        finally:
+            gc.unfreeze()
+            _graph = None
+    else:
+        with multiprocessing.Pool(processes, initializer=_initialize, initargs=(graph,)) as pool:
+            chunks = list(pool.imap(_run_chunk, tasks))
+
+    return [result for chunk in chunks for result in chunk]
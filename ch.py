@@ -0,0 +1,439 @@
+"""
+Contraction hierarchies for fast repeated queries on a static map
+
+Preprocessing contracts the nodes of the map one at a time, from least to
+most important, adding shortcut edges so that shortest path costs between
+the remaining nodes stay the same.  A query then runs a bidirectional
+Dijkstra search that only follows edges towards more important nodes,
+which settles a tiny part of the map, and unpacks the shortcuts on the path
+it finds back into the original nodes.
+
+Typical use:
+
+    map_rep = lab.build_internal_representation(nodes_filename, ways_filename)
+    map_rep = ch.prepare(map_rep)
+    lab.find_fast_path(map_rep, loc1, loc2)   # answered by the hierarchy
+
+Hierarchies can also be built offline and saved with write_hierarchy, one
+file per metric (here cambridge.distance and cambridge.time):
+
+    python ch.py resources/cambridge.nodes resources/cambridge.ways cambridge
+
+and attached to the map again with read_hierarchy and attach.
+"""
+
+import sys
+import heapq
+import pickle
+from array import array
+
+import lab
+
+
+# Most nodes a witness search may settle before giving up.  A witness search
+# that gives up early only costs an unnecessary shortcut, never a wrong path.
+WITNESS_SETTLE_LIMIT = 60
+
+NO_MIDDLE = -1
+
+
+class ContractionHierarchy:
+    """
+    Contraction hierarchy over one metric of a map
+
+    Nodes are numbered 0 to n - 1 in the order of graph.node_handles(), and
+    rank[i] is the order in which node i was contracted.  The upward edges
+    leaving node i (towards higher ranks) are entries upOffsets[i] to
+    upOffsets[i + 1] - 1 of upTargets, upWeights and upMiddles.  The down
+    arrays hold, for every node i, the edges that come into i from higher
+    ranked nodes, with downTargets giving their start node.  A middle of
+    NO_MIDDLE marks an original edge; any other middle is the node a
+    shortcut was made to skip.
+    """
+
+    def __init__(self, graph, metric, order=None):
+        """
+        Contract every node of a map
+
+        Parameters:
+            graph: map object with the methods of lab.MapRepresentation
+            metric: 'distance' or 'time'
+            order: optional rank of every node number (such as the rank of
+                   an earlier hierarchy of the same nodes) to contract in,
+                   which skips working out and updating the priorities;
+                   nodes numbered past its end are contracted first
+        """
+        self.metric = metric
+        self.handles = list(graph.node_handles())
+        n = len(self.handles)
+
+        # Node handles are used directly when they are already 0 to n - 1
+        if self.handles == list(range(n)):
+            self.local = None
+        else:
+            self.local = {handle: index for index, handle in enumerate(self.handles)}
+
+        # Loads the edges, keeping the cheapest of parallel edges
+        outEdges = [dict() for _ in range(n)]
+        inEdges = [dict() for _ in range(n)]
+        edges = graph.edges(metric)
+        for u, handle in enumerate(self.handles):
+            for child, cost in edges(handle):
+                v = self._index(child)
+                if v is None or v == u:
+                    continue
+                if v not in outEdges[u] or cost < outEdges[u][v][0]:
+                    outEdges[u][v] = (cost, NO_MIDDLE)
+                    inEdges[v][u] = (cost, NO_MIDDLE)
+
+        self.shortcuts = 0
+        self.rank = array('i', [0]) * n
+        up = [None] * n
+        down = [None] * n
+        contracted = bytearray(n)
+        deletedNeighbors = [0] * n
+
+        # Orders the nodes by edge difference plus contracted neighbors, and
+        # recomputes a node's priority lazily when it reaches the top (unless
+        # the order was given)
+        if order is None:
+            queue = [(self._priority(v, outEdges, inEdges, contracted, deletedNeighbors)[0], v) for v in range(n)]
+        else:
+            queue = [(order[v] if v < len(order) else -1, v) for v in range(n)]
+        heapq.heapify(queue)
+        nextRank = 0
+        while queue:
+            priority, v = heapq.heappop(queue)
+            current, needed = self._priority(v, outEdges, inEdges, contracted, deletedNeighbors)
+            if order is None and queue and current > queue[0][0]:
+                heapq.heappush(queue, (current, v))
+                continue
+
+            # Keeps v's remaining edges, which all lead to higher ranks
+            self.rank[v] = nextRank
+            nextRank += 1
+            up[v] = list(outEdges[v].items())
+            down[v] = list(inEdges[v].items())
+
+            for u, w, cost in needed:
+                existing = outEdges[u].get(w)
+                if existing is None or cost < existing[0]:
+                    if existing is None:
+                        self.shortcuts += 1
+                    outEdges[u][w] = (cost, v)
+                    inEdges[w][u] = (cost, v)
+
+            # Removes v from the remaining graph
+            contracted[v] = 1
+            for u in inEdges[v]:
+                del outEdges[u][v]
+                deletedNeighbors[u] += 1
+            for w in outEdges[v]:
+                del inEdges[w][v]
+                deletedNeighbors[w] += 1
+            outEdges[v] = None
+            inEdges[v] = None
+
+        self.upOffsets, self.upTargets, self.upWeights, self.upMiddles = self._pack(up)
+        self.downOffsets, self.downTargets, self.downWeights, self.downMiddles = self._pack(down)
+
+    def _index(self, handle):
+        """
+        Return the node number of a handle, or None if it is not in the map
+        """
+        if self.local is None:
+            return handle if 0 <= handle < len(self.handles) else None
+        return self.local.get(handle)
+
+    @staticmethod
+    def _witness_costs(source, skip, limit, targets, outEdges, contracted):
+        """
+        Run a bounded Dijkstra search from source that avoids skip and all
+        contracted nodes, and return the costs it found
+
+        The search stops once every target is settled, the cost passes
+        limit, or WITNESS_SETTLE_LIMIT nodes are settled.
+        """
+        costs = {source: 0}
+        settled = set()
+        remaining = len(targets)
+        queue = [(0, source)]
+        while queue and len(settled) < WITNESS_SETTLE_LIMIT:
+            cost, node = heapq.heappop(queue)
+            if node in settled:
+                continue
+            if cost > limit:
+                break
+            settled.add(node)
+            if node in targets:
+                remaining -= 1
+                if remaining == 0:
+                    break
+            for child, (edgeCost, middle) in outEdges[node].items():
+                if child == skip or contracted[child]:
+                    continue
+                childCost = cost + edgeCost
+                if childCost <= limit and childCost < costs.get(child, float('inf')):
+                    costs[child] = childCost
+                    heapq.heappush(queue, (childCost, child))
+        return costs
+
+    def _shortcuts_needed(self, u, v, costIn, outEdges, contracted):
+        """
+        Return the (w, cost) shortcuts u -> w that contracting v would need,
+        one for every path u -> v -> w with no cheaper witness path
+        """
+        viaCosts = {w: costIn + costOut for w, (costOut, middle) in outEdges[v].items() if w != u}
+        if not viaCosts:
+            return []
+        witness = self._witness_costs(u, v, max(viaCosts.values()), viaCosts, outEdges, contracted)
+        return [(w, cost) for w, cost in viaCosts.items() if witness.get(w, float('inf')) > cost]
+
+    def _priority(self, v, outEdges, inEdges, contracted, deletedNeighbors):
+        """
+        Return the contraction priority of v (the shortcuts it would add
+        minus the edges it would remove, plus its contracted neighbors) and
+        the (u, w, cost) shortcuts themselves
+        """
+        needed = []
+        for u, (costIn, middle) in inEdges[v].items():
+            for w, cost in self._shortcuts_needed(u, v, costIn, outEdges, contracted):
+                needed.append((u, w, cost))
+        return len(needed) - len(inEdges[v]) - len(outEdges[v]) + deletedNeighbors[v], needed
+
+    @staticmethod
+    def _pack(adjacency):
+        """
+        Lay out per-node lists of (node, (cost, middle)) as CSR arrays
+        """
+        offsets = array('q', [0])
+        targets = array('i')
+        weights = array('d')
+        middles = array('i')
+        for entries in adjacency:
+            for node, (cost, middle) in entries:
+                targets.append(node)
+                weights.append(cost)
+                middles.append(middle)
+            offsets.append(len(targets))
+        return offsets, targets, weights, middles
+
+    def _middle(self, u, w):
+        """
+        Return the middle of the hierarchy edge u -> w
+        """
+        if self.rank[u] < self.rank[w]:
+            for edge in range(self.upOffsets[u], self.upOffsets[u + 1]):
+                if self.upTargets[edge] == w:
+                    return self.upMiddles[edge]
+        else:
+            for edge in range(self.downOffsets[w], self.downOffsets[w + 1]):
+                if self.downTargets[edge] == u:
+                    return self.downMiddles[edge]
+        raise KeyError((u, w))
+
+    def _unpack(self, path):
+        """
+        Replace every shortcut on a path of node numbers with the nodes it
+        skips
+        """
+        result = [path[0]]
+        stack = [(path[i], path[i + 1]) for i in range(len(path) - 2, -1, -1)]
+        while stack:
+            u, w = stack.pop()
+            middle = self._middle(u, w)
+            if middle == NO_MIDDLE:
+                result.append(w)
+            else:
+                stack.append((middle, w))
+                stack.append((u, middle))
+        return result
+
+    def query(self, node1, node2, stats=None, sources=None, targets=None):
+        """
+        Return the cheapest path between two node handles
+
+        Parameters:
+            node1: handle of the start node
+            node2: handle of the end node
+            stats: optional dictionary filled with the same keys as
+                   lab._search
+            sources: optional list of (handle, cost) pairs to start the
+                     search from in place of node1, each at the cost of
+                     getting there from node1, for a start node that the
+                     hierarchy does not know (see simplify.py)
+            targets: optional list of (handle, cost) pairs to end the
+                     search at in place of node2, each at the cost of
+                     getting from there to node2
+
+        Returns:
+            a tuple (path, settled) where path is a list of node handles
+            from node1 to node2 (None if there is no path) and settled is
+            the number of nodes settled by both directions together
+        """
+        # Starts each direction from its end node, or from its seeds
+        costs = ({}, {})
+        for side, node, seeds in ((0, node1, sources), (1, node2, targets)):
+            for handle, cost in [(node, 0)] if seeds is None else seeds:
+                number = self._index(handle)
+                if number is not None and cost < costs[side].get(number, float('inf')):
+                    costs[side][number] = cost
+        if not costs[0] or not costs[1]:
+            return None, 0
+
+        # Both directions only climb towards higher ranks
+        sides = (
+            (self.upOffsets, self.upTargets, self.upWeights),
+            (self.downOffsets, self.downTargets, self.downWeights),
+        )
+        parents = (dict.fromkeys(costs[0]), dict.fromkeys(costs[1]))
+        queues = ([(cost, node) for node, cost in costs[0].items()],
+                  [(cost, node) for node, cost in costs[1].items()])
+        for queue in queues:
+            heapq.heapify(queue)
+        settled = (set(), set())
+        done = [False, False]
+        best = float('inf')
+        meeting = None
+        for node, cost in costs[0].items():
+            if node in costs[1] and cost + costs[1][node] < best:
+                best = cost + costs[1][node]
+                meeting = node
+        pushes = len(queues[0]) + len(queues[1])
+        stalePops = 0
+        peakAgenda = pushes
+
+        while not (done[0] and done[1]):
+            # A direction is done once its agenda is empty
+            for side in (0, 1):
+                if not queues[side]:
+                    done[side] = True
+            if done[0] and done[1]:
+                break
+
+            # Advances the direction whose next node is closer
+            if done[0]:
+                side = 1
+            elif done[1]:
+                side = 0
+            else:
+                side = 0 if queues[0][0][0] <= queues[1][0][0] else 1
+            queue = queues[side]
+            if not queue or queue[0][0] >= best:
+                done[side] = True
+                continue
+
+            cost, node = heapq.heappop(queue)
+            if node in settled[side]:
+                stalePops += 1
+                continue
+            settled[side].add(node)
+
+            # Checks whether the other direction has reached this node
+            other = costs[1 - side].get(node)
+            if other is not None and cost + other < best:
+                best = cost + other
+                meeting = node
+
+            offsets, targets, weights = sides[side]
+            for edge in range(offsets[node], offsets[node + 1]):
+                child = targets[edge]
+                childCost = cost + weights[edge]
+                if childCost < costs[side].get(child, float('inf')):
+                    costs[side][child] = childCost
+                    parents[side][child] = node
+                    heapq.heappush(queue, (childCost, child))
+                    pushes += 1
+            peakAgenda = max(peakAgenda, len(queues[0]) + len(queues[1]))
+
+        expanded = len(settled[0]) + len(settled[1])
+        if stats is not None:
+            stats['expanded'] = expanded
+            stats['pushes'] = pushes
+            stats['stale_pops'] = stalePops
+            stats['peak_agenda'] = peakAgenda
+            stats['peak_path_nodes'] = len(parents[0]) + len(parents[1])
+
+        if meeting is None:
+            return None, expanded
+
+        # Joins the two halves at the meeting node and unpacks the shortcuts
+        path = []
+        node = meeting
+        while node is not None:
+            path.append(node)
+            node = parents[0][node]
+        path.reverse()
+        node = parents[1][meeting]
+        while node is not None:
+            path.append(node)
+            node = parents[1][node]
+
+        path = [self.handles[node] for node in self._unpack(path)]
+        if path[0] != node1:
+            path.insert(0, node1)
+        if path[-1] != node2:
+            path.append(node2)
+        return path, expanded
+
+
+def prepare(map_rep, metrics=('distance', 'time')):
+    """
+    Build contraction hierarchies for a map and attach them to it, so that
+    the search functions in lab.py use them
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation, or a
+                 compact.CompactMap
+        metrics: the metrics to build hierarchies for
+
+    Returns:
+        the map with the hierarchies attached (a MapRepresentation if a plain
+        tuple was passed in)
+    """
+    graph = lab._as_graph(map_rep)
+    for metric in metrics:
+        graph.hierarchies[metric] = ContractionHierarchy(graph, metric)
+    return graph
+
+
+def write_hierarchy(hierarchy, filename):
+    """
+    Save a ContractionHierarchy to a file
+    """
+    with open(filename, 'wb') as f:
+        pickle.dump(hierarchy, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_hierarchy(filename):
+    """
+    Load a ContractionHierarchy saved by write_hierarchy
+    """
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def attach(map_rep, hierarchy):
+    """
+    Attach a loaded ContractionHierarchy to the map it was built from
+
+    Returns:
+        the map with the hierarchy attached
+    """
+    graph = lab._as_graph(map_rep)
+    if len(hierarchy.handles) != len(graph.node_handles()):
+        raise ValueError('hierarchy was built for a different map')
+    graph.hierarchies[hierarchy.metric] = hierarchy
+    return graph
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print('usage: python ch.py NODES_FILE WAYS_FILE OUTPUT_PREFIX')
+        sys.exit(1)
+    nodes_filename, ways_filename, prefix = sys.argv[1:]
+    graph = lab.build_internal_representation(nodes_filename, ways_filename)
+    for metric in ('distance', 'time'):
+        hierarchy = ContractionHierarchy(graph, metric)
+        write_hierarchy(hierarchy, '%s.%s' % (prefix, metric))
+        print('%s: %d nodes, %d shortcuts' % (metric, len(hierarchy.handles), hierarchy.shortcuts))
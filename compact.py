@@ -0,0 +1,355 @@
+"""
+Compact, array-backed map representation
+
+build_internal_representation keeps every node as a full OSM dictionary and
+every edge as a dictionary entry, which takes a lot of memory for a large
+extract.  CompactMap keeps the same graph in a handful of flat typed arrays
+instead, and can be passed to any of the search functions in lab.py in place
+of the usual map representation.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+import lab
+import geo
+from util import great_circle_distance
+
+
+class CompactMap:
+    """
+    Map representation backed by typed arrays
+
+    Nodes are renumbered 0 to n - 1 in the order they appear in the nodes
+    dictionary, and the search works on those numbers.  Edges are stored in
+    compressed sparse row (CSR) form: the edges leaving node i are the
+    entries offsets[i] to offsets[i + 1] - 1 of targets, speeds, lengths and
+    times.
+
+    Attributes:
+        ids: OSM node ID of every node
+        lats: latitude of every node
+        lons: longitude of every node
+        offsets: start of every node's edges, plus the total edge count
+        targets: node number at the end of every edge
+        speeds: speed limit of every edge in miles per hour
+        lengths: length of every edge in miles
+        times: travel time of every edge in hours
+        spatial_index: lab.NodeGrid over lats and lons, built on the first
+                       nearest query
+        reverse: (offsets, sources, edge numbers) CSR arrays of the edges
+                 coming into every node, built the first time a
+                 bidirectional search needs them
+        sortedIds: the node IDs in increasing order
+        sortedPositions: the node number of every entry of sortedIds
+        hierarchies: dictionary mapping a metric to a contraction hierarchy
+                     (see ch.py) that answers queries for that metric
+        landmarks: dictionary mapping a metric to a landmark table (see
+                   landmarks.py) that gives A* heuristics for that metric
+        version: number bumped every time the edge weights change, as for
+                 lab.MapRepresentation
+
+    Any sequence type that supports len, indexing and slicing works for the
+    attributes, such as arrays or memoryviews over a memory-mapped file.
+    """
+
+    def __init__(self, ids, lats, lons, offsets, targets, speeds, lengths, times,
+                 sortedIds=None, sortedPositions=None):
+        self.ids = ids
+        self.lats = lats
+        self.lons = lons
+        self.offsets = offsets
+        self.targets = targets
+        self.speeds = speeds
+        self.lengths = lengths
+        self.times = times
+
+        # Sorted copy of the IDs for looking up node numbers by OSM ID
+        if sortedIds is None:
+            order = sorted(range(len(ids)), key=ids.__getitem__)
+            sortedIds = array('q', [ids[position] for position in order])
+            sortedPositions = array('i', order)
+        self.sortedIds = sortedIds
+        self.sortedPositions = sortedPositions
+
+        self.spatial_index = None
+        self.reverse = None
+        self.hierarchies = {}
+        self.landmarks = {}
+        self.version = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def internal_id(self, node):
+        """
+        Return the node number for an OSM node ID
+        """
+        position = bisect_left(self.sortedIds, node)
+        if position == len(self.sortedIds) or self.sortedIds[position] != node:
+            raise KeyError(node)
+        return self.sortedPositions[position]
+
+    def external_id(self, node):
+        """
+        Return the OSM node ID for a node number
+        """
+        return self.ids[node]
+
+    def node_handles(self):
+        """
+        Return the node numbers of every node in the map
+        """
+        return range(len(self.ids))
+
+    def location(self, node):
+        """
+        Return the (latitude, longitude) of a node number
+        """
+        return (self.lats[node], self.lons[node])
+
+    def edges(self, metric):
+        """
+        Return a function that gives the outgoing edges of a node number
+
+        Parameters:
+            metric: 'distance' for edge lengths in miles or 'time' for travel
+                    times in hours
+
+        Returns:
+            a function taking a node number and returning an iterable of
+            (child, cost) tuples
+        """
+        offsets, targets = self.offsets, self.targets
+        weights = self.lengths if metric == 'distance' else self.times
+
+        def edges(node):
+            start, end = offsets[node], offsets[node + 1]
+            return zip(targets[start:end], weights[start:end])
+
+        return edges
+
+    def _edge_number(self, node, child):
+        """
+        Return the number of the edge from node to child, or None if there
+        is no such edge
+        """
+        for edge in range(self.offsets[node], self.offsets[node + 1]):
+            if self.targets[edge] == child:
+                return edge
+        return None
+
+    def edge_speed(self, node, child):
+        """
+        Return the speed of the edge from node to child in miles per hour, or
+        None if there is no such edge
+        """
+        edge = self._edge_number(node, child)
+        return None if edge is None else self.speeds[edge]
+
+    def update_edges(self, changes):
+        """
+        Change the speed of edges or remove them
+
+        Speed changes rewrite the edge's travel time in place.  Removals
+        close the gaps in the edge arrays and shift the offsets of the
+        nodes after them, in one pass for the whole batch, and drop the
+        reverse arrays so they are rebuilt when next needed.  Arrays that
+        are read-only views (such as a memory-mapped cache) are copied
+        first.
+
+        Parameters:
+            changes: dictionary mapping (node, child) edges to their new
+                     speed in miles per hour, or to None to remove them;
+                     every edge must exist
+
+        Returns:
+            a dictionary with the number of edges 'changed' and 'removed'
+        """
+        for name in ('offsets', 'targets', 'speeds', 'lengths', 'times'):
+            values = getattr(self, name)
+            if not isinstance(values, array):
+                setattr(self, name, array(values.format, values))
+
+        removed = []
+        for (node, child), speed in changes.items():
+            edge = self._edge_number(node, child)
+            if speed is None:
+                removed.append(edge)
+            else:
+                self.speeds[edge] = speed
+                self.times[edge] = self.lengths[edge] / speed
+
+        if removed:
+            removed.sort()
+            for name in ('targets', 'speeds', 'lengths', 'times'):
+                values = getattr(self, name)
+                kept = array(values.typecode)
+                previous = 0
+                for edge in removed:
+                    kept += values[previous:edge]
+                    previous = edge + 1
+                kept += values[previous:]
+                setattr(self, name, kept)
+
+            # Every offset moves back by the removed edges before it
+            offsets = self.offsets
+            passed = 0
+            for node in range(bisect_right(offsets, removed[0]), len(offsets)):
+                while passed < len(removed) and removed[passed] < offsets[node]:
+                    passed += 1
+                offsets[node] -= passed
+            self.reverse = None
+
+        self.version += 1
+        return {'changed': len(changes) - len(removed), 'removed': len(removed)}
+
+    def unindex(self, nodes):
+        """
+        Stop snapping locations to some node numbers until the spatial index
+        is rebuilt
+        """
+        if self.spatial_index is None:
+            self.build_spatial_index()
+        for node in nodes:
+            self.spatial_index.remove(node)
+
+    def build_spatial_index(self, kernel=geo.distances_from):
+        """
+        Build the NodeGrid used by nearest, with the batched distance
+        kernel by default
+        """
+        self.spatial_index = lab.NodeGrid(self.lats, self.lons, kernel)
+
+    def straight_line_heuristic(self, node):
+        """
+        Return a function giving the straight-line distance in miles from
+        every node number to the given node number, computed once per node
+        (see geo.straight_line_heuristic)
+        """
+        return geo.straight_line_heuristic(self.location(node), self.lats, self.lons)
+
+    def build_reverse_edges(self):
+        """
+        Build the CSR arrays of the edges coming into every node
+        """
+        n = len(self.ids)
+        offsets, targets = self.offsets, self.targets
+
+        # Counts the incoming edges of every node, then turns the counts
+        # into the start of every node's block
+        reverseOffsets = array('q', [0]) * (n + 1)
+        for edge in range(len(targets)):
+            reverseOffsets[targets[edge] + 1] += 1
+        for node in range(n):
+            reverseOffsets[node + 1] += reverseOffsets[node]
+
+        # Fills every node's block in order of the edges' start nodes
+        sources = array('i', [0]) * len(targets)
+        edgeNumbers = array('q', [0]) * len(targets)
+        nextSlot = array('q', reverseOffsets[:n])
+        for node in range(n):
+            for edge in range(offsets[node], offsets[node + 1]):
+                slot = nextSlot[targets[edge]]
+                sources[slot] = node
+                edgeNumbers[slot] = edge
+                nextSlot[targets[edge]] += 1
+
+        self.reverse = (reverseOffsets, sources, edgeNumbers)
+
+    def reverse_edges(self, metric):
+        """
+        Return a function that gives the incoming edges of a node number
+
+        Parameters:
+            metric: 'distance' or 'time', as for edges
+
+        Returns:
+            a function taking a node number and returning a list of
+            (parent, cost) tuples
+        """
+        if self.reverse is None:
+            self.build_reverse_edges()
+        reverseOffsets, sources, edgeNumbers = self.reverse
+        weights = self.lengths if metric == 'distance' else self.times
+
+        def edges(node):
+            return [(sources[slot], weights[edgeNumbers[slot]])
+                    for slot in range(reverseOffsets[node], reverseOffsets[node + 1])]
+
+        return edges
+
+    def nearest(self, loc, k=1):
+        """
+        Return a list of the (up to) k node numbers closest to loc, closest
+        first
+        """
+        if self.spatial_index is None:
+            self.build_spatial_index()
+        return self.spatial_index.nearest(loc, k)
+
+    def nbytes(self):
+        """
+        Return the number of bytes held by the arrays
+        """
+        return sum(len(values) * values.itemsize for values in (
+            self.ids, self.lats, self.lons, self.offsets, self.targets, self.speeds,
+            self.lengths, self.times, self.sortedIds, self.sortedPositions))
+
+
+def compact_representation(map_rep):
+    """
+    Convert the result of build_internal_representation to a CompactMap
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation
+
+    Returns:
+        a CompactMap holding the same graph.  Node IDs must be integers.
+        Edges to nodes that are missing from the nodes file are dropped.
+    """
+    nodes, neighbors, waySet = map_rep
+
+    # Numbers the nodes in the same order the spatial index uses
+    order = [node for node in nodes if node in waySet]
+    position = {node: index for index, node in enumerate(order)}
+
+    ids = array('q', order)
+    lats = array('d', [nodes[node]['lat'] for node in order])
+    lons = array('d', [nodes[node]['lon'] for node in order])
+
+    # Lays out the edges of every node one after the other, keeping the order
+    # of the neighbors dictionary so ties are broken the same way
+    offsets = array('q', [0])
+    targets = array('i')
+    speeds = array('d')
+    lengths = array('d')
+    times = array('d')
+    for node in order:
+        here = (nodes[node]['lat'], nodes[node]['lon'])
+        for child, speed in neighbors.get(node, {}).items():
+            if child in position:
+                length = great_circle_distance(here, (nodes[child]['lat'], nodes[child]['lon']))
+                targets.append(position[child])
+                speeds.append(speed)
+                lengths.append(length)
+                times.append(length / speed)
+        offsets.append(len(targets))
+
+    compact_map = CompactMap(ids, lats, lons, offsets, targets, speeds, lengths, times)
+    compact_map.build_spatial_index()
+    return compact_map
+
+
+def build_compact_representation(nodes_filename, ways_filename):
+    """
+    Build a CompactMap straight from the given OSM files
+
+    Parameters:
+        nodes_filename: path to the .nodes file
+        ways_filename: path to the .ways file
+
+    Returns:
+        a CompactMap of the map
+    """
+    return compact_representation(lab.build_internal_representation(nodes_filename, ways_filename))
@@ -0,0 +1,258 @@
+"""
+Strongly connected components, for answering unreachable queries at once
+
+When the start of a query cannot reach its end (say the end is the exit of
+a one-way parking lot), a search only finds out by expanding everything the
+start can reach.  Components labels every node with its strongly connected
+component, computed once with an iterative version of Tarjan's algorithm
+(so large maps cannot hit the recursion limit), and decides from the labels
+whether one node can reach another:
+
+    same component                          always
+    components in the wrong order           never (checked in O(1))
+    to, from or through the largest         O(1) with two flags per
+    component                               component
+    anything else                           a search of the (tiny) graph
+                                            of components
+
+Snapping can also be restricted to the largest component, so that locations
+never snap onto an isolated fragment.
+
+Typical use:
+
+    map_rep = lab.build_internal_representation(nodes_filename, ways_filename)
+    map_rep = components.prepare(map_rep, restrict_snapping=True)
+    lab.find_fast_path(map_rep, loc1, loc2)   # None at once if unreachable
+"""
+
+from array import array
+
+import lab
+
+
+class Components:
+    """
+    Strongly connected components of a map
+
+    Nodes are numbered 0 to n - 1 in the order of graph.node_handles().
+    Components are numbered in the order Tarjan's algorithm finds them,
+    which is a reverse topological order: every edge between two components
+    goes from a higher number to a lower one.
+
+    Attributes:
+        graph: the map the components were computed for
+        labels: component number of every node number
+        sizes: number of nodes in every component
+        largest: number of the largest component
+        dagOffsets, dagTargets: CSR arrays of the edges between components
+        reachesLargest: bytearray flagging the components that can reach
+                        the largest one
+        reachedFromLargest: bytearray flagging the components the largest
+                            one can reach
+        version: the map version the components were computed for; the
+                 labels are not used once the map changes
+    """
+
+    def __init__(self, graph):
+        """
+        Compute the components of a map
+
+        Parameters:
+            graph: map object with the methods of lab.MapRepresentation
+        """
+        self.graph = graph
+        self.version = getattr(graph, 'version', 0)
+        handles = list(graph.node_handles())
+        n = len(handles)
+        self.size = n
+        if handles == list(range(n)):
+            self.local = None
+        else:
+            self.local = {handle: index for index, handle in enumerate(handles)}
+
+        adjacency = [[] for _ in range(n)]
+        edges = graph.edges('distance')
+        for u, handle in enumerate(handles):
+            for child, cost in edges(handle):
+                v = self._index(child)
+                if v is not None:
+                    adjacency[u].append(v)
+
+        self.labels = self._tarjan(adjacency)
+        count = max(self.labels, default=-1) + 1
+        self.sizes = array('i', [0]) * count
+        for label in self.labels:
+            self.sizes[label] += 1
+        self.largest = max(range(count), key=self.sizes.__getitem__, default=-1)
+
+        # Graph of the components, without duplicate edges
+        successors = [set() for _ in range(count)]
+        for u in range(n):
+            for v in adjacency[u]:
+                if self.labels[u] != self.labels[v]:
+                    successors[self.labels[u]].add(self.labels[v])
+        self.dagOffsets = array('q', [0])
+        self.dagTargets = array('i')
+        for targets in successors:
+            self.dagTargets.extend(sorted(targets))
+            self.dagOffsets.append(len(self.dagTargets))
+
+        # Successors have lower numbers, so one pass upwards settles what
+        # reaches the largest component and one pass downwards what it reaches
+        self.reachesLargest = bytearray(count)
+        self.reachedFromLargest = bytearray(count)
+        if count:
+            self.reachedFromLargest[self.largest] = 1
+        for component in range(count):
+            if component == self.largest or any(self.reachesLargest[target] for target in self._successors(component)):
+                self.reachesLargest[component] = 1
+        for component in range(count - 1, -1, -1):
+            if self.reachedFromLargest[component]:
+                for target in self._successors(component):
+                    self.reachedFromLargest[target] = 1
+
+    @staticmethod
+    def _tarjan(adjacency):
+        """
+        Return the component number of every node of an adjacency list,
+        with Tarjan's algorithm run on an explicit stack
+        """
+        n = len(adjacency)
+        index = array('i', [-1]) * n
+        low = array('i', [0]) * n
+        onStack = bytearray(n)
+        labels = array('i', [-1]) * n
+        stack = []
+        counter = 0
+        component = 0
+
+        for root in range(n):
+            if index[root] != -1:
+                continue
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            onStack[root] = 1
+            # Every entry is a node and the iterator over its remaining
+            # children, standing in for a recursive call
+            work = [(root, iter(adjacency[root]))]
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if index[child] == -1:
+                        index[child] = low[child] = counter
+                        counter += 1
+                        stack.append(child)
+                        onStack[child] = 1
+                        work.append((child, iter(adjacency[child])))
+                        break
+                    if onStack[child] and index[child] < low[node]:
+                        low[node] = index[child]
+                else:
+                    # Every child is done: returns to the caller
+                    work.pop()
+                    if work and low[node] < low[work[-1][0]]:
+                        low[work[-1][0]] = low[node]
+                    if low[node] == index[node]:
+                        while True:
+                            member = stack.pop()
+                            onStack[member] = 0
+                            labels[member] = component
+                            if member == node:
+                                break
+                        component += 1
+        return labels
+
+    def _index(self, handle):
+        """
+        Return the node number of a handle, or None if it is not in the map
+        """
+        if self.local is None:
+            return handle if 0 <= handle < self.size else None
+        return self.local.get(handle)
+
+    def _successors(self, component):
+        return self.dagTargets[self.dagOffsets[component]:self.dagOffsets[component + 1]]
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def label(self, node):
+        """
+        Return the component number of a node handle, or None if it is not
+        in the map
+        """
+        index = self._index(node)
+        return None if index is None else self.labels[index]
+
+    def reachable(self, node1, node2):
+        """
+        Check whether there is a path from node1 to node2
+
+        Nodes the components do not know, and maps that changed since the
+        components were computed, are reported as reachable so the search
+        decides.
+        """
+        if getattr(self.graph, 'version', 0) != self.version:
+            return True
+        source, target = self.label(node1), self.label(node2)
+        if source is None or target is None or source == target:
+            return True
+        if source < target:
+            return False
+        if source == self.largest:
+            return bool(self.reachedFromLargest[target])
+        if target == self.largest:
+            return bool(self.reachesLargest[source])
+        if self.reachesLargest[source] and self.reachedFromLargest[target]:
+            return True
+
+        # Searches the graph of components, only through components that
+        # come before the target and (once the largest one is ruled out)
+        # avoiding the largest one
+        seen = {source}
+        stack = [source]
+        while stack:
+            for component in self._successors(stack.pop()):
+                if component == target:
+                    return True
+                if component > target and component != self.largest and component not in seen:
+                    seen.add(component)
+                    stack.append(component)
+        return False
+
+    def nbytes(self):
+        """
+        Return the number of bytes held by the arrays
+        """
+        return (len(self.labels) * self.labels.itemsize + len(self.sizes) * self.sizes.itemsize
+                + len(self.dagOffsets) * self.dagOffsets.itemsize + len(self.dagTargets) * self.dagTargets.itemsize
+                + len(self.reachesLargest) + len(self.reachedFromLargest))
+
+
+def prepare(map_rep, restrict_snapping=False):
+    """
+    Compute the strongly connected components of a map and attach them to
+    it, so that the search functions in lab.py reject unreachable queries
+    without searching
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation, a
+                 compact.CompactMap or a simplify.SimplifiedMap (whose
+                 components are computed over its full map)
+        restrict_snapping: take every node outside the largest component
+                           out of the spatial index, so locations only snap
+                           to the largest component (until the spatial index
+                           is rebuilt)
+
+    Returns:
+        the map with a Components attached as map_rep.components (a
+        MapRepresentation if a plain tuple was passed in)
+    """
+    graph = lab._as_graph(map_rep)
+    full = getattr(graph, 'base', graph)
+    graph.components = Components(full)
+    if restrict_snapping:
+        labels, largest = graph.components.labels, graph.components.largest
+        full.unindex([handle for index, handle in enumerate(full.node_handles()) if labels[index] != largest])
+    return graph
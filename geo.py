@@ -0,0 +1,138 @@
+"""
+Batched great circle distances
+
+util.great_circle_distance works on one pair of points at a time, redoing
+the trigonometry of both points on every call.  distances_from computes the
+distances from one point to many points, given as contiguous latitude and
+longitude sequences, in one call: with numpy when it is installed and the
+batch is large enough to pay for the call, and otherwise with a pure-Python
+loop that still only does the first point's trigonometry once.
+
+The earth radius is taken from util.great_circle_distance itself, so both
+agree (up to rounding) on every distance.
+
+Typical use:
+
+    map_rep = lab.build_internal_representation(nodes_filename, ways_filename)
+    geo.use_kernel(map_rep)   # snapping now goes through distances_from
+"""
+
+import math
+from array import array
+
+from util import great_circle_distance
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+EARTH_RADIUS_MILES = great_circle_distance((0.0, 0.0), (1.0, 0.0)) / math.radians(1.0)
+
+# Smallest batch handed to numpy; smaller ones cost less in pure Python
+NUMPY_MIN_BATCH = 64
+
+
+def _distance_function(point):
+    """
+    Return a function taking a latitude and a longitude and returning their
+    haversine distance from point, with the trigonometry of point done once
+    """
+    radians, sin, cos, asin, sqrt = math.radians, math.sin, math.cos, math.asin, math.sqrt
+    lat1 = radians(point[0])
+    lon1 = radians(point[1])
+    cos1 = cos(lat1)
+    diameter = 2 * EARTH_RADIUS_MILES
+
+    def distance(lat, lon):
+        lat2 = radians(lat)
+        a = sin((lat2 - lat1) / 2) ** 2 + cos1 * cos(lat2) * sin((radians(lon) - lon1) / 2) ** 2
+        return diameter * asin(sqrt(min(a, 1.0)))
+
+    return distance
+
+
+def _python_distances(point, lats, lons):
+    """
+    Pure-Python haversine from one point to many
+    """
+    distance = _distance_function(point)
+    return array('d', map(distance, lats, lons))
+
+
+def _numpy_distances(point, lats, lons):
+    """
+    numpy haversine from one point to many
+    """
+    lat1 = math.radians(point[0])
+    lon1 = math.radians(point[1])
+    lat2 = numpy.radians(numpy.asarray(lats, dtype=numpy.float64))
+    lon2 = numpy.radians(numpy.asarray(lons, dtype=numpy.float64))
+    a = numpy.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+def distances_from(point, lats, lons):
+    """
+    Return the great circle distances in miles from one point to many
+
+    Parameters:
+        point: tuple of 2 floats: (latitude, longitude)
+        lats: sequence of latitudes (a list, array, memoryview or numpy
+              array)
+        lons: sequence of longitudes, in the same order
+
+    Returns:
+        a sequence of distances supporting len, indexing and iteration
+    """
+    if numpy is not None and len(lats) >= NUMPY_MIN_BATCH:
+        return _numpy_distances(point, lats, lons)
+    return _python_distances(point, lats, lons)
+
+
+class DistanceTable:
+    """
+    Straight-line distances from one point to the nodes of a map, each
+    computed the first time it is needed and kept in a dictionary
+
+    Calling the table with a node number returns its distance, so it can be
+    used directly as an A* heuristic.  A query only pays for the nodes it
+    touches, whatever the size of the map.  The distances are those of the
+    pure-Python kernel, one node at a time, since A* asks for them one child
+    at a time; snapping, which knows its batch up front, goes through
+    distances_from instead.
+    """
+
+    def __init__(self, point, lats, lons):
+        self.point = point
+        self.lats = lats
+        self.lons = lons
+        self.values = {}
+        self.distance = _distance_function(point)
+
+    def __call__(self, node):
+        value = self.values.get(node)
+        if value is None:
+            value = self.values[node] = self.distance(self.lats[node], self.lons[node])
+        return value
+
+
+def straight_line_heuristic(point, lats, lons):
+    """
+    Return a DistanceTable giving the straight-line distance from point to
+    the node with a given number
+    """
+    return DistanceTable(point, lats, lons)
+
+
+def use_kernel(map_rep):
+    """
+    Rebuild the spatial index of a map so that snapping goes through
+    distances_from
+
+    Returns:
+        the map
+    """
+    map_rep.build_spatial_index(distances_from)
+    return map_rep
@@ -0,0 +1,249 @@
+"""
+Persistent binary cache of built maps
+
+Building a map means two full passes of read_osm_data over the OSM files.
+load_map skips that work by writing the arrays of a compact.CompactMap to a
+cache file the first time, and memory-mapping them on later runs, so that
+loading takes about the same time no matter how large the map is.
+
+A cache file is only used when it was built from the same input files (same
+size and modification time, or failing that the same content hash), with
+the same ALLOWED_HIGHWAY_TYPES and DEFAULT_SPEED_LIMIT_MPH tables, the same
+file format version and the same byte order.  Otherwise it is rebuilt.
+"""
+
+import os
+import sys
+import json
+import mmap
+import struct
+import hashlib
+from array import array
+
+import lab
+import compact
+import ingest
+
+
+MAGIC = b'GMAPGRPH'
+FORMAT_VERSION = 1
+
+# Arrays of a CompactMap that are stored in the cache, with their type codes
+ARRAY_FIELDS = (
+    ('ids', 'q'),
+    ('lats', 'd'),
+    ('lons', 'd'),
+    ('offsets', 'q'),
+    ('targets', 'i'),
+    ('speeds', 'd'),
+    ('lengths', 'd'),
+    ('times', 'd'),
+    ('sortedIds', 'q'),
+    ('sortedPositions', 'i'),
+)
+
+# Array data starts on a multiple of this many bytes
+ALIGNMENT = 8
+
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def default_cache_filename(nodes_filename, ways_filename):
+    """
+    Return the cache path used when none is given: the ways file with its
+    extension replaced by .graph
+    """
+    return os.path.splitext(ways_filename)[0] + '.graph'
+
+
+def file_hash(filename):
+    """
+    Return the SHA-256 hex digest of a file's contents
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def settings_hash():
+    """
+    Return a digest of the tables that decide which ways become edges and
+    how fast they are, so a change to either invalidates the cache
+    """
+    settings = {
+        'allowed_highway_types': sorted(lab.ALLOWED_HIGHWAY_TYPES),
+        'default_speed_limit_mph': sorted(lab.DEFAULT_SPEED_LIMIT_MPH.items()),
+    }
+    return hashlib.sha256(json.dumps(settings).encode()).hexdigest()
+
+
+def source_info(filename, with_hash=True):
+    """
+    Return the size, modification time and (optionally) content hash of an
+    input file as a dictionary
+    """
+    status = os.stat(filename)
+    info = {'size': status.st_size, 'mtime_ns': status.st_mtime_ns}
+    if with_hash:
+        info['sha256'] = file_hash(filename)
+    return info
+
+
+def write_cache(compact_map, cache_filename, sources):
+    """
+    Write the arrays of a CompactMap to a cache file
+
+    The file is written under a temporary name and renamed into place, so
+    readers never see a partly written cache.
+
+    Parameters:
+        compact_map: the compact.CompactMap to store
+        cache_filename: path of the cache file
+        sources: list of source_info dictionaries for the input files
+    """
+    # Works out where every array goes
+    layout = []
+    offset = 0
+    for name, typecode in ARRAY_FIELDS:
+        values = getattr(compact_map, name)
+        nbytes = len(values) * array(typecode).itemsize
+        layout.append({'name': name, 'typecode': typecode, 'offset': offset, 'count': len(values)})
+        offset += -(-nbytes // ALIGNMENT) * ALIGNMENT
+
+    header = json.dumps({
+        'version': FORMAT_VERSION,
+        'byteorder': sys.byteorder,
+        'settings': settings_hash(),
+        'sources': sources,
+        'arrays': layout,
+    }).encode()
+
+    # Pads the header so the array data is aligned
+    prefix = len(MAGIC) + 8
+    dataStart = -(-(prefix + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    temporary = cache_filename + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write(b'\0' * (dataStart - prefix - len(header)))
+        for entry in layout:
+            values = getattr(compact_map, entry['name'])
+            if not isinstance(values, array) or values.typecode != entry['typecode']:
+                values = array(entry['typecode'], values)
+            data = values.tobytes()
+            f.write(data)
+            f.write(b'\0' * (-len(data) % ALIGNMENT))
+    os.replace(temporary, cache_filename)
+
+
+def _read_header(f):
+    """
+    Return (header dictionary, start of the array data) for an open cache
+    file, or None if it is not a cache file
+    """
+    prefix = f.read(len(MAGIC) + 8)
+    if len(prefix) < len(MAGIC) + 8 or prefix[:len(MAGIC)] != MAGIC:
+        return None
+    headerLength = struct.unpack('<Q', prefix[len(MAGIC):])[0]
+    try:
+        header = json.loads(f.read(headerLength))
+    except ValueError:
+        return None
+    dataStart = -(-(len(prefix) + headerLength) // ALIGNMENT) * ALIGNMENT
+    return header, dataStart
+
+
+def cache_is_valid(header, filenames):
+    """
+    Check whether a cache header still matches the current input files and
+    settings
+
+    Files whose size and modification time match are trusted as is.  A file
+    whose size matches but whose modification time changed is hashed and
+    compared with the stored hash.
+    """
+    if (header.get('version') != FORMAT_VERSION or header.get('byteorder') != sys.byteorder
+            or header.get('settings') != settings_hash()):
+        return False
+    sources = header.get('sources', [])
+    if len(sources) != len(filenames):
+        return False
+    for filename, stored in zip(filenames, sources):
+        current = source_info(filename, with_hash=False)
+        if current['size'] != stored['size']:
+            return False
+        if current['mtime_ns'] != stored['mtime_ns'] and file_hash(filename) != stored['sha256']:
+            return False
+    return True
+
+
+def read_cache(cache_filename, filenames):
+    """
+    Memory-map a cache file and return it as a CompactMap
+
+    Parameters:
+        cache_filename: path of the cache file
+        filenames: the input files the cache must have been built from
+
+    Returns:
+        a compact.CompactMap whose arrays are memoryviews over the mapped
+        file, or None if the file is missing, unreadable or out of date
+    """
+    try:
+        f = open(cache_filename, 'rb')
+    except OSError:
+        return None
+    with f:
+        found = _read_header(f)
+        if found is None:
+            return None
+        header, dataStart = found
+        if not cache_is_valid(header, filenames):
+            return None
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Views each array straight out of the mapped file
+    view = memoryview(mapped)
+    fields = {}
+    for entry in header['arrays']:
+        start = dataStart + entry['offset']
+        end = start + entry['count'] * array(entry['typecode']).itemsize
+        fields[entry['name']] = view[start:end].cast(entry['typecode'])
+    return compact.CompactMap(**fields)
+
+
+def load_map(nodes_filename, ways_filename, cache_filename=None, max_bytes=None, progress=None):
+    """
+    Return a CompactMap for the given OSM files, from the cache file when it
+    is still valid and otherwise by building it and writing the cache
+
+    Parameters:
+        nodes_filename: path to the .nodes file
+        ways_filename: path to the .ways file
+        cache_filename: path of the cache file; defaults to the ways file
+                        with a .graph extension
+        max_bytes, progress: passed on to
+                             ingest.stream_compact_representation when the
+                             cache has to be built
+
+    Returns:
+        a compact.CompactMap of the map
+    """
+    if cache_filename is None:
+        cache_filename = default_cache_filename(nodes_filename, ways_filename)
+    filenames = [nodes_filename, ways_filename]
+
+    compact_map = read_cache(cache_filename, filenames)
+    if compact_map is not None:
+        return compact_map
+
+    # Takes the file information before reading, so a file that changes
+    # while the map is built makes the new cache stale rather than wrong
+    sources = [source_info(filename) for filename in filenames]
+    compact_map = ingest.stream_compact_representation(nodes_filename, ways_filename, max_bytes, progress)
+    write_cache(compact_map, cache_filename, sources)
+    return compact_map
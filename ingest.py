@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Streaming ingestion of OSM files into a compact.CompactMap
+
+build_internal_representation keeps the full dictionary of every matching
+node, tags included, plus a set and nested dictionaries for the ways, so
+its peak memory grows with all the OSM metadata it never uses.  This module
+reads the same files in two streaming passes and only keeps flat typed
+arrays:
+
+    ways pass:   way_edges turns every allowed highway into edge records
+                 (start ID, end ID, speed), kept in three arrays
+    nodes pass:  only id/lat/lon of the nodes used by those edges are kept
+
+The edge records are then sorted into the CSR arrays of a CompactMap in
+place of the neighbors dictionary.  The result is the same graph, with the
+same node order and edge order, as compact.compact_representation of
+build_internal_representation.
+
+Every stage (the two passes, sorting the node IDs, filling the edges and
+building the spatial index) can report progress, and stops with a
+MemoryError once what it holds grows past a given number of bytes instead
+of running the machine out of memory half way through a large extract.
+
+    python ingest.py resources/midwest.nodes resources/midwest.ways
+"""
+
+import sys
+import time
+import heapq
+from array import array
+from bisect import bisect_left
+
+import lab
+import compact
+from util import read_osm_data, great_circle_distance
+
+
+# Records read between two progress reports and memory checks
+PROGRESS_INTERVAL = 100000
+
+# Bytes a lab.NodeGrid holds for every point (its position and coordinates,
+# and their slots in the cell lists) and for every cell (its key, dictionary
+# entry, tuple and three lists)
+GRID_POINT_BYTES = sys.getsizeof(1 << 40) + 2 * sys.getsizeof(0.0) + 4 * 8
+GRID_CELL_BYTES = 2 * sys.getsizeof(1 << 40) + sys.getsizeof((0, 0)) + sys.getsizeof((0, 0, 0)) \
+    + 3 * sys.getsizeof([]) + 64
+
+
+def print_progress(stage, records, seconds, file=sys.stderr):
+    """
+    Default progress report: records read so far and records per second
+    """
+    rate = records / seconds if seconds else 0.0
+    print('%-6s %12d records %10.1f s %12.0f records/sec' % (stage, records, seconds, rate), file=file)
+
+
+class _Meter:
+    """
+    Counts the records of one stage, reporting progress and enforcing the
+    memory ceiling every PROGRESS_INTERVAL records
+
+    The bytes held are those allocated for the arrays the meter holds, plus
+    whatever extra returns (the size of a spatial index being built).
+    Arrays a stage frees must be released from the meter too, which
+    otherwise keeps them alive.
+    """
+
+    def __init__(self, stage, progress, max_bytes, arrays, extra=None):
+        self.stage = stage
+        self.progress = progress
+        self.max_bytes = max_bytes
+        self.arrays = list(arrays)
+        self.extra = extra
+        self.records = 0
+        self.start = time.perf_counter()
+
+    def hold(self, *arrays):
+        self.arrays.extend(arrays)
+
+    def release(self, *arrays):
+        self.arrays = [values for values in self.arrays if not any(values is other for other in arrays)]
+
+    def held_bytes(self):
+        held = sum(sys.getsizeof(values) for values in self.arrays)
+        return held if self.extra is None else held + self.extra()
+
+    def tick(self):
+        self.records += 1
+        if self.records % PROGRESS_INTERVAL == 0:
+            self.check()
+            if self.progress is not None:
+                self.progress(self.stage, self.records, time.perf_counter() - self.start)
+
+    def check(self, more=0):
+        """
+        Raise a MemoryError if the bytes held, plus more bytes about to be
+        allocated, pass the ceiling
+        """
+        if self.max_bytes is not None and self.held_bytes() + more > self.max_bytes:
+            raise MemoryError('%s pass needs more than %d bytes after %d records'
+                              % (self.stage, self.max_bytes, self.records))
+
+    def finish(self):
+        self.check()
+        if self.progress is not None:
+            self.progress(self.stage, self.records, time.perf_counter() - self.start)
+
+
+def way_edges(ways_filename, counter=None):
+    """
+    Generate the edges of the allowed highways in a ways file
+
+    Edges come out in the order build_internal_representation inserts them
+    into its neighbors dictionary; a two-way street gives one edge in each
+    direction.  A way with a single node gives the edge (node, None, 0) so
+    the node is still part of the map.
+
+    Parameters:
+        ways_filename: path to the .ways file
+        counter: optional function called once for every way read
+
+    Yields:
+        (start ID, end ID, speed limit in miles per hour) tuples
+    """
+    for way in read_osm_data(ways_filename):
+        if counter is not None:
+            counter()
+        tags = way['tags']
+        highway = tags.get('highway')
+        if highway not in lab.ALLOWED_HIGHWAY_TYPES:
+            continue
+        nodes = way['nodes']
+        speed = tags['maxspeed_mph'] if 'maxspeed_mph' in tags else lab.DEFAULT_SPEED_LIMIT_MPH[highway]
+        oneway = tags.get('oneway') == 'yes'
+        if len(nodes) == 1:
+            yield nodes[0], None, 0
+        for i in range(len(nodes) - 1):
+            yield nodes[i], nodes[i + 1], speed
+            if not oneway:
+                yield nodes[i + 1], nodes[i], speed
+
+
+def stream_compact_representation(nodes_filename, ways_filename, max_bytes=None, progress=None):
+    """
+    Build a CompactMap from OSM files in two streaming passes
+
+    Parameters:
+        nodes_filename: path to the .nodes file
+        ways_filename: path to the .ways file
+        max_bytes: optional ceiling on the bytes held by the arrays and the
+                   spatial index; a MemoryError is raised as soon as it is
+                   passed
+        progress: optional function called as progress(stage, records,
+                  seconds) every PROGRESS_INTERVAL records and at the end of
+                  each stage, such as print_progress
+
+    Returns:
+        a CompactMap holding the same graph as compact_representation of
+        build_internal_representation
+    """
+    # Ways pass: keeps the edge records in flat arrays
+    starts = array('q')
+    ends = array('q')
+    speeds = array('d')
+    isolated = array('q')
+    meter = _Meter('ways', progress, max_bytes, (starts, ends, speeds, isolated))
+    for start, end, speed in way_edges(ways_filename, meter.tick):
+        if end is None:
+            isolated.append(start)
+        else:
+            starts.append(start)
+            ends.append(end)
+            speeds.append(speed)
+            # A way can give many edges, so the ceiling is also checked
+            # every PROGRESS_INTERVAL edges
+            if len(starts) % PROGRESS_INTERVAL == 0:
+                meter.check()
+    meter.finish()
+
+    # Sorted, duplicate-free IDs of every node used by a way
+    meter = _Meter('ids', progress, max_bytes, (starts, ends, speeds, isolated))
+    used = _sorted_ids((starts, ends, isolated), meter)
+    meter.finish()
+    del isolated
+
+    # Nodes pass: keeps id/lat/lon of the used nodes, in file order, and the
+    # node number of every used ID that was found
+    ids = array('q')
+    lats = array('d')
+    lons = array('d')
+    meter = _Meter('nodes', progress, max_bytes, (starts, ends, speeds, used, ids, lats, lons))
+    meter.check(4 * len(used))
+    numbers = array('i', [-1]) * len(used)
+    meter.hold(numbers)
+    for node in read_osm_data(nodes_filename):
+        meter.tick()
+        position = bisect_left(used, node['id'])
+        if position < len(used) and used[position] == node['id']:
+            numbers[position] = len(ids)
+            ids.append(node['id'])
+            lats.append(node['lat'])
+            lons.append(node['lon'])
+
+    # The IDs in increasing order come from the used IDs, so CompactMap does
+    # not have to sort them
+    meter.check(12 * len(ids))
+    sortedIds = array('q', [0]) * len(ids)
+    sortedPositions = array('i', [0]) * len(ids)
+    meter.hold(sortedIds, sortedPositions)
+    slot = 0
+    for position, number in enumerate(numbers):
+        if number >= 0:
+            sortedIds[slot] = used[position]
+            sortedPositions[slot] = number
+            slot += 1
+    meter.finish()
+    del used, numbers
+
+    compact_map = compact.CompactMap(ids, lats, lons, array('q', [0]), array('i'), array('d'), array('d'),
+                                     array('d'), sortedIds, sortedPositions)
+    meter = _Meter('edges', progress, max_bytes, (
+        starts, ends, speeds, ids, lats, lons, sortedIds, sortedPositions, compact_map.offsets,
+        compact_map.targets, compact_map.speeds, compact_map.lengths, compact_map.times))
+    _fill_edges(compact_map, starts, ends, speeds, meter)
+    meter.release(starts, ends, speeds)
+    meter.finish()
+    del starts, ends, speeds
+
+    # The spatial index holds Python objects rather than arrays, so its size
+    # is worked out from its number of points and cells as it grows
+    grid = None
+
+    def gridBytes():
+        return 0 if grid is None else meter.records * GRID_POINT_BYTES + len(grid.cells) * GRID_CELL_BYTES
+
+    def counter(nodeGrid):
+        nonlocal grid
+        grid = nodeGrid
+        meter.tick()
+
+    meter = _Meter('index', progress, max_bytes, meter.arrays, gridBytes)
+    compact_map.spatial_index = lab.NodeGrid(compact_map.lats, compact_map.lons, counter=counter)
+    meter.finish()
+    return compact_map
+
+
+def _sorted_ids(arrays, meter):
+    """
+    Return an array of the sorted, duplicate-free values of some arrays
+
+    Blocks of PROGRESS_INTERVAL values are sorted one at a time into arrays,
+    which are then merged, so no Python set or list of every value is built.
+    Every array made is held by the meter while it is alive.
+    """
+    blocks = []
+    for values in arrays:
+        for first in range(0, len(values), PROGRESS_INTERVAL):
+            meter.check(8 * min(PROGRESS_INTERVAL, len(values) - first))
+            block = array('q', sorted(set(values[first:first + PROGRESS_INTERVAL])))
+            meter.hold(block)
+            blocks.append(block)
+    used = array('q')
+    meter.hold(used)
+    last = None
+    for value in heapq.merge(*blocks):
+        meter.tick()
+        if value != last:
+            used.append(value)
+            last = value
+    meter.release(*blocks)
+    return used
+
+
+def _fill_edges(compact_map, starts, ends, speeds, meter):
+    """
+    Sort edge records into the CSR arrays of a CompactMap whose nodes are
+    already set, keeping the fastest of repeated edges and dropping edges
+    whose nodes are missing
+
+    The meter holds the arrays made here while they are alive, and ticks
+    once for every record sorted and every record stored.
+    """
+    number = compact_map.internal_id
+    n = len(compact_map.ids)
+
+    def lookup(node):
+        try:
+            return number(node)
+        except KeyError:
+            return -1
+
+    # Counting sort of the records by start node, stable so every node's
+    # edges keep the order they were read in
+    meter.check(4 * len(starts) + 16 * (n + 1))
+    sources = array('i', map(lookup, starts))
+    counts = array('q', [0]) * (n + 1)
+    meter.hold(sources, counts)
+    for source in sources:
+        meter.tick()
+        if source >= 0:
+            counts[source + 1] += 1
+    for node in range(n):
+        counts[node + 1] += counts[node]
+    meter.check(8 * counts[n])
+    order = array('q', [0]) * counts[n]
+    nextSlot = array('q', counts[:n])
+    meter.hold(order, nextSlot)
+    for record, source in enumerate(sources):
+        if source >= 0:
+            order[nextSlot[source]] = record
+            nextSlot[source] += 1
+    meter.release(sources, nextSlot)
+    del sources, nextSlot
+
+    offsets, targets = compact_map.offsets, compact_map.targets
+    edgeSpeeds, lengths, times = compact_map.speeds, compact_map.lengths, compact_map.times
+    for node in range(n):
+        here = (compact_map.lats[node], compact_map.lons[node])
+        slots = {}
+        for slot in range(counts[node], counts[node + 1]):
+            meter.tick()
+            record = order[slot]
+            target = lookup(ends[record])
+            if target < 0:
+                continue
+            if target in slots:
+                # Repeated edge: keeps the higher speed limit
+                edge = slots[target]
+                if speeds[record] > edgeSpeeds[edge]:
+                    edgeSpeeds[edge] = speeds[record]
+                    times[edge] = lengths[edge] / speeds[record]
+                continue
+            slots[target] = len(targets)
+            length = great_circle_distance(here, (compact_map.lats[target], compact_map.lons[target]))
+            targets.append(target)
+            edgeSpeeds.append(speeds[record])
+            lengths.append(length)
+            times.append(length / speeds[record])
+        offsets.append(len(targets))
+    meter.release(counts, order)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        print('usage: python ingest.py NODES_FILE WAYS_FILE [MAX_MEGABYTES]')
+        sys.exit(1)
+    limit = int(sys.argv[3]) << 20 if len(sys.argv) == 4 else None
+    start = time.perf_counter()
+    graph = stream_compact_representation(sys.argv[1], sys.argv[2], limit, print_progress)
+    print('%d nodes, %d edges, %d bytes in %.1f s' % (len(graph), len(graph.targets), graph.nbytes(),
+                                                      time.perf_counter() - start))
@@ -0,0 +1,138 @@
+"""
+Query statistics and their aggregation
+
+Every path function in lab.py takes an optional stats argument.  A plain
+dictionary collects the search counters; a QueryStats also collects the
+time spent snapping locations and searching.  Passing None (the default)
+collects nothing and costs nothing.
+
+A Recorder hands out one QueryStats per query and reports percentiles over
+all of them.  A disabled Recorder hands out None, so instrumented code can
+stay in place at no cost:
+
+    recorder = instrument.Recorder(enabled=True)
+    for loc1, loc2 in queries:
+        lab.find_fast_path(map_rep, loc1, loc2, stats=recorder.new())
+    recorder.report()
+
+Keys filled in by the searches:
+    expanded: nodes expanded
+    pushes: entries pushed on the agenda
+    stale_pops: entries popped for nodes that were already expanded
+    peak_agenda: most entries on the agenda at once
+    peak_path_nodes: most node IDs held for path bookkeeping at once
+    path_length: nodes on the path found (0 if there is none)
+    tile_hits: tile lookups answered from memory (tiles.TiledMap only)
+    tile_misses: tiles read from the tile file (tiles.TiledMap only)
+    snapping_time: seconds spent snapping locations to nodes (QueryStats)
+    search_time: seconds spent searching (QueryStats)
+"""
+
+import sys
+import time
+
+
+DEFAULT_PERCENTILES = (50, 90, 99)
+
+REPORT_KEYS = ('snapping_time', 'search_time', 'expanded', 'pushes', 'stale_pops', 'peak_agenda',
+               'path_length', 'tile_hits', 'tile_misses')
+
+
+class QueryStats(dict):
+    """
+    Dictionary of the statistics of one query, with a clock so the search
+    functions also record how long each step took
+    """
+
+    clock = staticmethod(time.perf_counter)
+
+    def total_time(self):
+        """
+        Return the seconds spent snapping and searching
+        """
+        return self.get('snapping_time', 0.0) + self.get('search_time', 0.0)
+
+
+def percentile(values, percent):
+    """
+    Return the given percentile of a list of numbers, by linear
+    interpolation between the closest ranks, or None if it is empty
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * percent / 100.0
+    below = int(rank)
+    above = min(below + 1, len(ordered) - 1)
+    return ordered[below] + (ordered[above] - ordered[below]) * (rank - below)
+
+
+class Recorder:
+    """
+    Collects the QueryStats of many queries
+
+    Attributes:
+        enabled: whether new hands out QueryStats (True) or None (False)
+        queries: the QueryStats handed out so far
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.queries = []
+
+    def new(self):
+        """
+        Return a fresh QueryStats to pass to one query, already recorded,
+        or None when the recorder is disabled
+        """
+        if not self.enabled:
+            return None
+        stats = QueryStats()
+        self.queries.append(stats)
+        return stats
+
+    def record(self, stats):
+        """
+        Add the statistics of a query that were collected elsewhere
+        """
+        if self.enabled and stats is not None:
+            self.queries.append(stats)
+
+    def values(self, key):
+        """
+        Return the values recorded for a key, skipping queries without it
+        """
+        return [stats[key] for stats in self.queries if key in stats]
+
+    def percentiles(self, key, percents=DEFAULT_PERCENTILES):
+        """
+        Return a dictionary mapping each percent to that percentile of a key
+        """
+        values = self.values(key)
+        return {percent: percentile(values, percent) for percent in percents}
+
+    def summary(self, keys=REPORT_KEYS, percents=DEFAULT_PERCENTILES):
+        """
+        Return a dictionary mapping each key that was recorded to a
+        dictionary of its count, mean and percentiles
+        """
+        result = {}
+        for key in keys:
+            values = self.values(key)
+            if values:
+                entry = {'count': len(values), 'mean': sum(values) / len(values)}
+                entry.update((percent, percentile(values, percent)) for percent in percents)
+                result[key] = entry
+        return result
+
+    def report(self, file=sys.stdout, percents=DEFAULT_PERCENTILES):
+        """
+        Print the summary as a table, with times in milliseconds
+        """
+        print('%-14s %8s %12s' % ('statistic', 'count', 'mean')
+              + ''.join(' %11s' % ('p%d' % percent) for percent in percents), file=file)
+        for key, entry in self.summary(percents=percents).items():
+            scale = 1e3 if key.endswith('_time') else 1
+            name = key[:-5] + ' ms' if key.endswith('_time') else key
+            print('%-14s %8d %12.3f' % (name, entry['count'], entry['mean'] * scale)
+                  + ''.join(' %11.3f' % (entry[percent] * scale) for percent in percents), file=file)
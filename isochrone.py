@@ -0,0 +1,232 @@
+"""
+Isochrones: everything reachable from a location within a travel budget
+
+Finding every node within ten minutes of a depot with find_fast_path takes
+one search per node.  isochrone runs a single Dijkstra search from the
+snapped location that never queues a node past the largest budget, and
+returns every node it settled with its cost.  Several budgets share the same
+search, and a reached node belongs to every budget at least its cost.
+
+isochrones does the same for many locations: it searches from every distinct
+snapped node once, reuses one set of search buffers (see matrix.OneToMany)
+per process, and spreads the searches over worker processes like
+bulk.route_many.
+
+Typical use:
+
+    map_rep = lab.build_internal_representation(nodes_filename, ways_filename)
+    area = isochrone.isochrone(map_rep, depot, max_time=[10 / 60, 20 / 60])
+    area.nodes(10 / 60)          # OSM IDs within ten minutes
+    area.kml_url(20 / 60)        # outline of the twenty-minute area
+"""
+
+import functools
+
+from util import to_local_kml_url
+
+import lab
+import bulk
+import matrix
+
+
+class Isochrone:
+    """
+    Nodes reached from one location within one or more budgets
+
+    Attributes:
+        origin: OSM ID of the node the location snapped to
+        metric: 'time' (hours) or 'distance' (miles)
+        thresholds: the budgets, in increasing order
+        costs: dictionary mapping the OSM ID of every node reached within the
+               largest budget to its cost from the origin
+        outlines: dictionary mapping every budget to the closed convex hull
+                  of its nodes as a list of (latitude, longitude) tuples, or
+                  None if outlines were not asked for
+    """
+
+    def __init__(self, origin, metric, thresholds, costs, outlines=None):
+        self.origin = origin
+        self.metric = metric
+        self.thresholds = thresholds
+        self.costs = costs
+        self.outlines = outlines
+
+    def __len__(self):
+        return len(self.costs)
+
+    def _threshold(self, threshold):
+        if threshold is None:
+            return self.thresholds[-1]
+        if threshold > self.thresholds[-1]:
+            raise ValueError('threshold %r is past the largest one searched' % (threshold,))
+        return threshold
+
+    def nodes(self, threshold=None):
+        """
+        Return the set of OSM IDs reached within a budget (by default the
+        largest one)
+        """
+        threshold = self._threshold(threshold)
+        return {node for node, cost in self.costs.items() if cost <= threshold}
+
+    def bands(self):
+        """
+        Return a dictionary mapping every budget to the set of OSM IDs
+        reached within it but not within the budget before it
+        """
+        result = {threshold: set() for threshold in self.thresholds}
+        for node, cost in self.costs.items():
+            for threshold in self.thresholds:
+                if cost <= threshold:
+                    result[threshold].add(node)
+                    break
+        return result
+
+    def polygon(self, threshold=None):
+        """
+        Return the outline of the area reached within a budget (by default the
+        largest one) as a closed list of (latitude, longitude) tuples
+        """
+        if self.outlines is None:
+            raise ValueError('isochrone was computed without outlines')
+        return self.outlines[self._threshold(threshold)]
+
+    def kml_url(self, threshold=None):
+        """
+        Return a URL showing the outline of a budget's area, as made by
+        util.to_local_kml_url
+        """
+        return to_local_kml_url(self.polygon(threshold))
+
+
+def convex_hull(points):
+    """
+    Return the convex hull of a list of (latitude, longitude) tuples as a
+    closed list (the first point repeated at the end), with Andrew's monotone
+    chain algorithm
+
+    Fewer than three distinct points are returned as they are.
+    """
+    points = sorted(set(points))
+    if len(points) < 3:
+        return points
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    lower = []
+    for point in points:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], point) <= 0:
+            lower.pop()
+        lower.append(point)
+    upper = []
+    for point in reversed(points):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], point) <= 0:
+            upper.pop()
+        upper.append(point)
+    return lower[:-1] + upper
+
+
+def _thresholds(max_time, max_distance):
+    """
+    Return the metric and the sorted budgets of a query
+    """
+    if (max_time is None) == (max_distance is None):
+        raise ValueError('give exactly one of max_time and max_distance')
+    metric, limits = ('time', max_time) if max_time is not None else ('distance', max_distance)
+    if isinstance(limits, (int, float)):
+        limits = [limits]
+    thresholds = tuple(sorted(set(limits)))
+    if not thresholds or thresholds[0] < 0:
+        raise ValueError('budgets must be non-negative: %r' % (limits,))
+    return metric, thresholds
+
+
+def _isochrone(graph, search, node, metric, thresholds, outlines):
+    """
+    Run one bounded search from a node handle and build its Isochrone
+    """
+    source = search.index(node)
+    found = {} if source is None else search.within(source, thresholds[-1])
+    handles = search.handles
+    costs = {graph.external_id(handles[number]): cost for number, cost in found.items()}
+    result = Isochrone(graph.external_id(node), metric, thresholds, costs)
+    if outlines:
+        result.outlines = {
+            threshold: convex_hull([graph.location(handles[number])
+                                    for number, cost in found.items() if cost <= threshold])
+            for threshold in thresholds
+        }
+    return result
+
+
+def _isochrone_chunk(metric, thresholds, outlines, graph, nodes):
+    """
+    Compute the isochrones of a chunk of node handles
+    """
+    search = matrix._search_for(graph, metric)
+    return [_isochrone(graph, search, node, metric, thresholds, outlines) for node in nodes]
+
+
+def _full_map(map_rep):
+    """
+    Return the map to search: a simplify.SimplifiedMap's full map, so that
+    the nodes along its chains are reached too
+    """
+    graph = lab._as_graph(map_rep)
+    return getattr(graph, 'base', graph)
+
+
+def isochrone(map_rep, loc, max_time=None, max_distance=None, outlines=False):
+    """
+    Find every node reachable from a location within one or more budgets
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation, a
+                 compact.CompactMap or a simplify.SimplifiedMap
+        loc: (latitude, longitude) of the origin, snapped to the nearest node
+        max_time: budget in hours, or a list of budgets
+        max_distance: budget in miles, or a list of budgets (give exactly
+                      one of max_time and max_distance)
+        outlines: also compute the convex hull of every budget's nodes, for
+                  Isochrone.polygon and Isochrone.kml_url
+
+    Returns:
+        an Isochrone
+    """
+    metric, thresholds = _thresholds(max_time, max_distance)
+    graph = _full_map(map_rep)
+    return _isochrone_chunk(metric, thresholds, outlines, graph, [graph.nearest(loc)[0]])[0]
+
+
+def isochrones(map_rep, locations, max_time=None, max_distance=None, outlines=False,
+               processes=None, chunk_size=bulk.DEFAULT_CHUNK_SIZE):
+    """
+    Find the isochrones of many locations
+
+    Parameters:
+        map_rep, max_time, max_distance, outlines: as for isochrone
+        locations: list of (latitude, longitude) tuples
+        processes: number of worker processes; defaults to the number of
+                   cores.  With 1 the searches run in this process.
+        chunk_size: number of locations handed to a worker at a time
+
+    Returns:
+        a list with the Isochrone of every location, in the order of
+        locations.  Locations that snap to the same node share one Isochrone.
+    """
+    metric, thresholds = _thresholds(max_time, max_distance)
+    graph = _full_map(map_rep)
+
+    # Snaps every distinct location once and searches from every distinct
+    # node once
+    snapped = {}
+    for loc in locations:
+        loc = tuple(loc)
+        if loc not in snapped:
+            snapped[loc] = graph.nearest(loc)[0]
+    nodes = list(dict.fromkeys(snapped.values()))
+
+    function = functools.partial(_isochrone_chunk, metric, thresholds, outlines)
+    results = dict(zip(nodes, bulk.map_chunks(graph, function, nodes, processes, chunk_size)))
+    return [results[snapped[tuple(loc)]] for loc in locations]
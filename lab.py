@@ -30,6 +30,254 @@ DEFAULT_SPEED_LIMIT_MPH = {
 }
 
 
+class MapRepresentation(tuple):
+    """
+    The (nodes, neighbors, waySet) tuple returned by
+    build_internal_representation
+
+    It unpacks exactly like a plain 3-tuple, and also carries the data
+    structures that are built once from the map so that every query can
+    reuse them:
+        spatial_index: NodeGrid over the nodes in waySet
+        nodeOrder: list of the node IDs in the order NodeGrid numbers them
+        edgeWeights: dictionary mapping 'distance' and 'time' to the
+                     precomputed (child, cost) lists of every node
+        reverseWeights: like edgeWeights, but with the (parent, cost) lists
+                        of the edges coming into every node, built the
+                        first time a bidirectional search needs them
+        hierarchies: dictionary mapping a metric to a contraction hierarchy
+                     (see ch.py) that answers queries for that metric
+        landmarks: dictionary mapping a metric to a landmark table (see
+                   landmarks.py) that gives A* heuristics for that metric
+        version: number bumped every time the edge weights change, so
+                 caches of query results (see route_cache.py) know to
+                 empty themselves
+
+    The search functions only talk to a map through internal_id,
+    external_id, node_handles, location, edges, reverse_edges and nearest,
+    so any object with those methods (such as compact.CompactMap) can be
+    passed in its place.
+    """
+
+    def __new__(cls, nodes, neighbors, waySet):
+        return tuple.__new__(cls, (nodes, neighbors, waySet))
+
+    def __init__(self, nodes, neighbors, waySet):
+        self.spatial_index = None
+        self.nodeOrder = None
+        self.edgeWeights = None
+        self.reverseWeights = None
+        self.hierarchies = {}
+        self.landmarks = {}
+        self.version = 0
+
+    def internal_id(self, node):
+        """
+        Return the handle the search uses for an OSM node ID
+        """
+        return node
+
+    def external_id(self, node):
+        """
+        Return the OSM node ID for a search handle
+        """
+        return node
+
+    def node_handles(self):
+        """
+        Return a list of the handles of every node in the map
+        """
+        return list(self[0])
+
+    def location(self, node):
+        """
+        Return the (latitude, longitude) of a node
+        """
+        node = self[0][node]
+        return (node['lat'], node['lon'])
+
+    def build_edge_weights(self):
+        """
+        Precompute the length and the travel time of every edge
+
+        Lengths are great circle distances in miles, and travel times are
+        lengths divided by the speed stored in neighbors, in hours.  Edges to
+        nodes that are missing from the nodes dictionary are left out.
+        """
+        nodes, neighbors, waySet = self
+        location = self.location
+
+        distances = {}
+        times = {}
+        for node, children in neighbors.items():
+            if node not in nodes:
+                continue
+            here = location(node)
+            distances[node] = []
+            times[node] = []
+            for child, speed in children.items():
+                if child in nodes:
+                    length = great_circle_distance(here, location(child))
+                    distances[node].append((child, length))
+                    times[node].append((child, length / speed))
+
+        self.edgeWeights = {'distance': distances, 'time': times}
+        self.reverseWeights = None
+        self.version += 1
+
+    def edge_speed(self, node, child):
+        """
+        Return the speed of the edge from node to child in miles per hour, or
+        None if there is no such edge
+        """
+        return self[1].get(node, {}).get(child)
+
+    def update_edges(self, changes):
+        """
+        Change the speed of edges or remove them, fixing up the precomputed
+        weights in place rather than rebuilding them
+
+        Parameters:
+            changes: dictionary mapping (node, child) edges to their new
+                     speed in miles per hour, or to None to remove them;
+                     every edge must exist
+
+        Returns:
+            a dictionary with the number of edges 'changed' and 'removed'
+        """
+        nodes, neighbors, waySet = self
+        removed = 0
+        for (node, child), speed in changes.items():
+            if speed is None:
+                del neighbors[node][child]
+                removed += 1
+            else:
+                neighbors[node][child] = speed
+            if self.edgeWeights is not None:
+                self._update_weights(self.edgeWeights, node, child, speed)
+            if self.reverseWeights is not None:
+                self._update_weights(self.reverseWeights, child, node, speed)
+        self.version += 1
+        return {'changed': len(changes) - removed, 'removed': removed}
+
+    @staticmethod
+    def _update_weights(weights, node, other, speed):
+        """
+        Change or remove the entry for other in the edge lists of node, in
+        both metrics of edgeWeights or reverseWeights
+        """
+        distances = weights['distance'].get(node, ())
+        for index, (neighbor, length) in enumerate(distances):
+            if neighbor == other:
+                break
+        else:
+            # Edges to nodes missing from the nodes dictionary have no entry
+            return
+        if speed is None:
+            del distances[index]
+            del weights['time'][node][index]
+        else:
+            weights['time'][node][index] = (other, length / speed)
+
+    def unindex(self, nodes):
+        """
+        Stop snapping locations to some nodes (such as nodes whose edges
+        were all closed) until the spatial index is rebuilt
+        """
+        if self.spatial_index is None:
+            self.build_spatial_index()
+        nodes = set(nodes)
+        for position, node in enumerate(self.nodeOrder):
+            if node in nodes:
+                self.spatial_index.remove(position)
+
+    def edges(self, metric):
+        """
+        Return a function that gives the outgoing edges of a node
+
+        Parameters:
+            metric: 'distance' for edge lengths in miles or 'time' for travel
+                    times in hours
+
+        Returns:
+            a function taking a node and returning a list of (child, cost)
+            tuples
+        """
+        if self.edgeWeights is None:
+            self.build_edge_weights()
+        weights = self.edgeWeights[metric]
+
+        def edges(node):
+            return weights.get(node, ())
+
+        return edges
+
+    def reverse_edges(self, metric):
+        """
+        Return a function that gives the incoming edges of a node
+
+        One-way streets only have an edge in neighbors in their direction of
+        travel, so they show up here only at the node they lead to.
+
+        Parameters:
+            metric: 'distance' or 'time', as for edges
+
+        Returns:
+            a function taking a node and returning a list of (parent, cost)
+            tuples
+        """
+        if self.reverseWeights is None:
+            if self.edgeWeights is None:
+                self.build_edge_weights()
+            self.reverseWeights = {}
+            for kind, weights in self.edgeWeights.items():
+                reverse = {}
+                for node, children in weights.items():
+                    for child, cost in children:
+                        reverse.setdefault(child, []).append((node, cost))
+                self.reverseWeights[kind] = reverse
+        weights = self.reverseWeights[metric]
+
+        def edges(node):
+            return weights.get(node, ())
+
+        return edges
+
+    def build_spatial_index(self, kernel=None):
+        """
+        Build the NodeGrid used by nearest over the nodes in waySet, with an
+        optional batched distance kernel (see NodeGrid)
+        """
+        nodes, neighbors, waySet = self
+        self.nodeOrder = [node for node in nodes if node in waySet]
+        self.spatial_index = NodeGrid([nodes[node]['lat'] for node in self.nodeOrder],
+                                      [nodes[node]['lon'] for node in self.nodeOrder], kernel)
+
+    def nearest(self, loc, k=1):
+        """
+        Return a list of the (up to) k nodes closest to loc, closest first
+        """
+        if self.spatial_index is None:
+            self.build_spatial_index()
+        return [self.nodeOrder[position] for position in self.spatial_index.nearest(loc, k)]
+
+
+def _as_graph(map_rep):
+    """
+    Return map_rep as an object with the methods of MapRepresentation,
+    wrapping plain (nodes, neighbors, waySet) tuples
+
+    A plain tuple is wrapped anew on every call, so its edge weights and
+    spatial index are rebuilt for every query and nothing attached to the
+    wrapper (hierarchies, landmarks, caches) outlives it.  Keep and pass
+    around the MapRepresentation that build_internal_representation (or a
+    prepare function) returns instead.
+    """
+    if hasattr(map_rep, 'edges'):
+        return map_rep
+    return MapRepresentation(*map_rep)
+
+
 def build_internal_representation(nodes_filename, ways_filename):
     """
     Create any internal representation you you want for the specified map, by
@@ -130,245 +378,752 @@ def build_internal_representation(nodes_filename, ways_filename):
         if (node['id'] in waySet):
             nodeSet[node['id']] = node
 
-    # Returns the nodeSet, neighbors and the waySet
-    return nodeSet, neighbors, waySet
+    # Returns the nodeSet, neighbors and the waySet, along with the edge
+    # weights and a spatial index for snapping locations to nodes
+    map_rep = MapRepresentation(nodeSet, neighbors, waySet)
+    map_rep.build_edge_weights()
+    map_rep.build_spatial_index()
+    return map_rep
 
 
-def find_short_path_nodes(map_rep, node1, node2):
+# Miles per degree of latitude, slightly rounded down so that it is always a
+# lower bound on the great circle distance
+MILES_PER_DEGREE_LAT = 69.0
+
+
+class NodeGrid:
     """
-    Return the shortest path between the two nodes
+    Spatial index that buckets points into square lat/lon cells
+
+    Points are given as parallel latitude and longitude sequences and are
+    referred to by their position in them.  Nearest-point queries look at the
+    cells in rings of growing size around the query location and stop once
+    no unvisited cell can hold anything closer than the candidates already
+    found.  Candidates are compared by great circle distance, and ties go to
+    the earlier position, so the results match a full scan in order.
+
+    Every cell keeps the positions, latitudes and longitudes of its points
+    in parallel lists, so the distances to a whole ring of cells can be
+    computed by a batched kernel (see geo.distances_from).
+    """
+
+    def __init__(self, lats, lons, kernel=None, counter=None):
+        """
+        Parameters:
+            lats: sequence of point latitudes
+            lons: sequence of point longitudes, in the same order
+            kernel: optional function taking a location and latitude and
+                    longitude sequences and returning the distances from
+                    the location to every point; defaults to calling
+                    great_circle_distance on every point
+            counter: optional function called with the grid every time a
+                     point is put in it, so a caller can follow its size
+        """
+        self.lats = lats
+        self.lons = lons
+        self.kernel = kernel or _great_circle_distances
+
+        self.cells = {}
+        if not len(lats):
+            return
+
+        # Gets the bounding box of the points
+        self.minLat, self.maxLat = min(lats), max(lats)
+        self.minLon, self.maxLon = min(lons), max(lons)
+        self.maxAbsLat = max(abs(self.minLat), abs(self.maxLat))
+
+        # Picks a cell size that puts a few points in each cell on average
+        area = max(self.maxLat - self.minLat, 1e-4) * max(self.maxLon - self.minLon, 1e-4)
+        self.cellSize = 2 * (area / len(lats)) ** 0.5
+
+        # Puts every point in its cell, as (positions, lats, lons) lists
+        for position in range(len(lats)):
+            cell = self._cell((lats[position], lons[position]))
+            if cell not in self.cells:
+                self.cells[cell] = ([], [], [])
+            positions, cellLats, cellLons = self.cells[cell]
+            positions.append(position)
+            cellLats.append(lats[position])
+            cellLons.append(lons[position])
+            if counter is not None:
+                counter(self)
+
+        # Gets the range of cells that hold points
+        self.minCell = self._cell((self.minLat, self.minLon))
+        self.maxCell = self._cell((self.maxLat, self.maxLon))
+
+    def remove(self, position):
+        """
+        Take the point at a position out of the grid, so nearest no longer
+        returns it
+        """
+        cell = self._cell((self.lats[position], self.lons[position]))
+        positions, cellLats, cellLons = self.cells.get(cell, ([], [], []))
+        if position in positions:
+            index = positions.index(position)
+            del positions[index], cellLats[index], cellLons[index]
+            if not positions:
+                del self.cells[cell]
+
+    def _cell(self, location):
+        """
+        Return the (row, column) of the cell that holds the location
+        """
+        return (int(location[0] // self.cellSize), int(location[1] // self.cellSize))
+
+    def _ring(self, row, col, radius):
+        """
+        Yield the cells whose row or column is exactly radius away from
+        (row, col), skipping the ones outside the grid
+        """
+        rowLow = max(row - radius, self.minCell[0])
+        rowHigh = min(row + radius, self.maxCell[0])
+        colLow = max(col - radius, self.minCell[1])
+        colHigh = min(col + radius, self.maxCell[1])
+        for i in range(rowLow, rowHigh + 1):
+            if i == row - radius or i == row + radius:
+                # Top and bottom rows of the ring
+                for j in range(colLow, colHigh + 1):
+                    yield (i, j)
+            else:
+                # Left and right columns of the ring
+                if col - radius >= colLow:
+                    yield (i, col - radius)
+                if col + radius <= colHigh:
+                    yield (i, col + radius)
+
+    def nearest(self, loc, k=1):
+        """
+        Return the k points closest to a location
+
+        Parameters:
+            loc: tuple of 2 floats: (latitude, longitude)
+            k: number of points to return
+
+        Returns:
+            a list of up to k positions, closest first
+        """
+        if not self.cells or k <= 0:
+            return []
+        row, col = self._cell(loc)
+
+        # Miles per degree of longitude anywhere between loc and the nodes,
+        # rounded down so it stays a lower bound
+        furthestLat = min(max(abs(loc[0]), self.maxAbsLat), 89.0)
+        milesPerDegreeLon = 0.99 * great_circle_distance((furthestLat, 0), (furthestLat, 1))
+
+        # Rings closer than the grid hold no cells, and rings past the
+        # furthest corner of the grid hold nothing new
+        firstRadius = max(self.minCell[0] - row, row - self.maxCell[0],
+                          self.minCell[1] - col, col - self.maxCell[1], 0)
+        lastRadius = max(abs(row - self.minCell[0]), abs(row - self.maxCell[0]),
+                         abs(col - self.minCell[1]), abs(col - self.maxCell[1]))
+
+        # Candidates are kept sorted as (distance, position)
+        best = []
+        for radius in range(firstRadius, lastRadius + 1):
+            # Gathers the points of the whole ring for one kernel call
+            positions, ringLats, ringLons = [], [], []
+            for cell in self._ring(row, col, radius):
+                if cell in self.cells:
+                    cellPositions, cellLats, cellLons = self.cells[cell]
+                    positions += cellPositions
+                    ringLats += cellLats
+                    ringLons += cellLons
+
+            if positions:
+                for distance, position in zip(self.kernel(loc, ringLats, ringLons), positions):
+                    candidate = (float(distance), position)
+                    if len(best) < k or candidate < best[-1]:
+                        best.append(candidate)
+                        best.sort()
+                        del best[k:]
+
+            # Gets the smallest distance from loc to a cell outside this ring
+            if len(best) == k:
+                latGap = min(loc[0] - (row - radius) * self.cellSize,
+                             (row + radius + 1) * self.cellSize - loc[0])
+                lonGap = min(loc[1] - (col - radius) * self.cellSize,
+                             (col + radius + 1) * self.cellSize - loc[1])
+                bound = min(latGap * MILES_PER_DEGREE_LAT, lonGap * milesPerDegreeLon)
+                if best[-1][0] <= bound:
+                    break
+
+        return [position for distance, position in best]
+
+
+def _great_circle_distances(loc, lats, lons):
+    """
+    Return the great circle distances from loc to every point of parallel
+    latitude and longitude sequences, one great_circle_distance call each
+    """
+    return [great_circle_distance(loc, point) for point in zip(lats, lons)]
+
+
+def nearest_node(map_rep, loc):
+    """
+    Return the node closest to a location
 
     Parameters:
         map_rep: the result of calling build_internal_representation
-        node1: node representing the start location
-        node2: node representing the end location
+        loc: tuple of 2 floats: (latitude, longitude)
 
     Returns:
-        a list of node IDs representing the shortest path (in terms of
-        distance) from node1 to node2
+        the ID of the node closest to loc (in terms of great circle
+        distance), or None if the map has no nodes
+    """
+    graph = _as_graph(map_rep)
+    found = graph.nearest(loc, 1)
+    return graph.external_id(found[0]) if found else None
 
-        Use a uniform cost search
+
+def nearest_nodes(map_rep, loc, k):
     """
-    # Defines the map representation
-    nodes, neighbors, third = map_rep
+    Return the k nodes closest to a location
 
-    # Sets agenda to a node, a list of nodes, and a cost
-    agenda = [(node1,[node1],0)]
+    Parameters:
+        map_rep: the result of calling build_internal_representation
+        loc: tuple of 2 floats: (latitude, longitude)
+        k: number of nodes to return
 
-    # Makes an expanded set
-    expanded = set()
+    Returns:
+        a list of up to k node IDs, closest first
+    """
+    graph = _as_graph(map_rep)
+    return [graph.external_id(node) for node in graph.nearest(loc, k)]
 
-    # Defines a location 1
-    location1 = (nodes[node1]['lat'],nodes[node1]['lon'])
 
-    # Defines a minIndex
-    minIndex = 0
+def _heap_push(heap, item):
+    """
+    Push an item onto a binary min-heap stored in a list
 
-    # While agenda is not empty
-    while(agenda):
-        # Defines a default minCost and minIndex
-        minCost = agenda[0][2]
-        minIndex = 0
-
-        # Goes through the agenda to find the minCost
-        for i in range(len(agenda)):
-             if(agenda[i][2] < minCost):
-                 minCost = agenda[i][2]
-                 # Keeps track of the minimum index
-                 minIndex = i
-
-        # Pops the node with the minimum cost
-        currentNode, currentList, cost = agenda.pop(minIndex)
-
-        # Gets the first location
-        location1 = (nodes[currentNode]['lat'], nodes[currentNode]['lon'])
-
-        # If the currentNode is already in expanded
-        if(currentNode in expanded):
-            pass
-        # If currentNode is the final node
-        elif(currentNode==node2):
-            print("Length of regular", len(expanded))
-            return currentList
-        # Otherwise add the node to expanded
+    Parameters:
+        heap: list holding the heap
+        item: tuple whose first element is the priority
+    """
+    # Adds the item at the bottom of the heap
+    heap.append(item)
+    index = len(heap) - 1
+
+    # Moves the item up while it is smaller than its parent
+    while index > 0:
+        parent = (index - 1) // 2
+        if heap[index] < heap[parent]:
+            heap[index], heap[parent] = heap[parent], heap[index]
+            index = parent
         else:
-            expanded.add(currentNode)
-            # Checks to see if currentNode has neighbors
-            if(currentNode in neighbors):
-                # Goes through the neighbors of current Node
-                for children in neighbors[currentNode]:
-                    # If the child is already in expanded
-                    if(children in expanded):
-                        continue
-                    else:
-                        # Gets a copy of the list
-                        copyList = currentList.copy()
-                        # Gets the location of the child
-                        location2 = (nodes[children]['lat'],nodes[children]['lon'])
-                        # Gets the distance between the current node and the child
-                        getDistance = great_circle_distance(location1,location2)
+            break
 
-                        # Adds the child to the list
-                        copyList.append(children)
-                        # Adds the child, the new list, and the new cost to agenda
-                        agenda.append((children,copyList,getDistance+cost))
 
-    # Returns None if agenda is empty
-    return None
+def _heap_pop(heap):
+    """
+    Pop the smallest item off a binary min-heap stored in a list
+
+    Parameters:
+        heap: non-empty list holding the heap
 
-def find_short_path_nodes_heuristics(map_rep, node1, node2):
+    Returns:
+        the item with the smallest priority
     """
-    Return the shortest path between the two nodes
+    # Takes the last item so the list can shrink from the end
+    last = heap.pop()
+    if not heap:
+        return last
+
+    # Puts the last item at the root and remembers the old root
+    smallest = heap[0]
+    heap[0] = last
+    index = 0
+    size = len(heap)
+
+    # Moves the new root down while one of its children is smaller
+    while True:
+        child = 2 * index + 1
+        if child >= size:
+            break
+        if child + 1 < size and heap[child + 1] < heap[child]:
+            child += 1
+        if heap[child] < heap[index]:
+            heap[index], heap[child] = heap[child], heap[index]
+            index = child
+        else:
+            break
+
+    return smallest
+
+
+def _rebuild_path(parent, node):
+    """
+    Follow the predecessor map back from node and return the path to it
+    """
+    path = [node]
+    while parent[node] is not None:
+        node = parent[node]
+        path.append(node)
+    path.reverse()
+    return path
+
+
+def _search(edges, node1, node2, heuristic=None, stats=None, copy_paths=False):
+    """
+    Best-first search shared by all of the path functions
+
+    The agenda is a binary heap with lazy deletion: a node can be pushed more
+    than once, and every entry after the first one popped is skipped.  Ties
+    are broken by insertion order, the same way the old linear scan did.
+
+    By default the agenda only holds nodes and costs.  A predecessor map and
+    a cost map record the best way found to reach each node, and the path is
+    rebuilt from the predecessor map once node2 is popped.  With copy_paths
+    set, every agenda entry carries its own copy of the path instead (the
+    old behavior, kept so the two can be compared).
 
     Parameters:
-        map_rep: the result of calling build_internal_representation
+        edges: function taking a node and returning its outgoing edges as
+               (child, cost) tuples, such as MapRepresentation.edges(metric)
         node1: node representing the start location
         node2: node representing the end location
+        heuristic: optional function taking a node and returning a lower
+                   bound on the cost from that node to node2, or infinity
+                   if node2 cannot be reached from it.  None gives a uniform
+                   cost search.
+        stats: optional dictionary that is filled with 'expanded', 'pushes',
+               'stale_pops' (entries skipped because their node was already
+               expanded), 'peak_agenda' (most entries on the agenda at once)
+               and 'peak_path_nodes' (most node IDs held for path
+               bookkeeping at once)
+        copy_paths: store a full path copy in every agenda entry
 
     Returns:
-        a list of node IDs representing the shortest path (in terms of
-        distance) from node1 to node2
-
-        Use a uniform cost search
+        a tuple (path, expanded) where path is a list of node IDs from node1
+        to node2 (None if there is no path) and expanded is the number of
+        nodes that were expanded
     """
-    # Defines the map representation
-    nodes, neighbors, third = map_rep
+    # Agenda entries are (priority, insertion count, node, cost, path); the
+    # path is only kept when copy_paths is set
+    agenda = [(0, 0, node1, 0, [node1] if copy_paths else None)]
+    pushes = 1
+    stalePops = 0
+    peakAgenda = 1
+
+    # Predecessor and best known cost for every node reached so far
+    parent = {node1: None}
+    bestCost = {node1: 0}
 
-    # Sets agenda to a node, a list of nodes, and a cost
-    agenda = [(node1,[node1],0,0)]
+    # Number of node IDs held in agenda paths (copy_paths only)
+    pathNodes = 1
+    peakPathNodes = 1
 
     # Makes an expanded set
     expanded = set()
+    result = None
 
-    # Defines a location 1
-    location1 = (nodes[node1]['lat'],nodes[node1]['lon'])
-
-    # Defines a minIndex
-    minIndex = 0
+    # While agenda is not empty
+    while agenda:
+        # Pops the entry with the smallest priority
+        priority, order, currentNode, cost, currentList = _heap_pop(agenda)
+        if copy_paths:
+            pathNodes -= len(currentList)
 
-    final_location = (nodes[node2]['lat'], nodes[node2]['lon'])
+        # Skips entries for nodes that were already expanded
+        if currentNode in expanded:
+            stalePops += 1
+            continue
 
-    # While agenda is not empty
-    while(agenda):
-        # Defines a default minCost and minIndex
-        minCost = agenda[0][2]
-        minHeuristic=agenda[0][3]
-        minIndex = 0
-
-        # Goes through the agenda to find the minCost
-        for i in range(len(agenda)):
-             if(agenda[i][3] < minHeuristic):
-                 minHeuristic = agenda[i][3]
-                 # Keeps track of the minimum index
-                 minIndex = i
-
-        # Pops the node with the minimum cost
-        currentNode, currentList, cost, heuristic = agenda.pop(minIndex)
-
-        # Gets the first location
-        location1 = (nodes[currentNode]['lat'], nodes[currentNode]['lon'])
-
-        # If the currentNode is already in expanded
-        if(currentNode in expanded):
-            pass
         # If currentNode is the final node
-        elif(currentNode==node2):
-            print("Length of heuristic", len(expanded))
-            return currentList
-        # Otherwise add the node to expanded
-        else:
-            expanded.add(currentNode)
-            # Checks to see if currentNode has neighbors
-            if(currentNode in neighbors):
-                # Goes through the neighbors of current Node
-                for children in neighbors[currentNode]:
-                    # If the child is already in expanded
-                    if(children in expanded):
-                        continue
-                    else:
-                        # Gets a copy of the list
-                        copyList = currentList.copy()
-                        # Gets the location of the child
-                        location2 = (nodes[children]['lat'],nodes[children]['lon'])
-                        # Gets the distance between the current node and the child
-                        getDistance = great_circle_distance(location1,location2)
+        if currentNode == node2:
+            result = currentList if copy_paths else _rebuild_path(parent, currentNode)
+            break
 
-                        heuristic_distance = great_circle_distance(location2, final_location)
+        expanded.add(currentNode)
+
+        # Goes through the children of currentNode
+        for children, edgeCost in edges(currentNode):
+            if children in expanded:
+                continue
+
+            # Gets the cost of reaching the child through currentNode
+            childCost = cost + edgeCost
+
+            # Only pushes the child if this is a cheaper way to reach it
+            if not copy_paths and children in bestCost and bestCost[children] <= childCost:
+                continue
+
+            childPriority = childCost
+            if heuristic is not None:
+                childPriority += heuristic(children)
+                # Drops children that cannot lead to node2
+                if childPriority == float('inf'):
+                    continue
+
+            if copy_paths:
+                # Every entry gets its own copy of the path
+                copyList = currentList.copy()
+                copyList.append(children)
+                pathNodes += len(copyList)
+            else:
+                bestCost[children] = childCost
+                parent[children] = currentNode
+                copyList = None
+
+            # Adds the child and the new cost to agenda
+            _heap_push(agenda, (childPriority, pushes, children, childCost, copyList))
+            pushes += 1
+
+        # Keeps track of the peak agenda size
+        if len(agenda) > peakAgenda:
+            peakAgenda = len(agenda)
+        if pathNodes > peakPathNodes:
+            peakPathNodes = pathNodes
+
+    if stats is not None:
+        stats['expanded'] = len(expanded)
+        stats['pushes'] = pushes
+        stats['stale_pops'] = stalePops
+        stats['peak_agenda'] = peakAgenda
+        stats['peak_path_nodes'] = peakPathNodes if copy_paths else len(parent)
+
+    return result, len(expanded)
+
+
+def _bidirectional_search(edges, reverseEdges, node1, node2, heuristic=None, reverseHeuristic=None,
+                          stats=None):
+    """
+    Bidirectional version of _search
 
-                        # Adds the child to the list
-                        copyList.append(children)
-                        # Adds the child, the new list, and the new cost to agenda
-                        agenda.append((children,copyList,getDistance+cost, getDistance+cost+heuristic_distance))
+    One search grows forward from node1 over edges and another grows
+    backward from node2 over reverseEdges, always advancing the one whose
+    next entry is cheaper.  Every time a node gets a cost from one side and
+    already has one from the other, the path through it is a candidate.
+    The searches stop once the two cheapest agenda entries together cost at
+    least as much as the best candidate, or once either agenda runs out.
 
-    # Returns None if agenda is empty
-    return None
-
-def find_short_path(map_rep, loc1, loc2):
-    """
-    Return the shortest path between the two locations
+    With heuristics, both sides use the average potential
+    (heuristic - reverseHeuristic) / 2 (and its negative), which keeps the
+    stopping rule above correct.
 
     Parameters:
-        map_rep: the result of calling build_internal_representation
-        loc1: tuple of 2 floats: (latitude, longitude), representing the start
-              location
-        loc2: tuple of 2 floats: (latitude, longitude), representing the end
-              location
+        edges: function giving the (child, cost) outgoing edges of a node
+        reverseEdges: function giving the (parent, cost) incoming edges of
+                      a node
+        node1: node representing the start location
+        node2: node representing the end location
+        heuristic: optional lower bound on the cost from a node to node2
+        reverseHeuristic: optional lower bound on the cost from node1 to a
+                          node; needed whenever heuristic is given
+        stats: optional dictionary filled with the same keys as _search,
+               plus 'forward_expanded' and 'backward_expanded'
 
     Returns:
-        a list of (latitude, longitude) tuples representing the shortest path
-        (in terms of distance) from loc1 to loc2.
+        a tuple (path, expanded) like _search
     """
+    infinity = float('inf')
+
+    # Gets the forward potential of a node, or infinity if a heuristic
+    # shows the node cannot be on a path from node1 to node2
+    def potential(node):
+        if heuristic is None:
+            return 0
+        ahead = heuristic(node)
+        behind = reverseHeuristic(node)
+        if ahead == infinity or behind == infinity:
+            return infinity
+        return (ahead - behind) / 2
+
+    # Side 0 searches forward from node1, side 1 backward from node2
+    neighborFunctions = (edges, reverseEdges)
+    signs = (1, -1)
+    costs = ({node1: 0}, {node2: 0})
+    parents = ({node1: None}, {node2: None})
+    agendas = ([(potential(node1), 0, node1, 0)], [(-potential(node2), 0, node2, 0)])
+    expanded = (set(), set())
+    pushes = 2
+    stalePops = 0
+    peakAgenda = 2
+
+    best = 0 if node1 == node2 else infinity
+    meeting = node1 if node1 == node2 else None
+
+    while agendas[0] and agendas[1]:
+        # Stops once no path through the agendas can beat the best one
+        if agendas[0][0][0] + agendas[1][0][0] >= best:
+            break
 
-    # Gets the map representation
-    nodes,neighbors,waySet=map_rep
-
+        # Advances the side whose next entry is cheaper
+        side = 0 if agendas[0][0][0] <= agendas[1][0][0] else 1
+        priority, order, currentNode, cost = _heap_pop(agendas[side])
+        if currentNode in expanded[side]:
+            stalePops += 1
+            continue
+        expanded[side].add(currentNode)
+
+        for children, edgeCost in neighborFunctions[side](currentNode):
+            if children in expanded[side]:
+                continue
+            childCost = cost + edgeCost
+            if children in costs[side] and costs[side][children] <= childCost:
+                continue
+            childPotential = potential(children)
+            if childPotential == infinity:
+                continue
+
+            costs[side][children] = childCost
+            parents[side][children] = currentNode
+            _heap_push(agendas[side], (childCost + signs[side] * childPotential, pushes, children, childCost))
+            pushes += 1
+
+            # Checks for a cheaper path through the child
+            if children in costs[1 - side]:
+                total = childCost + costs[1 - side][children]
+                if total < best:
+                    best = total
+                    meeting = children
+
+        peakAgenda = max(peakAgenda, len(agendas[0]) + len(agendas[1]))
+
+    if stats is not None:
+        stats['forward_expanded'] = len(expanded[0])
+        stats['backward_expanded'] = len(expanded[1])
+        stats['expanded'] = len(expanded[0]) + len(expanded[1])
+        stats['pushes'] = pushes
+        stats['stale_pops'] = stalePops
+        stats['peak_agenda'] = peakAgenda
+        stats['peak_path_nodes'] = len(parents[0]) + len(parents[1])
+
+    if meeting is None:
+        return None, len(expanded[0]) + len(expanded[1])
+
+    # Joins the forward half and the backward half at the meeting node
+    path = _rebuild_path(parents[0], meeting)
+    node = parents[1][meeting]
+    while node is not None:
+        path.append(node)
+        node = parents[1][node]
+    return path, len(expanded[0]) + len(expanded[1])
+
+
+def _route(graph, node1, node2, metric, heuristic=None, stats=None, landmarks=False,
+           bidirectional=False, reverseHeuristic=None):
+    """
+    Find the cheapest path between two node handles with the fastest method
+    the map supports
+
+    Queries between nodes in strongly connected components that cannot
+    reach each other are answered at once when the map has components (see
+    components.py).  A query cache enabled on the map (see route_cache.py)
+    answers repeated queries.  Otherwise a contraction hierarchy attached to
+    the map for the metric answers the query when there is one and neither
+    a heuristic nor a bidirectional search was asked for, and the query runs
+    through _search or _bidirectional_search when there is not.  Tiled maps
+    (see tiles.py) also report 'tile_hits' and 'tile_misses' in stats.
 
-    count = 0
-    node1 = ''
-    # Gets the first node
-    for key in nodes:
-        if (count == 1):
-            break
-        node1 = (nodes[key])
-        count += 1
+    Parameters:
+        graph: map object with the methods of MapRepresentation
+        node1: handle of the start node
+        node2: handle of the end node
+        metric: 'distance' or 'time'
+        heuristic: optional A* heuristic towards node2
+        stats: optional dictionary to fill with search statistics, plus
+               'path_length' (nodes on the path) and, when it has a clock,
+               'search_time'
+        landmarks: use the landmark table attached to the map for the
+                   metric, if there is one, as (part of) the A* heuristic
+        bidirectional: search from both ends at once
+        reverseHeuristic: lower bound on the cost from node1 to a node,
+                          needed with heuristic for a bidirectional search
 
-    # Sets min distance to a default amount
-    minDistance1 = great_circle_distance(loc1, (node1['lat'], node1['lon']))
-    minDistance2 = great_circle_distance(loc2, (node1['lat'], node1['lon']))
+    Returns:
+        a tuple (path, expanded) like _search
+    """
+    def search():
+        return _find_route(graph, node1, node2, metric, heuristic, stats, landmarks, bidirectional,
+                           reverseHeuristic)
+
+    # Rejects queries between nodes that cannot reach each other without
+    # searching, when components were computed (see components.py)
+    components = getattr(graph, 'components', None)
+    if components is not None and not components.reachable(node1, node2):
+        if stats is not None:
+            stats.update(expanded=0, pushes=0, stale_pops=0, peak_agenda=0, peak_path_nodes=0, path_length=0)
+        return None, 0
+
+    # Maps that page their tiles in (see tiles.py) report the tiles each
+    # query found in memory and had to read
+    tiles = getattr(graph, 'tile_cache', None) if stats is not None else None
+    if tiles is not None:
+        hits, misses = tiles.hits, tiles.misses
+
+    # Answers repeated queries from the cache, when one is enabled (see
+    # route_cache.py)
+    cache = getattr(graph, 'query_cache', None)
+    if cache is not None:
+        path, expanded = _timed(stats, 'search_time', cache.route, graph, node1, node2, metric, search, stats)
+    else:
+        path, expanded = _timed(stats, 'search_time', search)
+
+    if stats is not None:
+        stats['path_length'] = 0 if path is None else len(path)
+    if tiles is not None:
+        stats['tile_hits'] = tiles.hits - hits
+        stats['tile_misses'] = tiles.misses - misses
+    return path, expanded
+
+
+def _timed(stats, key, function, *args):
+    """
+    Call function(*args), adding the seconds it took to stats[key] when
+    stats has a clock (see instrument.QueryStats)
+    """
+    clock = getattr(stats, 'clock', None)
+    if clock is None:
+        return function(*args)
+    start = clock()
+    result = function(*args)
+    stats[key] = stats.get(key, 0.0) + clock() - start
+    return result
 
-    # Sets savedNodes to default node
-    savedNode1 = node1
-    savedNode2 = node1
 
-    # Goes through the nodes to find the closest nodes to the two locations
-    for node in nodes:
-        if (node in waySet):
-            distance1 = (great_circle_distance(loc1, (nodes[node]['lat'], nodes[node]['lon'])))
-            if (distance1 < minDistance1):
-                minDistance1 = distance1
-                savedNode1 = nodes[node]
+def _find_route(graph, node1, node2, metric, heuristic=None, stats=None, landmarks=False,
+                bidirectional=False, reverseHeuristic=None):
+    """
+    Uncached part of _route, taking the same parameters
+    """
+    # Simplified maps (see simplify.py) search a view that can start and end
+    # at shape points, then expand the chains on the path back into nodes
+    if hasattr(graph, 'pin'):
+        view = graph.pin(node1, node2, metric)
+        path, expanded = _find_route(view, node1, node2, metric, heuristic, stats, landmarks,
+                                     bidirectional, reverseHeuristic)
+        return view.expand(path), expanded
+
+    hierarchy = getattr(graph, 'hierarchies', {}).get(metric)
+    if hierarchy is not None and heuristic is None and not bidirectional:
+        return hierarchy.query(node1, node2, stats)
+
+    table = getattr(graph, 'landmarks', {}).get(metric) if landmarks else None
+    if table is not None:
+        heuristic = _tighter(table.heuristic(node1, node2), heuristic)
+        if bidirectional:
+            reverseHeuristic = _tighter(table.reverse_heuristic(node1, node2), reverseHeuristic)
+
+    if bidirectional:
+        return _bidirectional_search(graph.edges(metric), graph.reverse_edges(metric), node1, node2,
+                                     heuristic, reverseHeuristic, stats=stats)
+    return _search(graph.edges(metric), node1, node2, heuristic, stats=stats)
+
+
+def _tighter(bound, otherBound):
+    """
+    Return a heuristic giving the larger of two lower bounds, either of
+    which may be None
+    """
+    if otherBound is None:
+        return bound
+    if bound is None:
+        return otherBound
 
-            distance2=(great_circle_distance(loc2, (nodes[node]['lat'], nodes[node]['lon'])))
-            if (distance2 < minDistance2):
-                minDistance2 = distance2
-                savedNode2 = nodes[node]
+    def heuristic(node):
+        return max(bound(node), otherBound(node))
 
+    return heuristic
 
-    # Gets a list of nodes calling the previous function
-    listNodes=find_short_path_nodes(map_rep,savedNode1['id'],savedNode2['id'])
 
+def _path_locations(graph, listNodes):
+    """
+    Convert a list of node IDs to a list of (latitude, longitude) tuples
+    """
     # If listNodes is empty
     if listNodes is None:
         return None
-    listLocations=[]
+    listLocations = []
 
     # Converts each node to a latitude and longitude
     for node in listNodes:
-        listLocations.append((nodes[node]['lat'],nodes[node]['lon']))
+        listLocations.append(graph.location(graph.internal_id(node)))
 
     return listLocations
 
-def find_short_path_heuristics(map_rep, loc1, loc2):
+
+def find_short_path_nodes(map_rep, node1, node2, stats=None, bidirectional=False):
+    """
+    Return the shortest path between the two nodes
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation
+        node1: node representing the start location
+        node2: node representing the end location
+        stats: optional dictionary to fill with search statistics, such as
+               the number of expanded nodes and the peak agenda size; an
+               instrument.QueryStats also records the time spent
+        bidirectional: search from both ends at once; stats then also
+                       reports the nodes expanded in each direction
+
+    Returns:
+        a list of node IDs representing the shortest path (in terms of
+        distance) from node1 to node2
+
+        Use a uniform cost search
+    """
+    # Defines the map representation
+    graph = _as_graph(map_rep)
+
+    path, expanded = _route(graph, graph.internal_id(node1), graph.internal_id(node2), 'distance',
+                            stats=stats, bidirectional=bidirectional)
+    if path is None:
+        return None
+    return [graph.external_id(node) for node in path]
+
+def find_short_path_nodes_heuristics(map_rep, node1, node2, stats=None, bidirectional=False):
+    """
+    Return the shortest path between the two nodes
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation
+        node1: node representing the start location
+        node2: node representing the end location
+        stats: optional dictionary to fill with search statistics, such as
+               the number of expanded nodes and the peak agenda size; an
+               instrument.QueryStats also records the time spent
+        bidirectional: search from both ends at once; stats then also
+                       reports the nodes expanded in each direction
+
+    Returns:
+        a list of node IDs representing the shortest path (in terms of
+        distance) from node1 to node2
+
+        Use an A* search with the straight-line distance to node2 as the
+        heuristic, tightened by the landmark table for distance when one
+        is attached to the map (see landmarks.py)
+    """
+    # Defines the map representation
+    graph = _as_graph(map_rep)
+    location = graph.location
+
+    start_location = location(graph.internal_id(node1))
+    final_location = location(graph.internal_id(node2))
+
+    # Gets the straight-line distance from a node to the final node
+    def heuristic_distance(node):
+        return great_circle_distance(location(node), final_location)
+
+    # Gets the straight-line distance from the start node to a node, for the
+    # backward half of a bidirectional search
+    def reverse_heuristic_distance(node):
+        return great_circle_distance(start_location, location(node))
+
+    # Maps with their own batched straight-line distances use those instead
+    if hasattr(graph, 'straight_line_heuristic'):
+        heuristic_distance = graph.straight_line_heuristic(graph.internal_id(node2))
+        reverse_heuristic_distance = graph.straight_line_heuristic(graph.internal_id(node1))
+
+    path, expanded = _route(graph, graph.internal_id(node1), graph.internal_id(node2), 'distance',
+                            heuristic_distance, stats=stats, landmarks=True,
+                            bidirectional=bidirectional, reverseHeuristic=reverse_heuristic_distance)
+    if path is None:
+        return None
+    return [graph.external_id(node) for node in path]
+
+def find_short_path(map_rep, loc1, loc2, stats=None, bidirectional=False):
     """
     Return the shortest path between the two locations
 
@@ -378,6 +1133,11 @@ def find_short_path_heuristics(map_rep, loc1, loc2):
               location
         loc2: tuple of 2 floats: (latitude, longitude), representing the end
               location
+        stats: optional dictionary to fill with search statistics, such as
+               the number of expanded nodes and the peak agenda size; an
+               instrument.QueryStats also records the time spent
+        bidirectional: search from both ends at once; stats then also
+                       reports the nodes expanded in each direction
 
     Returns:
         a list of (latitude, longitude) tuples representing the shortest path
@@ -385,55 +1145,51 @@ def find_short_path_heuristics(map_rep, loc1, loc2):
     """
 
     # Gets the map representation
-    nodes,neighbors,waySet=map_rep
-
+    graph = _as_graph(map_rep)
 
-    count = 0
-    node1 = ''
-    # Gets the first node
-    for key in nodes:
-        if (count == 1):
-            break
-        node1 = (nodes[key])
-        count += 1
+    # Finds the closest nodes to the two locations
+    node1 = _timed(stats, 'snapping_time', nearest_node, graph, loc1)
+    node2 = _timed(stats, 'snapping_time', nearest_node, graph, loc2)
 
-    # Sets min distance to a default amount
-    minDistance1 = great_circle_distance(loc1, (node1['lat'], node1['lon']))
-    minDistance2 = great_circle_distance(loc2, (node1['lat'], node1['lon']))
+    # Gets a list of nodes calling the previous function
+    listNodes=find_short_path_nodes(graph,node1,node2,stats,bidirectional)
 
-    # Sets savedNodes to default node
-    savedNode1 = node1
-    savedNode2 = node1
+    return _path_locations(graph, listNodes)
 
-    # Goes through the nodes to find the closest nodes to the two locations
-    for node in nodes:
-        if (node in waySet):
-            distance1 = (great_circle_distance(loc1, (nodes[node]['lat'], nodes[node]['lon'])))
-            if (distance1 < minDistance1):
-                minDistance1 = distance1
-                savedNode1 = nodes[node]
+def find_short_path_heuristics(map_rep, loc1, loc2, stats=None, bidirectional=False):
+    """
+    Return the shortest path between the two locations
 
-            distance2=(great_circle_distance(loc2, (nodes[node]['lat'], nodes[node]['lon'])))
-            if (distance2 < minDistance2):
-                minDistance2 = distance2
-                savedNode2 = nodes[node]
+    Parameters:
+        map_rep: the result of calling build_internal_representation
+        loc1: tuple of 2 floats: (latitude, longitude), representing the start
+              location
+        loc2: tuple of 2 floats: (latitude, longitude), representing the end
+              location
+        stats: optional dictionary to fill with search statistics, such as
+               the number of expanded nodes and the peak agenda size; an
+               instrument.QueryStats also records the time spent
+        bidirectional: search from both ends at once; stats then also
+                       reports the nodes expanded in each direction
 
+    Returns:
+        a list of (latitude, longitude) tuples representing the shortest path
+        (in terms of distance) from loc1 to loc2.
+    """
 
-    # Gets a list of nodes calling the previous function
-    listNodes=find_short_path_nodes_heuristics(map_rep,savedNode1['id'],savedNode2['id'])
+    # Gets the map representation
+    graph = _as_graph(map_rep)
 
-    # If listNodes is empty
-    if listNodes is None:
-        return None
-    listLocations=[]
+    # Finds the closest nodes to the two locations
+    node1 = _timed(stats, 'snapping_time', nearest_node, graph, loc1)
+    node2 = _timed(stats, 'snapping_time', nearest_node, graph, loc2)
 
-    # Converts each node to a latitude and longitude
-    for node in listNodes:
-        listLocations.append((nodes[node]['lat'],nodes[node]['lon']))
+    # Gets a list of nodes calling the previous function
+    listNodes=find_short_path_nodes_heuristics(graph,node1,node2,stats,bidirectional)
 
-    return listLocations
+    return _path_locations(graph, listNodes)
 
-def find_fast_path(map_rep, loc1, loc2):
+def find_fast_path(map_rep, loc1, loc2, stats=None, bidirectional=False, departure=None):
     """
     Return the shortest path between the two locations, in terms of expected
     time (taking into account speed limits).
@@ -444,126 +1200,51 @@ def find_fast_path(map_rep, loc1, loc2):
               location
         loc2: tuple of 2 floats: (latitude, longitude), representing the end
               location
+        stats: optional dictionary to fill with search statistics, such as
+               the number of expanded nodes and the peak agenda size; an
+               instrument.QueryStats also records the time spent
+        bidirectional: search from both ends at once; stats then also
+                       reports the nodes expanded in each direction
+        departure: optional time of departure in hours since midnight; the
+                   travel times then follow the speed profiles attached to
+                   the map (see traffic.py) instead of the static speeds.
+                   Arrival times are only known searching forwards, so it
+                   cannot be combined with bidirectional.
 
     Returns:
         a list of (latitude, longitude) tuples representing the shortest path
         (in terms of time) from loc1 to loc2.
     """
 
-    # Defines the map representation
-    nodes, neighbors, waySet = map_rep
-
-    count = 0
-    nodeA = ''
-    # Defines a default node
-    for key in nodes:
-        if (count == 1):
-            break
-        nodeA = (nodes[key])
-        count += 1
-
-    # Defines default distances
-    minDistance1 = great_circle_distance(loc1, (nodeA['lat'], nodeA['lon']))
-    minDistance2 = great_circle_distance(loc2, (nodeA['lat'], nodeA['lon']))
-
-    # Defines savedNode1 and 2
-    savedNode1 = nodeA
-    savedNode2 = nodeA
-
-    # Finds the closest nodes to savedNode1 and savedNode2
-    for node in nodes:
-        if (node in waySet):
-            distance1 = (great_circle_distance(loc1, (nodes[node]['lat'], nodes[node]['lon'])))
-            if (distance1 < minDistance1):
-                minDistance1 = distance1
-                savedNode1 = nodes[node]
-
-            distance2 = (great_circle_distance(loc2, (nodes[node]['lat'], nodes[node]['lon'])))
-            if (distance2 < minDistance2):
-                minDistance2 = distance2
-                savedNode2 = nodes[node]
-
-    # print("SAVED NODE 1",savedNode1, 'AYO')
+    if departure is not None and bidirectional:
+        raise ValueError('a departure time cannot be used with a bidirectional search')
 
-    # Redefines node1 and node2
-    node1 = savedNode1['id']
-    node2 = savedNode2['id']
-
-    # Keeps track of a node, a list of nodes and a cost
-    agenda = [(node1, [node1], 0)]
-
-    # Defines an expanded set
-    expanded = set()
-
-    # Defines a location for the first node
-    location1 = (nodes[node1]['lat'], nodes[node1]['lon'])
-
-    minIndex = 0
-
-    # While agneda is not empty
-    while (agenda):
-        # Defines a default minCost and minIndex
-        minCost = agenda[0][2]
-        minIndex = 0
-
-        # Goes through the agenda to find a minCost
-        for i in range(len(agenda)):
-            if (agenda[i][2] < minCost):
-                minCost = agenda[i][2]
-                minIndex = i
-
-        # Gets the information of the minIndex node
-        currentNode, currentList, cost = agenda.pop(minIndex)
-        # Gets the location of the currentNode
-        location1 = (nodes[currentNode]['lat'], nodes[currentNode]['lon'])
-        # If the currentNode is in expanded
-        if (currentNode in expanded):
-            pass
-        # If the node is the final Node
-        elif (currentNode == node2):
-            listNodes = currentList
-
-            if listNodes is None:
-                return None
-            listLocations = []
-
-            # Gets the lat and lon the nodes
-            for node in listNodes:
-                listLocations.append((nodes[node]['lat'], nodes[node]['lon']))
-
-            # Returns the list of locations
-            return listLocations
-
-        # Otherwise add the currentNode to an expanded set
-        else:
-            expanded.add(currentNode)
-            # If the currentNode has children
-            if (currentNode in neighbors):
-                # Goes through the children of currentNode
-                for children in neighbors[currentNode]:
-                    # If the child is in expanded
-                    if (children in expanded):
-                        continue
-                    else:
-                        # Gets a copy of the list
-                        copyList = currentList.copy()
-                        # Gets the location of the child
-                        location2 = (nodes[children]['lat'], nodes[children]['lon'])
-                        # Finds the distance between the currentNode and the child
-                        getDistance = great_circle_distance(location1, location2)
-                        # Gets the speed of the child
-                        speed = neighbors[currentNode][children]
-
-                        # Finds the time to get to the distance with the speed
-                        time = getDistance/speed
-
-                        # Adds the child to a list
-                        copyList.append(children)
+    # Defines the map representation
+    graph = _as_graph(map_rep)
+
+    # Finds the closest nodes to the two locations
+    node1 = _timed(stats, 'snapping_time', graph.nearest, loc1)[0]
+    node2 = _timed(stats, 'snapping_time', graph.nearest, loc2)[0]
+
+    if departure is not None:
+        # Searches by arrival time over the speed profiles of the map
+        traffic = getattr(graph, 'traffic', None)
+        if traffic is None:
+            raise ValueError('map has no speed profiles (see traffic.enable)')
+        listNodes, arrival = _timed(stats, 'search_time', traffic.route, node1, node2, departure, stats)
+        if stats is not None:
+            stats['path_length'] = 0 if listNodes is None else len(listNodes)
+    else:
+        # Searches using the travel time of every edge as its cost, guided
+        # by the landmark table for time when one is attached to the map
+        listNodes, expanded = _route(graph, node1, node2, 'time', stats=stats, landmarks=True,
+                                     bidirectional=bidirectional)
 
-                        # Appends the information to the agenda
-                        agenda.append((children, copyList, time + cost))
+    if listNodes is None:
+        return None
 
-    return None
+    # Gets the lat and lon the nodes
+    return [graph.location(node) for node in listNodes]
 
 
 if __name__ == '__main__':
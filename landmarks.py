@@ -0,0 +1,297 @@
+"""
+Landmark (ALT) lower bounds for A* search
+
+For a landmark L, the triangle inequality gives two lower bounds on the cost
+of getting from v to t:
+
+    d(L, t) - d(L, v)    and    d(v, L) - d(t, L)
+
+LandmarkTable precomputes d(L, v) and d(v, L) for a few landmarks spread
+across the map by farthest-point selection, and turns the best of these
+bounds into an A* heuristic that is much tighter than the straight-line
+distance, and that also works for travel times.
+
+Typical use:
+
+    map_rep = lab.build_internal_representation(nodes_filename, ways_filename)
+    map_rep = landmarks.prepare(map_rep)
+    lab.find_short_path_nodes_heuristics(map_rep, node1, node2)
+    lab.find_fast_path(map_rep, loc1, loc2)
+"""
+
+import heapq
+from array import array
+
+import lab
+
+
+DEFAULT_LANDMARKS = 8
+
+# Landmarks used for a single query, picked by how well they bound the
+# start node
+ACTIVE_LANDMARKS = 4
+
+# Distances are stored as 32-bit floats, which are off by at most one part
+# in 2 ** 24.  Bounds are lowered by this fraction of the values they are
+# made from so that they stay lower bounds.
+ROUNDING_SLACK = 1.2e-7
+
+INFINITY = float('inf')
+
+
+def _one_to_all(adjacency, source):
+    """
+    Return the list of costs from source to every node number over
+    adjacency (a list of (child, cost) lists), with INFINITY for nodes that
+    cannot be reached
+    """
+    costs = [INFINITY] * len(adjacency)
+    costs[source] = 0.0
+    queue = [(0.0, source)]
+    while queue:
+        cost, node = heapq.heappop(queue)
+        if cost > costs[node]:
+            continue
+        for child, edgeCost in adjacency[node]:
+            childCost = cost + edgeCost
+            if childCost < costs[child]:
+                costs[child] = childCost
+                heapq.heappush(queue, (childCost, child))
+    return costs
+
+
+class LandmarkTable:
+    """
+    Landmark distance tables for one metric of a map
+
+    Nodes are numbered 0 to n - 1 in the order of graph.node_handles().  For
+    landmark i, forward[v * count + i] is the cost from the landmark to node
+    v and backward[v * count + i] is the cost from node v to the landmark,
+    so all of a node's entries sit next to each other.
+    """
+
+    def __init__(self, graph, metric, count=DEFAULT_LANDMARKS):
+        """
+        Pick landmarks and compute their distance tables
+
+        Parameters:
+            graph: map object with the methods of lab.MapRepresentation
+            metric: 'distance' or 'time'
+            count: number of landmarks
+        """
+        self.metric = metric
+        handles = list(graph.node_handles())
+        n = len(handles)
+        self.size = n
+        if handles == list(range(n)):
+            self.local = None
+        else:
+            self.local = {handle: index for index, handle in enumerate(handles)}
+
+        # Builds forward and reverse adjacency lists over node numbers
+        forwardEdges = [[] for _ in range(n)]
+        reverseEdges = [[] for _ in range(n)]
+        edges = graph.edges(metric)
+        for u, handle in enumerate(handles):
+            for child, cost in edges(handle):
+                v = self._index(child)
+                if v is not None:
+                    forwardEdges[u].append((v, cost))
+                    reverseEdges[v].append((u, cost))
+
+        # Farthest-point selection: every new landmark is the node farthest
+        # (in whichever direction is shorter) from the landmarks picked so
+        # far.  The search for the first one starts from the best connected
+        # node, which is almost surely in the main part of the map.
+        self.landmarks = []
+        fromLandmarks = []
+        toLandmarks = []
+        closest = [INFINITY] * n
+        candidate = None
+        if n:
+            seed = max(range(n), key=lambda v: len(forwardEdges[v]) + len(reverseEdges[v]))
+            costs = _one_to_all(forwardEdges, seed)
+            candidate = max(range(n), key=lambda v: (costs[v] != INFINITY, costs[v]))
+        for _ in range(min(count, n)):
+            self.landmarks.append(candidate)
+            fromLandmarks.append(_one_to_all(forwardEdges, candidate))
+            toLandmarks.append(_one_to_all(reverseEdges, candidate))
+
+            best = 0
+            for v in range(n):
+                nearer = min(fromLandmarks[-1][v], toLandmarks[-1][v])
+                if nearer < closest[v]:
+                    closest[v] = nearer
+                if closest[v] != INFINITY and closest[v] > best:
+                    best = closest[v]
+                    candidate = v
+            if best == 0:
+                break
+
+        # Interleaves the tables so each node's entries are together
+        self.count = len(self.landmarks)
+        self.forward = array('f', [0.0]) * (n * self.count)
+        self.backward = array('f', [0.0]) * (n * self.count)
+        for i in range(self.count):
+            self.forward[i::self.count] = array('f', fromLandmarks[i])
+            self.backward[i::self.count] = array('f', toLandmarks[i])
+
+    def _index(self, handle):
+        """
+        Return the node number of a handle, or None if it is not in the map
+        """
+        if self.local is None:
+            return handle if 0 <= handle < self.size else None
+        return self.local.get(handle)
+
+    def add_nodes(self, nodes):
+        """
+        Number nodes that the table does not know yet after the others, and
+        give them entries computed from the edges linking them to known nodes
+
+        The entries are exact when every path to and from a new node goes
+        through the edges given, as for a shape point made a junction (see
+        simplify.SimplifiedMap.update_edges).
+
+        Parameters:
+            nodes: list of (handle, incoming, outgoing) tuples, where
+                   incoming lists the (known handle, cost) edges into the
+                   node and outgoing the (known handle, cost) edges out of it
+        """
+        count = self.count
+        if self.local is None and nodes:
+            self.local = {handle: handle for handle in range(self.size)}
+        for handle, incoming, outgoing in nodes:
+            self.local[handle] = self.size
+            self.size += 1
+            for i in range(count):
+                self.forward.append(min((self.forward[self._index(node) * count + i] + cost
+                                         for node, cost in incoming), default=INFINITY))
+                self.backward.append(min((cost + self.backward[self._index(node) * count + i]
+                                          for node, cost in outgoing), default=INFINITY))
+
+    def nbytes(self):
+        """
+        Return the number of bytes held by the distance tables
+        """
+        return (len(self.forward) + len(self.backward)) * self.forward.itemsize
+
+    def _bound(self, v, t, landmarks):
+        """
+        Return the best lower bound on the cost from node number v to node
+        number t over the given landmark indices
+
+        The bound is INFINITY when a landmark shows that t cannot be reached
+        from v: the landmark reaches v but not t, or t reaches the landmark
+        but v does not.
+        """
+        count = self.count
+        forward, backward = self.forward, self.backward
+        best = 0.0
+        for i in landmarks:
+            toTarget, toNode = forward[t * count + i], forward[v * count + i]
+            if toNode != INFINITY:
+                if toTarget == INFINITY:
+                    return INFINITY
+                bound = toTarget - toNode - ROUNDING_SLACK * (toTarget + toNode)
+                if bound > best:
+                    best = bound
+            fromNode, fromTarget = backward[v * count + i], backward[t * count + i]
+            if fromTarget != INFINITY:
+                if fromNode == INFINITY:
+                    return INFINITY
+                bound = fromNode - fromTarget - ROUNDING_SLACK * (fromNode + fromTarget)
+                if bound > best:
+                    best = bound
+        return best
+
+    def heuristic(self, node1, node2, active=ACTIVE_LANDMARKS):
+        """
+        Return an A* heuristic for a search from node1 to node2
+
+        Parameters:
+            node1: handle of the start node
+            node2: handle of the end node
+            active: number of landmarks to use, picked by how tight a bound
+                    each gives at node1
+
+        Returns:
+            a function taking a node handle and returning a lower bound on
+            the cost from it to node2, or INFINITY if node2 cannot be
+            reached from it
+        """
+        source = self._index(node1)
+        target = self._index(node2)
+        if source is None or target is None or not self.count:
+            return lambda node: 0.0
+
+        chosen = self._choose(source, target, active)
+        index = self._index
+        bound = self._bound
+
+        def heuristic(node):
+            v = index(node)
+            return 0.0 if v is None else bound(v, target, chosen)
+
+        return heuristic
+
+    def reverse_heuristic(self, node1, node2, active=ACTIVE_LANDMARKS):
+        """
+        Return the heuristic for the backward half of a bidirectional search
+        from node1 to node2
+
+        Parameters:
+            node1: handle of the start node
+            node2: handle of the end node
+            active: number of landmarks to use, as for heuristic
+
+        Returns:
+            a function taking a node handle and returning a lower bound on
+            the cost from node1 to it, or INFINITY if it cannot be reached
+            from node1
+        """
+        source = self._index(node1)
+        target = self._index(node2)
+        if source is None or target is None or not self.count:
+            return lambda node: 0.0
+
+        chosen = self._choose(source, target, active)
+        index = self._index
+        bound = self._bound
+
+        def heuristic(node):
+            v = index(node)
+            return 0.0 if v is None else bound(source, v, chosen)
+
+        return heuristic
+
+    def _choose(self, source, target, active):
+        """
+        Return the indices of the landmarks that bound the cost from source
+        to target best, or all of them when one proves there is no path
+        """
+        if self._bound(source, target, range(self.count)) == INFINITY:
+            return range(self.count)
+        ranked = sorted(range(self.count), key=lambda i: -self._bound(source, target, (i,)))
+        return ranked[:active]
+
+
+def prepare(map_rep, count=DEFAULT_LANDMARKS, metrics=('distance', 'time')):
+    """
+    Build landmark tables for a map and attach them to it, so that
+    find_short_path_nodes_heuristics and find_fast_path use them
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation, or a
+                 compact.CompactMap
+        count: number of landmarks per metric
+        metrics: the metrics to build tables for
+
+    Returns:
+        the map with the tables attached (a MapRepresentation if a plain
+        tuple was passed in)
+    """
+    graph = lab._as_graph(map_rep)
+    for metric in metrics:
+        graph.landmarks[metric] = LandmarkTable(graph, metric, count)
+    return graph
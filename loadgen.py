@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Load generator for service.py
+
+Opens a number of concurrent keep-alive connections to a running routing
+service and sends route requests between random locations inside the map's
+bounding box (read from GET /info), then prints the throughput and latency
+percentiles seen by the clients and the counters of the service.  Queries
+are drawn from a small pool of origins, as with deliveries from a few
+depots, so batches have start nodes to share.
+
+    python service.py resources/cambridge.nodes resources/cambridge.ways --port 8080 &
+    python loadgen.py --port 8080 --concurrency 32 --requests 2000
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import instrument
+
+
+DEFAULT_CONCURRENCY = 32
+DEFAULT_REQUESTS = 1000
+DEFAULT_ORIGINS = 8
+SEED = 6009
+
+
+async def request(reader, writer, method, target, body=None):
+    """
+    Send one HTTP/1.1 request on an open connection and return the status
+    and the decoded JSON reply
+    """
+    payload = b'' if body is None else json.dumps(body).encode()
+    writer.write(('%s %s HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                  'Content-Length: %d\r\n\r\n' % (method, target, len(payload))).encode() + payload)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = header.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def _client(host, port, queries, latencies, errors):
+    """
+    Send queries one after the other on one connection until none are left
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while queries:
+            body = queries.pop()
+            start = time.perf_counter()
+            status, reply = await request(reader, writer, 'POST', '/route', body)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(reply.get('error'))
+    finally:
+        writer.close()
+
+
+async def run(host, port, concurrency=DEFAULT_CONCURRENCY, count=DEFAULT_REQUESTS, kind='fast',
+              origins=DEFAULT_ORIGINS, seed=SEED):
+    """
+    Run the load against a service
+
+    Returns:
+        a dictionary with the seconds taken, the client latencies, the error
+        messages and the service's counters afterwards
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    status, info = await request(reader, writer, 'GET', '/info')
+    (minLat, minLon), (maxLat, maxLon) = info['bounds']
+
+    rnd = random.Random(seed)
+
+    def location():
+        return [rnd.uniform(minLat, maxLat), rnd.uniform(minLon, maxLon)]
+
+    starts = [location() for _ in range(origins)]
+    queries = [{'kind': kind, 'start': rnd.choice(starts), 'end': location()} for _ in range(count)]
+
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*(_client(host, port, queries, latencies, errors) for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+
+    status, counters = await request(reader, writer, 'GET', '/stats')
+    writer.close()
+    return {'seconds': seconds, 'latencies': latencies, 'errors': errors, 'counters': counters}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Send concurrent route requests to service.py.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='open connections (default %(default)s)')
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS,
+                        help='requests to send (default %(default)s)')
+    parser.add_argument('--kind', choices=('fast', 'short'), default='fast')
+    parser.add_argument('--origins', type=int, default=DEFAULT_ORIGINS,
+                        help='distinct start locations (default %(default)s)')
+    parser.add_argument('--seed', type=int, default=SEED)
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run(args.host, args.port, args.concurrency, args.requests, args.kind, args.origins,
+                             args.seed))
+    latencies = result['latencies']
+    print('%d requests in %.2f s: %.0f requests per second, %d errors'
+          % (len(latencies), result['seconds'], len(latencies) / result['seconds'], len(result['errors'])))
+    print('client latency ms: ' + ', '.join('p%d %.2f' % (percent, instrument.percentile(latencies, percent) * 1e3)
+                                            for percent in instrument.DEFAULT_PERCENTILES))
+    print('service: ' + json.dumps(result['counters']))
+    return 1 if result['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
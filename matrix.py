@@ -0,0 +1,436 @@
+"""
+Origin x destination travel time matrices
+
+Calling find_fast_path once per pair snaps both locations and runs a fresh
+search every time.  travel_time_matrix snaps every location once and then
+answers a whole row of the matrix per search:
+
+    'dijkstra': one Dijkstra search per origin, which stops as soon as every
+                destination has been settled and reuses the same cost
+                buffers from one origin to the next
+    'buckets':  many-to-many search over a contraction hierarchy (see ch.py).
+                An upward search from every destination leaves its costs in
+                buckets at the nodes it settles, and an upward search from
+                every origin then reads the buckets of the nodes it settles.
+                Both searches only cover a small part of the map, so this is
+                much faster for large matrices.
+
+Typical use:
+
+    map_rep = lab.build_internal_representation(nodes_filename, ways_filename)
+    times = matrix.travel_time_matrix(map_rep, origins, destinations)
+    times[i, j]   # hours from origins[i] to destinations[j]
+"""
+
+import heapq
+from array import array
+
+import lab
+
+
+INFINITY = float('inf')
+
+
+class Matrix:
+    """
+    Two-dimensional matrix of costs stored row by row in a flat array of
+    doubles
+
+    Attributes:
+        rows: number of rows (origins)
+        columns: number of columns (destinations)
+        values: array('d') of rows * columns costs, with INFINITY where the
+                destination cannot be reached from the origin
+    """
+
+    def __init__(self, rows, columns, values=None):
+        self.rows = rows
+        self.columns = columns
+        if values is None:
+            values = array('d', [INFINITY]) * (rows * columns)
+        self.values = values
+
+    def __getitem__(self, position):
+        row, column = position
+        return self.values[row * self.columns + column]
+
+    def __setitem__(self, position, value):
+        row, column = position
+        self.values[row * self.columns + column] = value
+
+    def row(self, row):
+        """
+        Return the costs from one origin to every destination
+        """
+        return self.values[row * self.columns:(row + 1) * self.columns]
+
+    def tolist(self):
+        """
+        Return the matrix as a list of rows
+        """
+        return [list(self.row(row)) for row in range(self.rows)]
+
+    def nbytes(self):
+        """
+        Return the number of bytes held by the costs
+        """
+        return len(self.values) * self.values.itemsize
+
+
+class OneToMany:
+    """
+    Dijkstra search from one node to a set of nodes, reusing its buffers
+    from one search to the next
+
+    Nodes are numbered 0 to n - 1 in the order of graph.node_handles().  The
+    cost buffer has one entry per node and only the entries a search touched
+    are reset before the next search, so a search costs time in proportion
+    to the part of the map it covers rather than to the whole map.
+    """
+
+    def __init__(self, graph, metric):
+        """
+        Parameters:
+            graph: map object with the methods of lab.MapRepresentation
+            metric: 'distance' or 'time'
+        """
+        handles = list(graph.node_handles())
+        n = len(handles)
+        self.handles = handles
+        if handles == list(range(n)):
+            # Node handles are already node numbers
+            self.local = None
+            self.adjacency = graph.edges(metric)
+        else:
+            self.local = {handle: index for index, handle in enumerate(handles)}
+            edges = graph.edges(metric)
+            adjacency = [[] for _ in range(n)]
+            for u, handle in enumerate(handles):
+                for child, cost in edges(handle):
+                    v = self.local.get(child)
+                    if v is not None:
+                        adjacency[u].append((v, cost))
+            self.adjacency = adjacency.__getitem__
+
+        self.costs = array('d', [INFINITY]) * n
+        self.settled = bytearray(n)
+        self.touched = []
+        self.expanded = 0
+
+    def index(self, handle):
+        """
+        Return the node number of a handle, or None if it is not in the map
+        """
+        if self.local is None:
+            return handle if 0 <= handle < len(self.handles) else None
+        return self.local.get(handle)
+
+    def _reset(self):
+        costs, settled = self.costs, self.settled
+        for node in self.touched:
+            costs[node] = INFINITY
+            settled[node] = 0
+        self.touched = []
+
+    def search(self, source, targets):
+        """
+        Return the costs from node number source to every node number in
+        targets, as a dictionary
+
+        The search stops once every target has been settled.  Targets that
+        cannot be reached are left out of the result.
+        """
+        return self.search_from([(source, 0.0)], targets)
+
+    def search_from(self, seeds, targets):
+        """
+        Like search, but starting from several node numbers at once
+
+        Parameters:
+            seeds: list of (node number, cost) pairs, each node starting the
+                   search at its cost
+            targets: node numbers to find the costs of
+        """
+        self._reset()
+        costs, settled, touched = self.costs, self.settled, self.touched
+        adjacency = self.adjacency
+
+        remaining = set(targets)
+        found = {}
+        for node, cost in seeds:
+            if cost < costs[node]:
+                if costs[node] == INFINITY:
+                    touched.append(node)
+                costs[node] = cost
+        queue = [(costs[node], node) for node in touched]
+        heapq.heapify(queue)
+        while queue and remaining:
+            cost, node = heapq.heappop(queue)
+            if settled[node]:
+                continue
+            settled[node] = 1
+            self.expanded += 1
+            if node in remaining:
+                remaining.discard(node)
+                found[node] = cost
+            for child, edgeCost in adjacency(node):
+                childCost = cost + edgeCost
+                if childCost < costs[child]:
+                    if costs[child] == INFINITY:
+                        touched.append(child)
+                    costs[child] = childCost
+                    heapq.heappush(queue, (childCost, child))
+        return found
+
+    def within(self, source, limit):
+        """
+        Return the costs from node number source to every node number it
+        reaches at a cost of at most limit, as a dictionary
+
+        Nodes past the limit are never queued, so the search only covers the
+        part of the map inside the limit.
+        """
+        self._reset()
+        costs, settled, touched = self.costs, self.settled, self.touched
+        adjacency = self.adjacency
+
+        found = {}
+        costs[source] = 0.0
+        touched.append(source)
+        queue = [(0.0, source)]
+        while queue:
+            cost, node = heapq.heappop(queue)
+            if settled[node]:
+                continue
+            settled[node] = 1
+            self.expanded += 1
+            found[node] = cost
+            for child, edgeCost in adjacency(node):
+                childCost = cost + edgeCost
+                if childCost <= limit and childCost < costs[child]:
+                    if costs[child] == INFINITY:
+                        touched.append(child)
+                    costs[child] = childCost
+                    heapq.heappush(queue, (childCost, child))
+        return found
+
+
+def _search_for(graph, metric):
+    """
+    Return a OneToMany over a map, made again only when the metric or map
+    version changes
+
+    The adjacency and buffers are kept on the map itself, as
+    graph.one_to_many, so they live exactly as long as the map (and every
+    worker process keeps its own).
+    """
+    version = getattr(graph, 'version', 0)
+    kept = getattr(graph, 'one_to_many', None)
+    if kept is None or kept[0] != metric or kept[1] != version:
+        kept = graph.one_to_many = (metric, version, OneToMany(graph, metric))
+    return kept[2]
+
+
+def _ends(graph, nodes, metric, outgoing):
+    """
+    Return a dictionary mapping every distinct node handle in nodes to the
+    (handle, cost) pairs that a search leaves it from (outgoing) or reaches
+    it at
+
+    A node is its own end at cost 0, except for a shape point of a
+    simplify.SimplifiedMap, which is not a node of the map searched.  It is
+    left at the junctions its chains lead to and reached from the junctions
+    they come from, at the cost of the part of the chain in between (see
+    simplify.SimplifiedMap.pin).
+    """
+    memberships = getattr(graph, 'memberships', {}) if hasattr(graph, 'pin') else {}
+    result = {}
+    for node in nodes:
+        if node in result:
+            continue
+        if node in memberships:
+            view = graph.pin(node, node, metric)
+            result[node] = (view.forward if outgoing else view.reverse).get(node, [])
+        else:
+            result[node] = [(node, 0.0)]
+    return result
+
+
+def _upward_costs(offsets, targets, weights, seeds):
+    """
+    Return a dictionary of the costs of every node reached from the
+    (node number, cost) pairs in seeds by a Dijkstra search over one
+    direction of a contraction hierarchy
+    """
+    costs = {}
+    for node, cost in seeds:
+        if cost < costs.get(node, INFINITY):
+            costs[node] = cost
+    done = set()
+    queue = [(cost, node) for node, cost in costs.items()]
+    heapq.heapify(queue)
+    while queue:
+        cost, node = heapq.heappop(queue)
+        if node in done:
+            continue
+        done.add(node)
+        for edge in range(offsets[node], offsets[node + 1]):
+            child = targets[edge]
+            childCost = cost + weights[edge]
+            if childCost < costs.get(child, INFINITY):
+                costs[child] = childCost
+                heapq.heappush(queue, (childCost, child))
+    return costs
+
+
+def _numbered(ends, index):
+    """
+    Return (handle, cost) pairs as (node number, cost) pairs, leaving out
+    the handles index does not know
+    """
+    return [(index(handle), cost) for handle, cost in ends if index(handle) is not None]
+
+
+def _bucket_matrix(graph, hierarchy, metric, sources, targets, result):
+    """
+    Fill result with the costs between node handles using the bucket
+    many-to-many algorithm over a contraction hierarchy
+    """
+    # Backward upward search from every distinct destination
+    buckets = {}
+    for node, ends in _ends(graph, targets, metric, False).items():
+        seeds = _numbered(ends, hierarchy._index)
+        if not seeds:
+            continue
+        for middle, cost in _upward_costs(hierarchy.downOffsets, hierarchy.downTargets,
+                                          hierarchy.downWeights, seeds).items():
+            buckets.setdefault(middle, []).append((node, cost))
+
+    # Forward upward search from every distinct origin, scanning buckets
+    columns = {}
+    for column, node in enumerate(targets):
+        columns.setdefault(node, []).append(column)
+    rows = {}
+    for row, node in enumerate(sources):
+        rows.setdefault(node, []).append(row)
+
+    for node, ends in _ends(graph, sources, metric, True).items():
+        seeds = _numbered(ends, hierarchy._index)
+        if not seeds:
+            continue
+        best = {}
+        for middle, cost in _upward_costs(hierarchy.upOffsets, hierarchy.upTargets,
+                                          hierarchy.upWeights, seeds).items():
+            for target, otherCost in buckets.get(middle, ()):
+                if cost + otherCost < best.get(target, INFINITY):
+                    best[target] = cost + otherCost
+        for target, cost in best.items():
+            for row in rows[node]:
+                for column in columns[target]:
+                    result[row, column] = cost
+
+
+def _dijkstra_matrix(graph, metric, sources, targets, result):
+    """
+    Fill result with the costs between node handles using one one-to-many
+    Dijkstra search per distinct origin
+    """
+    search = _search_for(graph, metric)
+    ends = _ends(graph, targets, metric, False)
+    columns = {}
+    for column, node in enumerate(targets):
+        for number, extra in _numbered(ends[node], search.index):
+            columns.setdefault(number, []).append((column, extra))
+
+    done = {}
+    starts = _ends(graph, sources, metric, True)
+    for row, node in enumerate(sources):
+        if node in done:
+            # Copies the row of an earlier origin snapped to the same node
+            start = done[node] * result.columns
+            result.values[row * result.columns:(row + 1) * result.columns] = \
+                result.values[start:start + result.columns]
+            continue
+        done[node] = row
+        seeds = _numbered(starts[node], search.index)
+        if not seeds:
+            continue
+        for target, cost in search.search_from(seeds, columns).items():
+            for column, extra in columns[target]:
+                if cost + extra < result[row, column]:
+                    result[row, column] = cost + extra
+
+
+def _same_chain(graph, metric, sources, targets, result):
+    """
+    Fill in the costs between shape points of a simplify.SimplifiedMap that
+    lie on the same chain, which the searches between junctions miss when
+    the path between them stays on the chain
+    """
+    memberships = getattr(graph, 'memberships', None) if hasattr(graph, 'pin') else None
+    if not memberships:
+        return
+    columns = {}
+    for column, node in enumerate(targets):
+        for chain, position in memberships.get(node, ()):
+            columns.setdefault(chain, set()).add(column)
+
+    direct = {}
+    for row, node in enumerate(sources):
+        near = set()
+        for chain, position in memberships.get(node, ()):
+            near.update(columns.get(chain, ()))
+        for column in near:
+            other = targets[column]
+            if (node, other) not in direct:
+                segment = graph.pin(node, other, metric).segments.get((node, other))
+                direct[(node, other)] = 0.0 if node == other else INFINITY if segment is None else segment[0]
+            if direct[(node, other)] < result[row, column]:
+                result[row, column] = direct[(node, other)]
+
+
+def travel_time_matrix(map_rep, origins, destinations, metric='time', method=None):
+    """
+    Return the cost of the best path from every origin to every destination
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation, a
+                 compact.CompactMap or a simplify.SimplifiedMap
+        origins: list of (latitude, longitude) tuples
+        destinations: list of (latitude, longitude) tuples
+        metric: 'time' for travel times in hours or 'distance' for lengths in
+                miles
+        method: 'dijkstra' for one-to-many searches or 'buckets' for the
+                contraction hierarchy many-to-many search.  Defaults to
+                'buckets' when the map has a hierarchy for the metric and to
+                'dijkstra' otherwise.
+
+    Returns:
+        a Matrix with one row per origin and one column per destination,
+        holding INFINITY where there is no path
+    """
+    graph = lab._as_graph(map_rep)
+    if method is None:
+        method = 'buckets' if metric in graph.hierarchies else 'dijkstra'
+    if method not in ('dijkstra', 'buckets'):
+        raise ValueError('unknown method: %r' % (method,))
+
+    # Snaps every distinct location once
+    snapped = {}
+    for loc in list(origins) + list(destinations):
+        loc = tuple(loc)
+        if loc not in snapped:
+            snapped[loc] = graph.nearest(loc)[0]
+    sources = [snapped[tuple(loc)] for loc in origins]
+    targets = [snapped[tuple(loc)] for loc in destinations]
+
+    result = Matrix(len(sources), len(targets))
+    if method == 'buckets':
+        hierarchy = graph.hierarchies.get(metric)
+        if hierarchy is None:
+            raise ValueError('map has no contraction hierarchy for %r' % (metric,))
+        _bucket_matrix(graph, hierarchy, metric, sources, targets, result)
+    else:
+        _dijkstra_matrix(graph, metric, sources, targets, result)
+    _same_chain(graph, metric, sources, targets, result)
+    return result
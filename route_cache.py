@@ -0,0 +1,254 @@
+"""
+Opt-in cache of query results
+
+Routing traffic is often repetitive: the same depots to the same hot
+destinations.  Once enabled on a map, a QueryCache remembers the path found
+for every (snapped start node, snapped end node, metric), evicting the
+least recently used paths past a size limit.
+
+Queries that share an origin also share work: the second time an origin is
+seen, its query grows a shortest path tree from the origin, which is kept
+(also in least recently used order) and grown further by later queries from
+the same origin.  A target the tree has already settled is answered without
+any search.
+
+Every map object carries a version number that is bumped whenever its edges
+change, and the cache empties itself when the version no longer matches.
+
+Typical use:
+
+    map_rep = route_cache.enable(lab.build_internal_representation(nodes_filename, ways_filename))
+    lab.find_fast_path(map_rep, loc1, loc2)
+    lab.find_fast_path(map_rep, loc1, loc2)   # answered by the cache
+    map_rep.query_cache.counters()
+"""
+
+import heapq
+from collections import OrderedDict
+
+import lab
+
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_TREES = 16
+
+# Origins remembered (without a tree) to spot an origin's second query
+ORIGINS_PER_TREE = 4
+
+
+class ShortestPathTree:
+    """
+    Dijkstra search from one origin that is grown on demand
+
+    The agenda is kept between calls, so every node is expanded at most once
+    over all the targets asked for.  The pushes, stalePops and peakAgenda
+    counters cover the whole life of the tree.
+    """
+
+    def __init__(self, edges, origin):
+        self.edges = edges
+        self.costs = {origin: 0}
+        self.parents = {origin: None}
+        self.settled = set()
+        self.agenda = [(0, 0, origin)]
+        self.pushes = 1
+        self.stalePops = 0
+        self.peakAgenda = 1
+
+    def grow_to(self, target):
+        """
+        Expand nodes until target is settled or the agenda runs out
+
+        Returns:
+            the number of nodes expanded by this call
+        """
+        expanded = 0
+        settled, costs, parents, agenda = self.settled, self.costs, self.parents, self.agenda
+        while target not in settled and agenda:
+            cost, order, node = heapq.heappop(agenda)
+            if node in settled:
+                self.stalePops += 1
+                continue
+            settled.add(node)
+            expanded += 1
+            for child, edgeCost in self.edges(node):
+                childCost = cost + edgeCost
+                if child not in settled and childCost < costs.get(child, float('inf')):
+                    costs[child] = childCost
+                    parents[child] = node
+                    heapq.heappush(agenda, (childCost, self.pushes, child))
+                    self.pushes += 1
+            if len(agenda) > self.peakAgenda:
+                self.peakAgenda = len(agenda)
+        return expanded
+
+    def path(self, target):
+        """
+        Return the path from the origin to a settled target, or None if the
+        target is not settled
+        """
+        if target not in self.settled:
+            return None
+        return lab._rebuild_path(self.parents, target)
+
+
+class QueryCache:
+    """
+    Least recently used cache of paths, and of shortest path trees for
+    repeated origins
+
+    Attributes:
+        max_entries: most paths kept
+        max_trees: most shortest path trees kept (0 turns trees off)
+        hits: queries answered from a stored path
+        tree_hits: queries answered by a stored shortest path tree
+        misses: queries that needed a search
+        evictions: paths and trees dropped to stay within the limits
+        invalidations: times the cache emptied itself because the map changed
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_trees=DEFAULT_MAX_TREES):
+        self.max_entries = max_entries
+        self.max_trees = max_trees
+        self.paths = OrderedDict()
+        self.trees = OrderedDict()
+        self.origins = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.tree_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def clear(self):
+        """
+        Drop every stored path and tree, keeping the counters
+        """
+        self.paths.clear()
+        self.trees.clear()
+        self.origins.clear()
+
+    def counters(self):
+        """
+        Return the counters as a dictionary
+        """
+        return {
+            'hits': self.hits,
+            'tree_hits': self.tree_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'entries': len(self.paths),
+            'trees': len(self.trees),
+        }
+
+    @staticmethod
+    def _touch(entries, key, value, limit):
+        """
+        Store a value as the most recently used entry, returning the number
+        of entries evicted
+        """
+        entries[key] = value
+        entries.move_to_end(key)
+        evicted = 0
+        while len(entries) > limit:
+            entries.popitem(last=False)
+            evicted += 1
+        return evicted
+
+    def route(self, graph, node1, node2, metric, search, stats=None):
+        """
+        Return the result of a query, from the cache if possible
+
+        Parameters:
+            graph: the map the query runs on
+            node1: handle of the (snapped) start node
+            node2: handle of the (snapped) end node
+            metric: 'distance' or 'time'
+            search: function running the query without the cache and
+                    returning (path, expanded)
+            stats: optional dictionary to fill with search statistics; its
+                   'cache' key tells how the query was answered
+
+        Returns:
+            a tuple (path, expanded) like lab._search
+        """
+        version = getattr(graph, 'version', 0)
+        if version != self.version:
+            if self.version is not None:
+                self.invalidations += 1
+            self.clear()
+            self.version = version
+
+        key = (node1, node2, metric)
+        if key in self.paths:
+            self.hits += 1
+            self.paths.move_to_end(key)
+            path = self.paths[key]
+            if stats is not None:
+                stats.update(cache='hit', expanded=0, pushes=0, stale_pops=0, peak_agenda=0,
+                             peak_path_nodes=0)
+            return (None if path is None else list(path)), 0
+
+        # Grows the origin's tree if it has one, or plants one the second
+        # time the origin is seen.  Shape points of simplified maps are not
+        # search nodes, so those maps only cache paths.
+        origin = (node1, metric)
+        tree = self.trees.get(origin)
+        if tree is None and self.max_trees and not hasattr(graph, 'pin'):
+            if origin in self.origins:
+                del self.origins[origin]
+                tree = ShortestPathTree(graph.edges(metric), node1)
+                self.evictions += self._touch(self.trees, origin, tree, self.max_trees)
+            else:
+                self._touch(self.origins, origin, True, self.max_trees * ORIGINS_PER_TREE)
+
+        if tree is not None:
+            self.trees.move_to_end(origin)
+            if node2 in tree.settled:
+                self.tree_hits += 1
+                kind = 'tree'
+                expanded = 0
+            else:
+                self.misses += 1
+                kind = 'miss'
+                expanded = tree.grow_to(node2)
+            path = tree.path(node2)
+            if stats is not None:
+                stats.update(cache=kind, expanded=expanded, pushes=tree.pushes, stale_pops=tree.stalePops,
+                             peak_agenda=tree.peakAgenda, peak_path_nodes=len(tree.parents))
+        else:
+            self.misses += 1
+            path, expanded = search()
+            if stats is not None:
+                stats['cache'] = 'miss'
+
+        self.evictions += self._touch(self.paths, key, None if path is None else tuple(path), self.max_entries)
+        return path, expanded
+
+
+def enable(map_rep, max_entries=DEFAULT_MAX_ENTRIES, max_trees=DEFAULT_MAX_TREES):
+    """
+    Turn on query caching for a map
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation, or
+                 any other map object accepted by the search functions
+        max_entries: most paths kept
+        max_trees: most shortest path trees kept; 0 turns trees off
+
+    Returns:
+        the map with a QueryCache attached as map_rep.query_cache (a
+        MapRepresentation if a plain tuple was passed in)
+    """
+    graph = lab._as_graph(map_rep)
+    graph.query_cache = QueryCache(max_entries, max_trees)
+    return graph
+
+
+def disable(map_rep):
+    """
+    Turn off query caching for a map
+    """
+    if hasattr(map_rep, 'query_cache'):
+        del map_rep.query_cache
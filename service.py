@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+"""
+Asyncio HTTP/JSON routing service with request micro-batching
+
+The map is loaded once and shared by every request.  Requests that arrive
+close together are grouped into a micro-batch (at most max_batch requests,
+collected for at most batch_window seconds after the first one), and every
+batch is answered in one call off the event loop, in an executor:
+
+    snapping     every distinct location of the batch is snapped once
+    searching    queries of the same kind from the same start node share one
+                 shortest path tree (see route_cache.ShortestPathTree) that
+                 is grown until it has settled all of their ends; other
+                 queries go through lab._route as usual, so contraction
+                 hierarchies, landmarks, components and query caches
+                 attached to the map are still used
+
+The default executor has a single thread: the map and what is attached to it
+(query caches, search buffers) are not safe to use from several threads at
+once, and the searches hold the GIL anyway.  The event loop stays free to
+accept and parse requests while a batch is searched.
+
+Endpoints:
+
+    POST /route   {"kind": "fast" or "short", "start": [lat, lon],
+                   "end": [lat, lon]}
+                  -> {"path": [[lat, lon], ...]} ({"path": null} if there
+                  is no path)
+    GET /stats    counters of the service (see RoutingService.counters)
+    GET /info     number of nodes and bounding box of the map
+
+Run from the directory that holds lab.py:
+
+    python service.py resources/cambridge.nodes resources/cambridge.ways --port 8080
+    python loadgen.py --port 8080
+"""
+
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import collections
+import concurrent.futures
+
+import lab
+import graph_cache
+import instrument
+import route_cache
+
+
+DEFAULT_BATCH_WINDOW = 0.002
+DEFAULT_MAX_BATCH = 64
+
+# Latencies kept for the percentiles reported by RoutingService.counters
+LATENCY_WINDOW = 10000
+
+KIND_METRICS = {'short': 'distance', 'fast': 'time'}
+
+# Largest request body read, in bytes
+MAX_BODY_BYTES = 64 << 10
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+def _shares_trees(graph, metric):
+    """
+    Check whether queries from the same start node should share a shortest
+    path tree, rather than go through lab._route one by one
+
+    Maps with a contraction hierarchy for the metric answer single queries
+    faster than a tree, query caches share trees themselves, and simplified
+    maps need their chains expanded.
+    """
+    return (metric not in getattr(graph, 'hierarchies', {}) and getattr(graph, 'query_cache', None) is None
+            and not hasattr(graph, 'pin'))
+
+
+def answer_batch(graph, queries, counters=None):
+    """
+    Answer a batch of routing queries, sharing work between them
+
+    Parameters:
+        graph: map object with the methods of lab.MapRepresentation
+        queries: list of (kind, loc1, loc2) tuples, where kind is 'short' or
+                 'fast' and the locations are (latitude, longitude) tuples
+        counters: optional dictionary whose 'snaps' (locations snapped),
+                  'searches' (searches run) and 'shared' (queries answered by
+                  a tree grown for another query) entries are increased
+
+    Returns:
+        a list with the path of every query, as a list of (latitude,
+        longitude) tuples, None where there is no path, or the exception
+        raised answering it, so one bad query does not fail the others
+    """
+    if counters is None:
+        counters = {}
+
+    # Snaps every distinct location once
+    snapped = {}
+    for kind, loc1, loc2 in queries:
+        for loc in (loc1, loc2):
+            if loc not in snapped:
+                try:
+                    snapped[loc] = graph.nearest(loc)[0]
+                except Exception as error:
+                    snapped[loc] = error
+    counters['snaps'] = counters.get('snaps', 0) + len(snapped)
+
+    # Groups the queries by metric and start node
+    results = [None] * len(queries)
+    groups = collections.OrderedDict()
+    for position, (kind, loc1, loc2) in enumerate(queries):
+        node1, node2 = snapped[loc1], snapped[loc2]
+        for node in (node1, node2):
+            if isinstance(node, Exception):
+                results[position] = node
+        if results[position] is None:
+            groups.setdefault((KIND_METRICS[kind], node1), []).append((position, node2))
+
+    components = getattr(graph, 'components', None)
+    for (metric, node1), members in groups.items():
+        if len(members) > 1 and _shares_trees(graph, metric):
+            tree = route_cache.ShortestPathTree(graph.edges(metric), node1)
+            counters['searches'] = counters.get('searches', 0) + 1
+            for position, node2 in members:
+                if components is not None and not components.reachable(node1, node2):
+                    continue
+                if node2 in tree.settled:
+                    counters['shared'] = counters.get('shared', 0) + 1
+                try:
+                    tree.grow_to(node2)
+                    path = tree.path(node2)
+                    results[position] = None if path is None else [graph.location(node) for node in path]
+                except Exception as error:
+                    results[position] = error
+        else:
+            for position, node2 in members:
+                counters['searches'] = counters.get('searches', 0) + 1
+                try:
+                    path, expanded = lab._route(graph, node1, node2, metric)
+                    results[position] = None if path is None else [graph.location(node) for node in path]
+                except Exception as error:
+                    results[position] = error
+    return results
+
+
+def _location(value):
+    """
+    Return a [latitude, longitude] pair from a request as a tuple of floats,
+    raising a ValueError unless it holds two finite numbers in range
+    """
+    if not isinstance(value, list) or len(value) != 2:
+        raise ValueError('locations are [latitude, longitude]')
+    for part in value:
+        if isinstance(part, bool) or not isinstance(part, (int, float)) or not math.isfinite(part):
+            raise ValueError('locations are [latitude, longitude]')
+    lat, lon = float(value[0]), float(value[1])
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+        raise ValueError('location out of range: [%r, %r]' % (lat, lon))
+    return lat, lon
+
+
+def _content_length(headers):
+    """
+    Return the body length declared by a request's headers (0 when there is
+    none), or None if it is not a non-negative integer
+    """
+    length = headers.get('content-length', '0')
+    try:
+        length = int(length)
+    except ValueError:
+        return None
+    return length if length >= 0 else None
+
+
+class RoutingService:
+    """
+    Micro-batching front end to one map
+
+    Attributes:
+        graph: the map every request is answered on
+        batch_window: seconds a batch stays open after its first request
+        max_batch: most requests in one batch
+        executor: executor the batches are answered in
+        started: time.perf_counter() when the service was made
+    """
+
+    def __init__(self, map_rep, batch_window=DEFAULT_BATCH_WINDOW, max_batch=DEFAULT_MAX_BATCH, executor=None):
+        self.graph = lab._as_graph(map_rep)
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.executor = executor
+        self.started = time.perf_counter()
+
+        self.queue = None
+        self.batcher = None
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.batchCounters = {}
+        self.requests = 0
+        self.answered = 0
+        self.failed = 0
+        self.batches = 0
+
+    def _ensure_batcher(self):
+        if self.batcher is None:
+            self.queue = asyncio.Queue()
+            self.batcher = asyncio.ensure_future(self._run_batches())
+
+    async def route(self, kind, loc1, loc2):
+        """
+        Answer one query as part of the next batch
+
+        Parameters:
+            kind: 'short' or 'fast'
+            loc1, loc2: (latitude, longitude) tuples
+
+        Returns:
+            the path as a list of (latitude, longitude) tuples, or None
+        """
+        if kind not in KIND_METRICS:
+            raise ValueError('unknown query kind: %r' % (kind,))
+        self._ensure_batcher()
+        self.requests += 1
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(((kind, tuple(loc1), tuple(loc2)), future, time.perf_counter()))
+        return await future
+
+    async def _run_batches(self):
+        """
+        Collect requests into batches and answer them, forever
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            queries = [query for query, future, arrived in batch]
+            self.batches += 1
+            try:
+                paths = await loop.run_in_executor(self.executor, answer_batch, self.graph, queries,
+                                                   self.batchCounters)
+            except Exception as error:
+                self.failed += len(batch)
+                for query, future, arrived in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            finished = time.perf_counter()
+            for (query, future, arrived), path in zip(batch, paths):
+                if isinstance(path, Exception):
+                    self.failed += 1
+                    if not future.done():
+                        future.set_exception(path)
+                    continue
+                self.latencies.append(finished - arrived)
+                self.answered += 1
+                if not future.done():
+                    future.set_result(path)
+
+    def counters(self):
+        """
+        Return the counters of the service as a dictionary: requests,
+        answered, failed, batches, mean_batch, snaps, searches, shared,
+        requests_per_second (answered over the service's lifetime) and
+        latency_ms (percentiles of the most recent latencies)
+        """
+        uptime = time.perf_counter() - self.started
+        latencies = list(self.latencies)
+        result = {
+            'requests': self.requests,
+            'answered': self.answered,
+            'failed': self.failed,
+            'batches': self.batches,
+            'mean_batch': (self.answered + self.failed) / self.batches if self.batches else 0.0,
+            'requests_per_second': self.answered / uptime if uptime > 0 else 0.0,
+            'latency_ms': {'p%d' % percent: None if not latencies else instrument.percentile(latencies, percent) * 1e3
+                           for percent in instrument.DEFAULT_PERCENTILES},
+        }
+        for key in ('snaps', 'searches', 'shared'):
+            result[key] = self.batchCounters.get(key, 0)
+        return result
+
+    def info(self):
+        """
+        Return the number of nodes and the bounding box of the map
+        """
+        locations = [self.graph.location(node) for node in self.graph.node_handles()]
+        lats = [lat for lat, lon in locations]
+        lons = [lon for lat, lon in locations]
+        return {'nodes': len(locations), 'bounds': [[min(lats), min(lons)], [max(lats), max(lons)]]}
+
+    async def _dispatch(self, method, target, body):
+        """
+        Answer one HTTP request
+
+        Returns:
+            a tuple (status, JSON-serializable result)
+        """
+        if target == '/route':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            try:
+                request = json.loads(body)
+                kind = request.get('kind', 'fast')
+                loc1 = _location(request['start'])
+                loc2 = _location(request['end'])
+                path = await self.route(kind, loc1, loc2)
+            except (ValueError, KeyError, TypeError, AttributeError) as error:
+                return 400, {'error': str(error) or type(error).__name__}
+            return 200, {'path': None if path is None else [list(loc) for loc in path]}
+        if target in ('/stats', '/info'):
+            if method != 'GET':
+                return 405, {'error': 'use GET'}
+            return 200, self.counters() if target == '/stats' else self.info()
+        return 404, {'error': 'no such endpoint: %s' % target}
+
+    async def handle(self, reader, writer):
+        """
+        Serve the HTTP/1.1 requests of one connection, keeping it open until
+        the client closes it or asks to
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keepAlive = (headers.get('connection', '').lower() != 'close'
+                             and version.upper() != 'HTTP/1.0')
+
+                # Bodies of a bad or too large length are not read, so the
+                # connection is closed after the reply
+                length = _content_length(headers)
+                if length is None:
+                    status, result = 400, {'error': 'bad Content-Length: %r' % (headers['content-length'],)}
+                    keepAlive = False
+                elif length > MAX_BODY_BYTES:
+                    status, result = 413, {'error': 'body over %d bytes' % MAX_BODY_BYTES}
+                    keepAlive = False
+                else:
+                    body = await reader.readexactly(length)
+                    try:
+                        status, result = await self._dispatch(method, target, body)
+                    except Exception as error:
+                        status, result = 500, {'error': str(error) or type(error).__name__}
+                payload = json.dumps(result).encode()
+                writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                              'Connection: %s\r\n\r\n' % (status, STATUS_TEXT[status], len(payload),
+                                                          'keep-alive' if keepAlive else 'close')).encode()
+                             + payload)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """
+        Start listening for HTTP requests
+
+        Returns:
+            the asyncio server
+        """
+        self._ensure_batcher()
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def close(self):
+        """
+        Stop the batcher and the executor
+        """
+        if self.batcher is not None:
+            self.batcher.cancel()
+            try:
+                await self.batcher
+            except asyncio.CancelledError:
+                pass
+            self.batcher = None
+        self.executor.shutdown(wait=True)
+
+
+async def serve(map_rep, host='127.0.0.1', port=8080, **options):
+    """
+    Serve a map over HTTP until cancelled
+
+    Parameters:
+        map_rep: the map to route on
+        host, port: address to listen on
+        options: batch_window, max_batch and executor, as for RoutingService
+    """
+    service = RoutingService(map_rep, **options)
+    server = await service.start(host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve routing queries over HTTP.')
+    parser.add_argument('nodes_filename')
+    parser.add_argument('ways_filename')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--batch-window', type=float, default=DEFAULT_BATCH_WINDOW * 1e3,
+                        help='milliseconds a batch stays open (default %(default)s)')
+    parser.add_argument('--max-batch', type=int, default=DEFAULT_MAX_BATCH,
+                        help='most requests in one batch (default %(default)s)')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    map_rep = graph_cache.load_map(args.nodes_filename, args.ways_filename)
+    print('loaded %d nodes in %.2f s, serving on http://%s:%d' % (len(map_rep), time.perf_counter() - start,
+                                                                 args.host, args.port), file=sys.stderr)
+    try:
+        asyncio.run(serve(map_rep, args.host, args.port, batch_window=args.batch_window / 1e3,
+                          max_batch=args.max_batch))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,575 @@
+"""
+Graph simplification: collapsing chains of shape points into single edges
+
+Most nodes of an OSM extract are shape points in the middle of a way, with
+a single way in and a single way out.  A search still has to push and pop
+every one of them.  SimplifiedMap keeps only the junctions (every other
+node) as search nodes, and replaces every chain of shape points between two
+junctions by one edge carrying the summed length and travel time.  The
+shape points of every chain are kept, in order, so paths found on the
+junctions can be expanded back into the full list of nodes.
+
+Searches may start or end at a shape point (locations are still snapped to
+the closest node of the full map).  For such queries the search runs on a
+view of the map (see SimplifiedMap.pin) with extra edges from the chain's
+junctions to the shape point and back.
+
+Typical use:
+
+    map_rep = lab.build_internal_representation(nodes_filename, ways_filename)
+    map_rep = simplify.simplify(map_rep)
+    lab.find_fast_path(map_rep, loc1, loc2)   # same path, far fewer nodes
+"""
+
+from array import array
+
+import lab
+
+
+METRICS = ('distance', 'time')
+
+
+def _is_shape_point(node, children, parents):
+    """
+    Check whether a node is the middle of a chain: either one edge in from u
+    and one edge out to w (a one-way street), or edges both ways to exactly
+    two nodes (a two-way street)
+    """
+    if node in children:
+        return False
+    if len(children) == 1 and len(parents) == 1:
+        return children != parents
+    return len(children) == 2 and children == parents
+
+
+class SimplifiedMap:
+    """
+    Map whose search graph only holds the junctions of another map
+
+    Chain c goes from junction chainStarts[c] to junction chainEnds[c]
+    through the shape points chainNodes[chainOffsets[c]] to
+    chainNodes[chainOffsets[c + 1] - 1].  chainDistances and chainTimes hold
+    the cost from the start of the chain to each of those shape points, and
+    chainLengths and chainTravelTimes the cost of the whole chain.
+
+    Attributes:
+        base: the full map, which still answers internal_id, external_id,
+              location and nearest, so every node can be snapped to and
+              located
+        junctions: the handles of the nodes kept for searching
+        outgoing: dictionary mapping a junction to the chains leaving it
+        memberships: dictionary mapping a shape point to a list of
+                     (chain, position) pairs, where position 1 is the first
+                     shape point of the chain
+        edgeWeights: dictionary mapping 'distance' and 'time' to the
+                     (junction, cost) lists of every junction
+        reverseWeights: like edgeWeights for the incoming edges, built the
+                        first time a bidirectional search needs them
+        hierarchies, landmarks: as for lab.MapRepresentation, built over the
+                                junctions
+        version: as for lab.MapRepresentation
+    """
+
+    def __init__(self, base):
+        """
+        Find the junctions and chains of a map
+
+        Parameters:
+            base: map object with the methods of lab.MapRepresentation
+        """
+        self.base = base
+        handles = list(base.node_handles())
+
+        # Loads both costs of every edge, and the parents of every node
+        edges = self._base_edges()
+        children = {}
+        parents = {}
+        for node in handles:
+            children[node] = edges(node)
+            for child, _, _ in children[node]:
+                parents.setdefault(child, set()).add(node)
+
+        isShapePoint = {node for node in handles if _is_shape_point(
+            node, {child for child, _, _ in children[node]}, parents.get(node, set()))}
+        self.junctions = [node for node in handles if node not in isShapePoint]
+
+        self.chainStarts = array('q')
+        self.chainEnds = array('q')
+        self.chainOffsets = array('q', [0])
+        self.chainNodes = array('q')
+        self.chainDistances = array('d')
+        self.chainTimes = array('d')
+        self.chainLengths = array('d')
+        self.chainTravelTimes = array('d')
+        self.outgoing = {}
+        self.memberships = {}
+
+        for junction in self.junctions:
+            self._walk_chains(junction, children.__getitem__, isShapePoint)
+
+        # Chains of shape points that form a loop with no junction on it get
+        # one of their nodes promoted to a junction
+        for node in handles:
+            if node in isShapePoint and node not in self.memberships:
+                isShapePoint.discard(node)
+                self.junctions.append(node)
+                self._walk_chains(node, children.__getitem__, isShapePoint)
+
+        self.edgeWeights = {}
+        for metric, totals in (('distance', self.chainLengths), ('time', self.chainTravelTimes)):
+            self.edgeWeights[metric] = {
+                junction: [(self.chainEnds[chain], totals[chain]) for chain in chains]
+                for junction, chains in self.outgoing.items()}
+        self.reverseWeights = None
+        self.hierarchies = {}
+        self.landmarks = {}
+        self.version = 0
+
+    def _base_edges(self):
+        """
+        Return a function that gives the (child, distance, time) edges
+        leaving a node of the full map
+        """
+        distances, times = self.base.edges('distance'), self.base.edges('time')
+
+        def edges(node):
+            return [(child, distance, time) for (child, distance), (_, time) in zip(distances(node), times(node))]
+
+        return edges
+
+    def _walk_chains(self, junction, edges, isShapePoint):
+        """
+        Record every chain leaving a junction
+        """
+        chains = self.outgoing.setdefault(junction, [])
+        for child, distance, time in edges(junction):
+            chains.append(self._walk_chain(junction, child, distance, time, edges, isShapePoint))
+
+    def _walk_chain(self, junction, child, distance, time, edges, isShapePoint):
+        """
+        Record the chain leaving a junction by its edge to child, and return
+        the chain's number
+        """
+        chain = len(self.chainStarts)
+        previous, node = junction, child
+        while node in isShapePoint:
+            self.chainNodes.append(node)
+            self.chainDistances.append(distance)
+            self.chainTimes.append(time)
+            self.memberships.setdefault(node, []).append(
+                (chain, len(self.chainNodes) - self.chainOffsets[chain]))
+            # Follows the one edge that does not lead back
+            for nextNode, edgeDistance, edgeTime in edges(node):
+                if nextNode != previous:
+                    break
+            previous, node = node, nextNode
+            distance += edgeDistance
+            time += edgeTime
+        self.chainStarts.append(junction)
+        self.chainEnds.append(node)
+        self.chainOffsets.append(len(self.chainNodes))
+        self.chainLengths.append(distance)
+        self.chainTravelTimes.append(time)
+        return chain
+
+    def internal_id(self, node):
+        return self.base.internal_id(node)
+
+    def external_id(self, node):
+        return self.base.external_id(node)
+
+    def location(self, node):
+        return self.base.location(node)
+
+    def nearest(self, loc, k=1):
+        return self.base.nearest(loc, k)
+
+    @property
+    def spatial_index(self):
+        return self.base.spatial_index
+
+    def build_spatial_index(self, kernel=None):
+        self.base.build_spatial_index(kernel)
+
+    def node_handles(self):
+        """
+        Return the handles of the junctions
+        """
+        return list(self.junctions)
+
+    def edges(self, metric):
+        """
+        Return a function that gives the (junction, cost) edges leaving a
+        junction, one per chain
+        """
+        weights = self.edgeWeights[metric]
+
+        def edges(node):
+            return weights.get(node, ())
+
+        return edges
+
+    def reverse_edges(self, metric):
+        """
+        Return a function that gives the (junction, cost) edges coming into
+        a junction, one per chain
+        """
+        if self.reverseWeights is None:
+            self.reverseWeights = {}
+            for kind, weights in self.edgeWeights.items():
+                reverse = {}
+                for node, children in weights.items():
+                    for child, cost in children:
+                        reverse.setdefault(child, []).append((node, cost))
+                self.reverseWeights[kind] = reverse
+        weights = self.reverseWeights[metric]
+
+        def edges(node):
+            return weights.get(node, ())
+
+        return edges
+
+    def edge_speed(self, node, child):
+        return self.base.edge_speed(node, child)
+
+    def unindex(self, nodes):
+        self.base.unindex(nodes)
+
+    def update_edges(self, changes):
+        """
+        Change the speed of edges of the full map or remove them, and repair
+        the chains
+
+        Speed changes only touch the travel times of the chains holding the
+        changed edges.  Removals split the chains holding the removed edges
+        (see _split_chains).
+
+        Parameters:
+            changes: as for lab.MapRepresentation.update_edges, with the
+                     handles of the full map
+
+        Returns:
+            a dictionary with the number of edges 'changed' and 'removed',
+            of chains 'repaired' and 'rebuilt', and of shape points made
+            junctions ('promoted')
+        """
+        report = self.base.update_edges(changes)
+        removed = [edge for edge, speed in changes.items() if speed is None]
+        report['promoted'], report['rebuilt'] = self._split_chains(removed) if removed else (0, 0)
+
+        chains = set()
+        for (node, child), speed in changes.items():
+            if speed is None:
+                continue
+            if node in self.memberships:
+                chains.update(chain for chain, position in self.memberships[node]
+                              if self.chain_node(chain, position + 1) == child)
+            else:
+                chains.update(chain for chain in self.outgoing.get(node, ())
+                              if self.chain_node(chain, 1) == child)
+        for chain in chains:
+            self._repair_times(chain)
+        report['repaired'] = len(chains)
+        self.version += 1
+        return report
+
+    def _split_chains(self, removed):
+        """
+        Make the shape points at either end of removed edges junctions, and
+        walk again the chains that went through them or through a removed
+        edge
+
+        New junctions are numbered after the old ones, and junctions are never
+        turned back into shape points, so hierarchies and landmark tables
+        keep the numbers of their nodes.  Landmark tables get entries for the
+        new junctions from the chains they were on.  The retired chains stay
+        in the chain arrays, unused.
+
+        Returns:
+            a tuple (number of new junctions, number of chains walked again)
+        """
+        promoted = list(dict.fromkeys(node for edge in removed for node in edge if node in self.memberships))
+        for metric, table in self.landmarks.items():
+            table.add_nodes([(node, self._costs_to(node, metric), self._costs_from(node, metric))
+                             for node in promoted])
+
+        # Retires the chains through the new junctions or a removed edge, and
+        # every chain leaving the same junction by the same edge
+        retired = {chain for node in promoted for chain, position in self.memberships[node]}
+        for node, child in removed:
+            retired.update(chain for chain in self.outgoing.get(node, ()) if self.chain_node(chain, 1) == child)
+        starts = {(self.chainStarts[chain], self.chain_node(chain, 1)) for chain in retired}
+        for junction, first in starts:
+            retired.update(chain for chain in self.outgoing[junction] if self.chain_node(chain, 1) == first)
+
+        shapePoints = set()
+        for chain in retired:
+            self.outgoing[self.chainStarts[chain]].remove(chain)
+            for position in range(1, self.chain_size(chain)):
+                node = self.chain_node(chain, position)
+                memberships = self.memberships[node]
+                memberships.remove((chain, position))
+                if not memberships:
+                    del self.memberships[node]
+                shapePoints.add(node)
+        shapePoints.difference_update(promoted)
+        self.junctions.extend(promoted)
+
+        # The shape points of the retired chains are the only ones the new
+        # chains can go through
+        edges = self._base_edges()
+        count = len(self.chainStarts)
+        for junction, first in starts:
+            self.outgoing[junction].extend(self._walk_chain(junction, child, distance, time, edges, shapePoints)
+                                           for child, distance, time in edges(junction) if child == first)
+        for node in promoted:
+            self._walk_chains(node, edges, shapePoints)
+
+        for junction in {junction for junction, first in starts}.union(promoted):
+            for metric, totals in (('distance', self.chainLengths), ('time', self.chainTravelTimes)):
+                self.edgeWeights[metric][junction] = [(self.chainEnds[chain], totals[chain])
+                                                      for chain in self.outgoing[junction]]
+        self.reverseWeights = None
+        return len(promoted), len(self.chainStarts) - count
+
+    def _costs_to(self, node, metric):
+        """
+        Return the (junction, cost) pairs from the start junction of every
+        chain through a shape point to it
+        """
+        return [(self.chainStarts[chain], self.chain_cost(chain, position, metric))
+                for chain, position in self.memberships[node]]
+
+    def _costs_from(self, node, metric):
+        """
+        Return the (junction, cost) pairs from a shape point to the end
+        junction of every chain through it
+        """
+        return [(self.chainEnds[chain],
+                 self.chain_cost(chain, self.chain_size(chain), metric) - self.chain_cost(chain, position, metric))
+                for chain, position in self.memberships[node]]
+
+    def _repair_times(self, chain):
+        """
+        Recompute the travel times along a chain from the full map, and the
+        time of the chain's edge between its junctions
+        """
+        times = self.base.edges('time')
+        start = self.chainOffsets[chain]
+        total = 0.0
+        node = self.chainStarts[chain]
+        for position in range(1, self.chain_size(chain) + 1):
+            nextNode = self.chain_node(chain, position)
+            total += next(cost for child, cost in times(node) if child == nextNode)
+            if position < self.chain_size(chain):
+                self.chainTimes[start + position - 1] = total
+            node = nextNode
+        self.chainTravelTimes[chain] = total
+
+        junction = self.chainStarts[chain]
+        index = self.outgoing[junction].index(chain)
+        self.edgeWeights['time'][junction][index] = (self.chainEnds[chain], total)
+        self.reverseWeights = None
+
+    def chain_node(self, chain, position):
+        """
+        Return the node at a position of a chain: 0 is the start junction,
+        1 to m the shape points and m + 1 the end junction
+        """
+        start = self.chainOffsets[chain]
+        if position == 0:
+            return self.chainStarts[chain]
+        if start + position - 1 == self.chainOffsets[chain + 1]:
+            return self.chainEnds[chain]
+        return self.chainNodes[start + position - 1]
+
+    def chain_cost(self, chain, position, metric):
+        """
+        Return the cost from the start of a chain to a position on it
+        """
+        start = self.chainOffsets[chain]
+        if position == 0:
+            return 0.0
+        if start + position - 1 == self.chainOffsets[chain + 1]:
+            return (self.chainLengths if metric == 'distance' else self.chainTravelTimes)[chain]
+        return (self.chainDistances if metric == 'distance' else self.chainTimes)[start + position - 1]
+
+    def chain_size(self, chain):
+        """
+        Return the position of the end junction of a chain
+        """
+        return self.chainOffsets[chain + 1] - self.chainOffsets[chain] + 1
+
+    def pin(self, node1, node2, metric):
+        """
+        Return a view of this map on which node1 and node2 can be searched
+        from and to even if they are shape points
+        """
+        return _PinnedMap(self, node1, node2, metric)
+
+    def nbytes(self):
+        """
+        Return the number of bytes held by the chain arrays
+        """
+        return sum(len(values) * values.itemsize for values in (
+            self.chainStarts, self.chainEnds, self.chainOffsets, self.chainNodes,
+            self.chainDistances, self.chainTimes, self.chainLengths, self.chainTravelTimes))
+
+
+class _PinnedMap:
+    """
+    View of a SimplifiedMap for one query, with extra edges to and from the
+    query's shape points
+
+    A shape point at position i of chain c gets an edge from the chain's
+    start junction (costing the first i steps of the chain) and an edge to
+    its end junction (costing the rest).  Two pinned shape points on the
+    same chain also get an edge between them.
+    """
+
+    def __init__(self, simplified, node1, node2, metric):
+        self.simplified = simplified
+        self.metric = metric
+        self.segments = {}
+        self.forward = {}
+        self.reverse = {}
+        self.landmarks = simplified.landmarks
+
+        pins = {}
+        for node in (node1, node2):
+            for chain, position in simplified.memberships.get(node, ()):
+                pins.setdefault(chain, []).append(position)
+                self._add(chain, 0, position)
+                self._add(chain, position, simplified.chain_size(chain))
+        for chain, positions in pins.items():
+            if len(positions) == 2 and positions[0] != positions[1]:
+                self._add(chain, min(positions), max(positions))
+
+        # A hierarchy only knows the junctions, so queries from and to shape
+        # points start and end it at the junctions of their chains
+        hierarchy = simplified.hierarchies.get(metric)
+        if not pins or hierarchy is None:
+            self.hierarchies = simplified.hierarchies
+        else:
+            self.hierarchies = {metric: _PinnedHierarchy(self, hierarchy)}
+
+    def _add(self, chain, first, last):
+        """
+        Add the edge covering positions first to last of a chain, unless an
+        edge between the same nodes is already as cheap
+        """
+        simplified = self.simplified
+        node1 = simplified.chain_node(chain, first)
+        node2 = simplified.chain_node(chain, last)
+        cost = simplified.chain_cost(chain, last, self.metric) - simplified.chain_cost(chain, first, self.metric)
+        known = self.segments.get((node1, node2))
+        if known is not None and known[0] <= cost:
+            return
+        if known is not None:
+            self.forward[node1].remove((node2, known[0]))
+            self.reverse[node2].remove((node1, known[0]))
+        self.segments[(node1, node2)] = (cost, chain, first, last)
+        self.forward.setdefault(node1, []).append((node2, cost))
+        self.reverse.setdefault(node2, []).append((node1, cost))
+
+    def location(self, node):
+        return self.simplified.location(node)
+
+    def edges(self, metric):
+        return self._with_extra(self.simplified.edges(metric), self.forward)
+
+    def reverse_edges(self, metric):
+        return self._with_extra(self.simplified.reverse_edges(metric), self.reverse)
+
+    @staticmethod
+    def _with_extra(base, extra):
+        def edges(node):
+            more = extra.get(node)
+            if more is None:
+                return base(node)
+            return list(base(node)) + more
+
+        return edges
+
+    def expand(self, path):
+        """
+        Replace every edge of a path found on this view by the nodes of the
+        chain it stands for
+        """
+        if path is None:
+            return None
+        simplified = self.simplified
+        result = [path[0]]
+        for node1, node2 in zip(path, path[1:]):
+            segment = self.segments.get((node1, node2))
+            if segment is None:
+                # Junction to junction: the cheapest chain between them
+                totals = simplified.chainLengths if self.metric == 'distance' else simplified.chainTravelTimes
+                chain = min((chain for chain in simplified.outgoing[node1]
+                             if simplified.chainEnds[chain] == node2), key=totals.__getitem__)
+                first, last = 0, simplified.chain_size(chain)
+            else:
+                cost, chain, first, last = segment
+            result.extend(simplified.chain_node(chain, position) for position in range(first + 1, last + 1))
+        return result
+
+
+class _PinnedHierarchy:
+    """
+    Contraction hierarchy of a SimplifiedMap answering the queries of a
+    _PinnedMap
+
+    A shape point at an end of a query is replaced by the junctions its
+    pinned edges lead to (or come from), at the cost of those edges.  Two
+    shape points on the same chain can also be joined by the edge between
+    them, which the hierarchy does not know, so it is compared with the
+    path the hierarchy finds.
+    """
+
+    def __init__(self, view, hierarchy):
+        self.view = view
+        self.hierarchy = hierarchy
+
+    def query(self, node1, node2, stats=None):
+        """
+        Return the cheapest path between two node handles of the view, like
+        ch.ContractionHierarchy.query
+        """
+        view = self.view
+        memberships = view.simplified.memberships
+        if node1 == node2:
+            if stats is not None:
+                stats.update(expanded=0, pushes=0, stale_pops=0, peak_agenda=0, peak_path_nodes=0)
+            return [node1], 0
+        sources = view.forward.get(node1, ()) if node1 in memberships else None
+        targets = view.reverse.get(node2, ()) if node2 in memberships else None
+        path, expanded = self.hierarchy.query(node1, node2, stats, sources, targets)
+
+        direct = view.segments.get((node1, node2))
+        if direct is not None and (path is None or direct[0] < self._cost(path)):
+            path = [node1, node2]
+        return path, expanded
+
+    def _cost(self, path):
+        """
+        Return the cost of a path over the edges of the view
+        """
+        edges = self.view.edges(self.view.metric)
+        return sum(min(cost for child, cost in edges(node1) if child == node2)
+                   for node1, node2 in zip(path, path[1:]))
+
+
+def simplify(map_rep):
+    """
+    Collapse the chains of shape points of a map
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation, or a
+                 compact.CompactMap
+
+    Returns:
+        a SimplifiedMap that can be passed to the search functions in lab.py
+        in place of map_rep.  Contraction hierarchies and landmark tables
+        should be prepared on the SimplifiedMap itself.
+    """
+    return SimplifiedMap(lab._as_graph(map_rep))
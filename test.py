@@ -0,0 +1,686 @@
+#!/usr/bin/env python3
+"""
+Tests for the routing extensions, on a small map written as .nodes and
+.ways files
+
+The map is a lattice of streets: every row of nodes is a way, and every
+fourth column is a cross street, so the nodes of a row between two cross
+streets are shape points.  One row and one column are one-way, one row is
+faster, a footway and some unused nodes are left out of the map, and a
+short street far from the lattice is a component of its own.
+
+    python -m pytest test.py
+"""
+
+import csv
+import json
+import heapq
+import asyncio
+import pickle
+import random
+import runpy
+import tracemalloc
+
+import pytest
+
+import lab
+import compact
+import ingest
+import ch
+import landmarks
+import matrix
+import simplify
+import updates
+import components
+import tiles
+import alternatives
+import isochrone
+import traffic
+import instrument
+import route_cache
+import bulk
+import graph_cache
+import geo
+import service
+from util import great_circle_distance
+
+
+ROWS = 30
+COLUMNS = 48
+CROSS_EVERY = 4
+SEED = 6009
+
+
+def node_id(row, column):
+    return 1000 + row * COLUMNS + column
+
+
+def lattice():
+    """
+    Return the node and way records of the test map
+    """
+    rnd = random.Random(SEED)
+    nodes = [{'id': node_id(row, column), 'lat': 42.35 + row * 0.001 + rnd.uniform(-2e-4, 2e-4),
+              'lon': -71.1 + column * 0.0012 + rnd.uniform(-2e-4, 2e-4), 'tags': {}}
+             for row in range(ROWS) for column in range(COLUMNS)]
+    # The component of its own, and nodes no highway uses
+    nodes += [{'id': 90 + i, 'lat': 42.4 + i * 0.001, 'lon': -71.0, 'tags': {}} for i in range(3)]
+    nodes += [{'id': 80 + i, 'lat': 42.36, 'lon': -71.05 + i * 0.001, 'tags': {}} for i in range(3)]
+
+    ways = []
+    for row in range(ROWS):
+        tags = {'highway': 'residential'}
+        if row == 3:
+            tags['oneway'] = 'yes'
+        if row == 5:
+            tags = {'highway': 'primary', 'maxspeed_mph': 40}
+        ways.append({'id': 1 + row, 'nodes': [node_id(row, column) for column in range(COLUMNS)], 'tags': tags})
+    for column in range(0, COLUMNS, CROSS_EVERY):
+        tags = {'highway': 'tertiary'}
+        if column == 8:
+            tags['oneway'] = 'yes'
+        ways.append({'id': 500 + column, 'nodes': [node_id(row, column) for row in range(ROWS)], 'tags': tags})
+    ways.append({'id': 900, 'nodes': [90, 91, 92], 'tags': {'highway': 'residential'}})
+    ways.append({'id': 901, 'nodes': [80, 81, 82], 'tags': {'highway': 'footway'}})
+    return nodes, ways
+
+
+def write_map(directory):
+    """
+    Write the test map into a directory, returning the paths of its .nodes
+    and .ways files
+    """
+    paths = []
+    for suffix, records in zip(('nodes', 'ways'), lattice()):
+        path = str(directory / ('lattice.' + suffix))
+        with open(path, 'wb') as f:
+            for record in records:
+                pickle.dump(record, f)
+        paths.append(path)
+    return paths
+
+
+class Reference:
+    """
+    The edges of the test map, read straight from its records, and a plain
+    Dijkstra search over them
+
+    Changes are applied as for updates.apply_updates, so the expected costs
+    can follow a map that was changed.
+    """
+
+    def __init__(self, nodes, ways):
+        self.locations = {node['id']: (node['lat'], node['lon']) for node in nodes}
+        self.ids = {location: node for node, location in self.locations.items()}
+        self.speeds = {}
+        for way in ways:
+            tags = way['tags']
+            if tags.get('highway') not in lab.ALLOWED_HIGHWAY_TYPES:
+                continue
+            speed = tags.get('maxspeed_mph', lab.DEFAULT_SPEED_LIMIT_MPH[tags['highway']])
+            for node, child in zip(way['nodes'], way['nodes'][1:]):
+                self.speeds.setdefault(node, {})[child] = speed
+                if tags.get('oneway') != 'yes':
+                    self.speeds.setdefault(child, {})[node] = speed
+
+    def apply(self, changes):
+        for change in changes:
+            kind, start, end = change[:3]
+            if kind == 'close':
+                del self.speeds[start][end]
+            elif kind == 'speed':
+                self.speeds[start][end] = change[3]
+            else:
+                del self.speeds[end][start]
+
+    def cost(self, node, child, metric):
+        length = great_circle_distance(self.locations[node], self.locations[child])
+        return length if metric == 'distance' else length / self.speeds[node][child]
+
+    def path_cost(self, path, metric):
+        """
+        Return the cost of a path, failing if one of its edges does not exist
+        """
+        for node, child in zip(path, path[1:]):
+            assert child in self.speeds.get(node, ()), (node, child)
+        return sum(self.cost(node, child, metric) for node, child in zip(path, path[1:]))
+
+    def shortest(self, start, end, metric):
+        """
+        Return the cost of the best path from start to end, or None
+        """
+        settled = set()
+        queue = [(0.0, start)]
+        while queue:
+            cost, node = heapq.heappop(queue)
+            if node == end:
+                return cost
+            if node in settled:
+                continue
+            settled.add(node)
+            for child in self.speeds.get(node, ()):
+                if child not in settled:
+                    heapq.heappush(queue, (cost + self.cost(node, child, metric), child))
+        return None
+
+    def costs_from(self, start, metric):
+        """
+        Return a dictionary mapping every node reached from start to the
+        cost of the best path to it
+        """
+        costs = {}
+        queue = [(0.0, start)]
+        while queue:
+            cost, node = heapq.heappop(queue)
+            if node in costs:
+                continue
+            costs[node] = cost
+            for child in self.speeds.get(node, ()):
+                if child not in costs:
+                    heapq.heappush(queue, (cost + self.cost(node, child, metric), child))
+        return costs
+
+
+def query_pairs(count=40):
+    """
+    Return pairs of node IDs to route between: random lattice nodes, and
+    pairs within, into and out of the component of its own
+    """
+    rnd = random.Random(SEED)
+    nodes = [node_id(row, column) for row in range(ROWS) for column in range(COLUMNS)]
+    pairs = [(rnd.choice(nodes), rnd.choice(nodes)) for _ in range(count)]
+    return pairs + [(node_id(0, 0), 91), (91, node_id(2, 2)), (90, 92), (92, 90), (node_id(4, 7), node_id(4, 7))]
+
+
+def assert_cost(reference, path, node1, node2, metric):
+    """
+    Check that a path goes from node1 to node2 at the cost of the best one
+    """
+    expected = reference.shortest(node1, node2, metric)
+    if expected is None:
+        assert path is None, (node1, node2)
+    else:
+        assert path is not None and path[0] == node1 and path[-1] == node2, (node1, node2)
+        assert reference.path_cost(path, metric) == pytest.approx(expected, rel=1e-9), (node1, node2)
+
+
+def check_routes(graph, reference, heuristics=False, pairs=None, **options):
+    """
+    Compare the shortest and fastest paths found on a map with the reference
+    for every query pair
+    """
+    find_short = lab.find_short_path_nodes_heuristics if heuristics else lab.find_short_path_nodes
+    for node1, node2 in pairs or query_pairs():
+        assert_cost(reference, find_short(graph, node1, node2, **options), node1, node2, 'distance')
+        path = lab.find_fast_path(graph, reference.locations[node1], reference.locations[node2], **options)
+        assert_cost(reference, None if path is None else [reference.ids[location] for location in path],
+                    node1, node2, 'time')
+
+
+@pytest.fixture(scope='module')
+def map_files(tmp_path_factory):
+    return write_map(tmp_path_factory.mktemp('map'))
+
+
+@pytest.fixture
+def reference():
+    return Reference(*lattice())
+
+
+def load_map(map_files, kind):
+    """
+    Build the test map as a MapRepresentation ('dict') or a CompactMap
+    """
+    map_rep = lab._as_graph(lab.build_internal_representation(*map_files))
+    return map_rep if kind == 'dict' else compact.compact_representation(map_rep)
+
+
+@pytest.mark.parametrize('kind', ('dict', 'compact'))
+def test_plain_search_matches_reference(map_files, reference, kind):
+    check_routes(load_map(map_files, kind), reference)
+
+
+@pytest.mark.parametrize('kind', ('dict', 'compact'))
+def test_contraction_hierarchy_matches_reference(map_files, reference, kind):
+    graph = ch.prepare(load_map(map_files, kind))
+    check_routes(graph, reference)
+
+
+def test_contraction_hierarchy_file_round_trip(map_files, reference, tmp_path):
+    graph = load_map(map_files, 'compact')
+    hierarchy = ch.ContractionHierarchy(graph, 'distance')
+    ch.write_hierarchy(hierarchy, str(tmp_path / 'lattice.ch'))
+    fresh = load_map(map_files, 'compact')
+    ch.attach(fresh, ch.read_hierarchy(str(tmp_path / 'lattice.ch')))
+    for node1, node2 in query_pairs():
+        assert_cost(reference, lab.find_short_path_nodes(fresh, node1, node2), node1, node2, 'distance')
+
+
+def test_ingest_ceiling_bounds_peak_memory(map_files, monkeypatch):
+    # Checks run every 256 records, so little is allocated between two
+    # checks; the slack covers that, the file buffers and arrays growing by
+    # up to a sixteenth at a time
+    monkeypatch.setattr(ingest, 'PROGRESS_INTERVAL', 256)
+    tracemalloc.start()
+    try:
+        ingest.stream_compact_representation(*map_files)
+        unlimited = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    for fraction in (0.1, 0.25, 0.5, 0.75, 1.0, 1.5):
+        limit = int(unlimited * fraction)
+        tracemalloc.start()
+        try:
+            ingest.stream_compact_representation(*map_files, max_bytes=limit)
+            finished = True
+        except MemoryError:
+            finished = False
+        finally:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        assert peak <= limit + limit // 16 + 32768, fraction
+        assert finished or fraction < 1.5
+
+
+def test_graph_cache_rebuilds_when_settings_change(map_files, tmp_path, monkeypatch):
+    filename = str(tmp_path / 'lattice.graph')
+    assert not isinstance(graph_cache.load_map(*map_files, cache_filename=filename).targets, memoryview)
+    graph = graph_cache.load_map(*map_files, cache_filename=filename)
+    assert isinstance(graph.targets, memoryview)
+    check_routes(graph, Reference(*lattice()))
+
+    # Slower residential streets and footways as edges make the cache stale
+    monkeypatch.setattr(lab, 'DEFAULT_SPEED_LIMIT_MPH', dict(lab.DEFAULT_SPEED_LIMIT_MPH, residential=10, footway=3))
+    monkeypatch.setattr(lab, 'ALLOWED_HIGHWAY_TYPES', lab.ALLOWED_HIGHWAY_TYPES | {'footway'})
+    graph = graph_cache.load_map(*map_files, cache_filename=filename)
+    assert not isinstance(graph.targets, memoryview)
+    changed = Reference(*lattice())
+    check_routes(graph, changed, pairs=query_pairs() + [(80, 82)])
+    assert isinstance(graph_cache.load_map(*map_files, cache_filename=filename).targets, memoryview)
+
+
+def test_bulk_routing_keeps_query_order(map_files, reference):
+    graph = load_map(map_files, 'compact')
+    pairs = query_pairs(100)
+    queries = [(reference.locations[node1], reference.locations[node2]) for node1, node2 in pairs]
+    paths = bulk.route_many(graph, queries, 'fast', processes=3, chunk_size=7)
+    assert len(paths) == len(pairs)
+    for (node1, node2), path in zip(pairs, paths):
+        assert_cost(reference, None if path is None else [reference.ids[location] for location in path],
+                    node1, node2, 'time')
+    assert paths == bulk.route_many(graph, queries, 'fast', processes=1)
+
+
+def test_instrument_percentiles(map_files, reference):
+    assert instrument.percentile([], 50) is None
+    assert instrument.percentile([7.0], 99) == 7.0
+    values = [float(value) for value in range(101)]
+    random.Random(SEED).shuffle(values)
+    assert [instrument.percentile(values, percent) for percent in (0, 50, 90, 99, 100)] == [0, 50, 90, 99, 100]
+    assert instrument.percentile([1.0, 2.0, 4.0, 8.0], 50) == pytest.approx(3.0)
+    assert instrument.percentile([1.0, 2.0, 4.0, 8.0], 90) == pytest.approx(6.8)
+
+    # A recorder collects the statistics of every query it hands out
+    graph = load_map(map_files, 'compact')
+    pairs = query_pairs(20)
+    recorder = instrument.Recorder()
+    for node1, node2 in pairs:
+        lab.find_fast_path(graph, reference.locations[node1], reference.locations[node2], stats=recorder.new())
+    expanded = recorder.values('expanded')
+    assert len(expanded) == len(pairs) and len(recorder.values('search_time')) == len(pairs)
+    assert recorder.percentiles('expanded') == {percent: instrument.percentile(expanded, percent)
+                                                for percent in instrument.DEFAULT_PERCENTILES}
+    summary = recorder.summary()
+    assert summary['expanded']['count'] == len(pairs) and summary['expanded'][50] <= summary['expanded'][99]
+    assert instrument.Recorder(enabled=False).new() is None
+
+
+def test_lab_main_block_runs(tmp_path, monkeypatch, capsys):
+    # The block reads the mit and cambridge maps from resources/.  A street
+    # over nodes 1 to 9 stands in for mit, and the test map for cambridge.
+    mit = ([{'id': node, 'lat': 42.3575, 'lon': -71.0960 + node * 0.0002, 'tags': {}} for node in range(1, 10)],
+           [{'id': 1, 'nodes': list(range(1, 10)), 'tags': {'highway': 'residential'}}])
+    directory = tmp_path / 'resources'
+    directory.mkdir()
+    for name, records in (('mit', mit), ('cambridge', lattice())):
+        for suffix, items in zip(('nodes', 'ways'), records):
+            with open(str(directory / ('%s.%s' % (name, suffix))), 'wb') as f:
+                for item in items:
+                    pickle.dump(item, f)
+    monkeypatch.chdir(tmp_path)
+    runpy.run_path(lab.__file__, run_name='__main__')
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == str(mit[1][0])
+    assert lines[-5:] == ['{2: {1: 45}}', '{2: {1: 45, 8: 10}}', '1', '8', str(list(range(2, 9)))]
+
+
+@pytest.mark.parametrize('kind', ('dict', 'compact'))
+def test_landmarks_match_reference(map_files, reference, kind):
+    graph = landmarks.prepare(load_map(map_files, kind), count=4)
+    check_routes(graph, reference, heuristics=True)
+
+
+@pytest.mark.parametrize('kind', ('dict', 'compact'))
+@pytest.mark.parametrize('heuristics', (False, True))
+def test_bidirectional_search_matches_reference(map_files, reference, kind, heuristics):
+    check_routes(load_map(map_files, kind), reference, heuristics, bidirectional=True)
+
+
+def test_bidirectional_search_with_landmarks_matches_reference(map_files, reference):
+    graph = landmarks.prepare(load_map(map_files, 'compact'), count=4)
+    check_routes(graph, reference, heuristics=True, bidirectional=True)
+
+
+@pytest.mark.parametrize('kind, method', (('dict', 'dijkstra'), ('compact', 'dijkstra'), ('compact', 'buckets'),
+                                          ('simplified', 'dijkstra'), ('simplified', 'buckets')))
+@pytest.mark.parametrize('metric', ('distance', 'time'))
+def test_matrix_matches_reference(map_files, reference, kind, method, metric):
+    graph = load_map(map_files, 'dict' if kind == 'simplified' else kind)
+    if kind == 'simplified':
+        graph = simplify.simplify(graph)
+    if method == 'buckets':
+        ch.prepare(graph, (metric,))
+    # Shape points on the same chain, in both directions and on a one-way
+    # row, and origins repeated
+    pairs = query_pairs(12) + [(node_id(2, 1), node_id(2, 3)), (node_id(2, 3), node_id(2, 1)),
+                               (node_id(3, 3), node_id(3, 1)), (node_id(4, 7), node_id(4, 5))]
+    origins = [node1 for node1, node2 in pairs] + [node_id(2, 1)]
+    destinations = [node2 for node1, node2 in pairs] + [node_id(4, 7)]
+    costs = {node: reference.costs_from(node, metric) for node in origins}
+    for repeat in range(2):
+        result = matrix.travel_time_matrix(graph, [reference.locations[node] for node in origins],
+                                           [reference.locations[node] for node in destinations], metric, method)
+        for row, node1 in enumerate(origins):
+            for column, node2 in enumerate(destinations):
+                expected = costs[node1].get(node2, float('inf'))
+                assert result[row, column] == pytest.approx(expected, rel=1e-9), (node1, node2)
+        if method == 'dijkstra':
+            # The search over the map is made once and kept on it
+            search = graph.one_to_many
+            assert search[0] == metric and (repeat == 0 or search is kept)
+            kept = search
+
+
+@pytest.mark.parametrize('kind', ('dict', 'compact'))
+def test_simplified_map_matches_reference(map_files, reference, kind, monkeypatch):
+    graph = simplify.simplify(load_map(map_files, kind))
+    assert len(graph.node_handles()) < ROWS * COLUMNS
+    check_routes(graph, reference)
+    check_routes(graph, reference, bidirectional=True)
+    ch.prepare(graph)
+    landmarks.prepare(graph, count=4)
+
+    # The hierarchy answers queries from and to shape points too, including
+    # ones between shape points of the same chain, both ways along it
+    queries = []
+    query = ch.ContractionHierarchy.query
+    monkeypatch.setattr(ch.ContractionHierarchy, 'query',
+                        lambda self, *args: queries.append(args) or query(self, *args))
+    pairs = query_pairs() + [(node_id(2, 1), node_id(2, 3)), (node_id(2, 3), node_id(2, 1)),
+                             (node_id(3, 1), node_id(3, 3)), (node_id(3, 3), node_id(3, 1))]
+    check_routes(graph, reference, pairs=pairs)
+    assert len(queries) == 2 * sum(node1 != node2 for node1, node2 in pairs)
+    check_routes(graph, reference, heuristics=True)
+
+
+# Batches of changes applied one after the other: closures on a row between
+# cross streets and on a cross street, a slower and a faster edge, a street
+# made one-way, and a closure in both directions that cuts off the end of
+# the last row
+UPDATES = (
+    [('close', node_id(10, 1), node_id(10, 2)), ('close', node_id(12, 4), node_id(12, 5)),
+     ('speed', node_id(6, 9), node_id(6, 10), 5), ('oneway', node_id(7, 0), node_id(8, 0))],
+    [('close', node_id(29, 45), node_id(29, 46)), ('close', node_id(29, 46), node_id(29, 45)),
+     ('speed', node_id(5, 20), node_id(5, 21), 70)],
+    [('oneway', node_id(15, 2), node_id(15, 1))],
+)
+
+
+@pytest.mark.parametrize('kind', ('dict', 'compact', 'simplified'))
+def test_isochrones_match_reference(map_files, reference, kind):
+    graph = load_map(map_files, 'compact' if kind == 'compact' else 'dict')
+    if kind == 'simplified':
+        graph = simplify.simplify(graph)
+    origins = [node_id(0, 0), node_id(5, 10), node_id(3, 6), node_id(17, 33), 91]
+    locations = [reference.locations[node] for node in origins]
+    for metric, budgets in (('time', [0.004, 0.01, 0.02]), ('distance', [0.3])):
+        options = {'max_' + metric: budgets}
+        areas = isochrone.isochrones(graph, locations + locations[:2], processes=2, chunk_size=2, **options)
+        assert all(repeat is area for repeat, area in zip(areas[-2:], areas))
+        for node, location, area in zip(origins, locations, areas):
+            expected = {other: cost for other, cost in reference.costs_from(node, metric).items()
+                        if cost <= budgets[-1]}
+            assert area.origin == node and set(area.costs) == set(expected)
+            assert [area.costs[other] for other in expected] == pytest.approx(list(expected.values()), rel=1e-9)
+            for budget in budgets:
+                assert area.nodes(budget) == {other for other, cost in expected.items() if cost <= budget}
+            assert set().union(*area.bands().values()) == set(expected)
+            single = isochrone.isochrone(graph, location, **options)
+            assert single.costs == area.costs
+
+
+@pytest.mark.parametrize('kind', ('dict', 'compact', 'simplified'))
+def test_updates_match_reference(map_files, reference, kind):
+    graph = load_map(map_files, 'compact' if kind == 'compact' else 'dict')
+    if kind == 'simplified':
+        graph = simplify.simplify(graph)
+    ch.prepare(graph)
+    landmarks.prepare(graph, count=4)
+    # Routes to and from the ends of the changed edges, and into, out of and
+    # within the cut off end of the last row
+    changed = [node for changes in UPDATES for change in changes for node in change[1:3]]
+    rnd = random.Random(SEED)
+    extra = [(node_id(rnd.randrange(ROWS), rnd.randrange(COLUMNS)), node) for node in changed]
+    extra += [(node, node_id(rnd.randrange(ROWS), rnd.randrange(COLUMNS))) for node in changed]
+    extra += [(node_id(0, 0), node_id(29, 47)), (node_id(29, 47), node_id(0, 0)), (node_id(29, 46), node_id(29, 47))]
+    for changes in UPDATES:
+        report = updates.apply_updates(graph, changes)
+        reference.apply(changes)
+        check_routes(graph, reference)
+        check_routes(graph, reference, heuristics=True, bidirectional=True)
+        check_routes(graph, reference, pairs=extra)
+        check_routes(graph, reference, heuristics=True, pairs=extra)
+    assert report['closed'] == 1 and report['landmarks_rebuilt'] == 0
+
+    # The landmark bounds to and from the ends of the changed edges, which
+    # a simplified map made junctions, stay below the true costs
+    for metric, table in graph.landmarks.items():
+        for node1, node2 in extra:
+            handle1, handle2 = graph.internal_id(node1), graph.internal_id(node2)
+            expected = reference.shortest(node1, node2, metric)
+            if expected is not None:
+                assert table.heuristic(handle1, handle2)(handle1) <= expected * (1 + 1e-6), (node1, node2)
+    if kind == 'simplified':
+        assert report['junctions_added'] == 2 and report['chains_rebuilt'] < 10
+
+
+def test_route_cache_evicts_and_empties_on_updates(map_files, reference):
+    graph = route_cache.enable(load_map(map_files, 'compact'), max_entries=8, max_trees=2)
+    cache = graph.query_cache
+    pairs = query_pairs(20)
+    check_routes(graph, reference, pairs=pairs)
+    assert cache.evictions > 0 and len(cache.paths) == 8 and len(cache.trees) <= 2
+
+    # The most recent queries are answered from the cache, the oldest not
+    stats = {}
+    node1, node2 = pairs[-1]
+    check_routes(graph, reference, pairs=[(node1, node2)])
+    assert lab.find_short_path_nodes(graph, node1, node2, stats) is not None and stats['cache'] == 'hit'
+    stats = {}
+    assert lab.find_short_path_nodes(graph, *pairs[0], stats) is not None and stats['cache'] != 'hit'
+    assert cache.counters()['invalidations'] == 0
+
+    # Updates change the version of the map, which empties the cache
+    for changes in UPDATES:
+        updates.apply_updates(graph, changes)
+        reference.apply(changes)
+        check_routes(graph, reference, pairs=pairs)
+    assert cache.counters()['invalidations'] == len(UPDATES)
+
+
+def rush_hour(speed):
+    """
+    Return the speed profile of an edge of the primary row: its static
+    speed, falling to a tenth of it between 07:00 and 09:00
+    """
+    return [speed / 10 if 28 <= bucket < 36 else speed for bucket in range(traffic.BUCKETS)]
+
+
+def test_traffic_profiles_round_trip_and_stay_fifo(map_files, reference, tmp_path):
+    # Every edge gets a profile: flat at its static speed, except for the
+    # primary row at rush hour
+    filename = str(tmp_path / 'lattice.speeds')
+    with open(filename, 'w', newline='') as f:
+        f.write('# speeds of the test map\n')
+        writer = csv.writer(f)
+        writer.writerow(['start_node_id', 'end_node_id'] + ['speed_%d' % bucket for bucket in range(traffic.BUCKETS)])
+        for node, children in sorted(reference.speeds.items()):
+            for child, speed in sorted(children.items()):
+                primary = node_id(5, 0) <= min(node, child) and max(node, child) < node_id(6, 0)
+                writer.writerow([node, child] + (rush_hour(speed) if primary else [speed] * traffic.BUCKETS))
+    profiles = traffic.load_profiles(filename)
+    assert profiles.profile_count() == 2 and len(profiles) == sum(map(len, reference.speeds.values()))
+
+    # The binary file holds the same profiles and is memory-mapped
+    traffic.save_profiles(profiles, str(tmp_path / 'lattice.profiles'))
+    loaded = traffic.load_profiles(str(tmp_path / 'lattice.profiles'))
+    assert isinstance(loaded.speeds, memoryview)
+    for name in ('speeds', 'starts', 'ends', 'indices'):
+        assert list(getattr(loaded, name)) == list(getattr(profiles, name))
+    edge = (node_id(5, 10), node_id(5, 11))
+    assert loaded.speed(loaded.lookup(*edge), 8.0) == pytest.approx(4.0)
+    assert loaded.speed(loaded.lookup(*edge), 3.0) == pytest.approx(40.0)
+    assert loaded.lookup(node_id(5, 10), node_id(6, 11)) == traffic.NO_PROFILE
+
+    # Away from rush hour the times are the static ones
+    graph = traffic.enable(load_map(map_files, 'compact'), loaded)
+    pairs = [(node1, node2) for node1, node2 in query_pairs(20) if reference.shortest(node1, node2, 'time')]
+    for node1, node2 in pairs:
+        hours = traffic.travel_time(graph, reference.locations[node1], reference.locations[node2], 3.0)
+        assert hours == pytest.approx(reference.shortest(node1, node2, 'time'), rel=1e-9)
+
+    # Leaving later never means arriving earlier, on one edge or on a path
+    # along the primary row through rush hour
+    base = loaded.lookup(*edge) * traffic.BUCKETS
+    length = great_circle_distance(reference.locations[edge[0]], reference.locations[edge[1]])
+    departures = [6.5 + step / 200 for step in range(600)]
+    arrivals = [traffic.traverse(loaded.speeds, base, length, departure) for departure in departures]
+    assert all(earlier <= later for earlier, later in zip(arrivals, arrivals[1:]))
+    loc1, loc2 = reference.locations[node_id(5, 1)], reference.locations[node_id(5, 46)]
+    arrivals = [departure + traffic.travel_time(graph, loc1, loc2, departure) for departure in departures[::10]]
+    assert all(earlier <= later + 1e-12 for earlier, later in zip(arrivals, arrivals[1:]))
+    assert max(arrivals[i] - departures[10 * i] for i in range(len(arrivals))) > 1.5 * (arrivals[0] - departures[0])
+
+
+@pytest.mark.parametrize('kind', ('dict', 'compact', 'simplified'))
+def test_components_reject_unreachable_queries(map_files, reference, kind):
+    graph = load_map(map_files, 'compact' if kind == 'compact' else 'dict')
+    if kind == 'simplified':
+        graph = simplify.simplify(graph)
+    components.prepare(graph)
+    check_routes(graph, reference)
+
+    # Closing both directions of an edge cuts off the end of the last row
+    changes = UPDATES[1][:2]
+    assert updates.apply_updates(graph, changes)['components_recomputed'] == 1
+    reference.apply(changes)
+    check_routes(graph, reference)
+    for node1, node2 in ((node_id(0, 0), 91), (91, node_id(2, 2)), (node_id(0, 0), node_id(29, 47))):
+        stats = {}
+        assert lab.find_short_path_nodes(graph, node1, node2, stats) is None
+        assert stats['expanded'] == 0
+
+
+@pytest.mark.parametrize('kind', ('dict', 'compact', 'simplified'))
+@pytest.mark.parametrize('method', ('via', 'penalty'))
+def test_alternatives_are_valid_and_differ(map_files, reference, kind, method):
+    graph = load_map(map_files, 'compact' if kind == 'compact' else 'dict')
+    if kind == 'simplified':
+        graph = simplify.simplify(graph)
+    components.prepare(graph)
+    several = 0
+    for node1, node2 in query_pairs(15):
+        for metric in ('distance', 'time'):
+            stats = {}
+            routes = alternatives.alternative_paths_nodes(graph, node1, node2, 3, metric, method=method, stats=stats)
+            best = reference.shortest(node1, node2, metric)
+            if best is None:
+                # Components answer queries with no path without searching
+                assert routes == [] and stats == {}
+                continue
+            assert_cost(reference, routes[0], node1, node2, metric)
+            taken = set()
+            for route in routes[1:]:
+                assert route[0] == node1 and route[-1] == node2 and len(set(route)) == len(route)
+                cost = reference.path_cost(route, metric)
+                assert best <= cost * (1 + 1e-9) and cost <= best * (1 + alternatives.DEFAULT_MAX_STRETCH) * (1 + 1e-9)
+                taken.update(zip(routes[0], routes[0][1:]))
+                shared = sum(reference.cost(u, v, metric) for u, v in zip(route, route[1:]) if (u, v) in taken)
+                assert shared <= alternatives.DEFAULT_MAX_OVERLAP * cost * (1 + 1e-9)
+                taken.update(zip(route, route[1:]))
+            assert len({tuple(route) for route in routes}) == len(routes)
+            several += len(routes) > 1
+    assert several >= 10
+
+
+@pytest.mark.parametrize('max_bytes', (1 << 30, 20000))
+def test_tiled_map_matches_reference(map_files, reference, tmp_path, max_bytes):
+    filename = str(tmp_path / 'lattice.tiles')
+    assert tiles.write_tiles(load_map(map_files, 'compact'), filename, 0.01) > 1
+    graph = tiles.open_tiles(filename, max_bytes)
+    check_routes(graph, reference)
+    check_routes(graph, reference, heuristics=True, bidirectional=True)
+
+    # Snapping stays exact from locations far from the map, nearer a pole
+    # than any of its nodes
+    mapped = [node for node in reference.locations if node in reference.speeds]
+    for loc in ((42.36, -71.13), (42.3, -71.05), (42.4, -70.9), (75.0, -71.5), (89.0, -110.0), (-60.0, -71.0)):
+        expected = min(mapped, key=lambda node: great_circle_distance(loc, reference.locations[node]))
+        assert graph.external_id(graph.nearest(loc)[0]) == expected, loc
+
+
+def test_service_batches_queries_and_rejects_bad_ones(map_files, reference):
+    pairs = query_pairs(12)
+
+    async def run():
+        routing = service.RoutingService(load_map(map_files, 'compact'), batch_window=0.05)
+        try:
+            bad = routing.route('fast', (float('nan'), 0.0), reference.locations[pairs[0][0]])
+            answers = await asyncio.gather(bad, *(routing.route('fast', reference.locations[node1],
+                                                                reference.locations[node2])
+                                                  for node1, node2 in pairs), return_exceptions=True)
+            statuses = []
+            for start in ([float('nan'), 0.0], '42', [42.0, -71.0, 0.0], [91.0, 0.0], [42.0, 'x']):
+                body = json.dumps({'start': start, 'end': [42.0, -71.0]})
+                statuses.append((await routing._dispatch('POST', '/route', body))[0])
+            return answers, statuses, routing.counters()
+        finally:
+            await routing.close()
+
+    answers, statuses, counters = asyncio.run(run())
+
+    # The bad query fails alone, and the others share its batch
+    assert isinstance(answers[0], Exception)
+    for (node1, node2), path in zip(pairs, answers[1:]):
+        assert_cost(reference, None if path is None else [reference.ids[location] for location in path],
+                    node1, node2, 'time')
+    assert counters['batches'] == 1 and counters['failed'] == 1
+    assert statuses == [400] * 5
+
+
+def test_distance_kernels_match_great_circle_distance(reference):
+    rnd = random.Random(SEED)
+    points = list(reference.locations.values()) + [(rnd.uniform(-89, 89), rnd.uniform(-179, 179))
+                                                   for _ in range(100)]
+    lats = [lat for lat, lon in points]
+    lons = [lon for lat, lon in points]
+    kernels = [geo.distances_from, geo._python_distances]
+    if geo.numpy is not None:
+        kernels.append(geo._numpy_distances)
+    for point in points[::97]:
+        expected = [great_circle_distance(point, other) for other in points]
+        for kernel in kernels:
+            assert list(kernel(point, lats, lons)) == pytest.approx(expected, rel=1e-9, abs=1e-9)
+        table = geo.straight_line_heuristic(point, lats, lons)
+        assert [table(node) for node in range(len(points))] == pytest.approx(expected, rel=1e-9, abs=1e-9)
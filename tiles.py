@@ -0,0 +1,569 @@
+"""
+Tiled, lazily loaded maps for extracts too large to hold in memory
+
+build_internal_representation, and even a compact.CompactMap, hold the
+whole map in memory before the first query.  write_tiles instead splits a
+map into square latitude/longitude tiles and stores every tile as its own
+block of arrays in one file:
+
+    nodes        OSM ID, latitude and longitude of the tile's nodes
+    edges out    CSR arrays of the edges leaving the tile's nodes, with
+                 speeds, lengths and travel times
+    edges in     CSR arrays of the edges coming into the tile's nodes, with
+                 lengths and travel times, for bidirectional searches
+
+Edge ends are global node handles, (tile number << LOCAL_BITS) | position in
+the tile, so edges that cross a tile boundary need no special treatment by
+the search: following one simply pages in the other tile.  The header
+records, for every tile, how many of its edges leave it and which tiles they
+lead to.
+
+open_tiles only reads the header and memory-maps the file, so it takes the
+same time whatever the size of the map.  TiledMap then copies tiles into
+memory the first time a search or a snap touches them, keeping them in a
+least recently used TileCache whose size is capped by a byte budget.  A
+sorted table of OSM IDs in the file, read through the memory map, finds the
+tile of a node by its ID.
+
+Typical use:
+
+    tiles.build_tiles(nodes_filename, ways_filename, 'state.tiles')   # once
+    tiled = tiles.open_tiles('state.tiles', max_bytes=256 << 20)
+    stats = {}
+    lab.find_fast_path(tiled, loc1, loc2, stats=stats)
+    stats['tile_hits'], stats['tile_misses'], tiled.tile_cache.counters()
+
+Building the tiles needs the compact map in memory once (on any machine
+that can hold it, see ingest.py); routing from the tiles does not.
+Functions that walk the whole map (node_handles, and so components,
+hierarchies, landmarks and matrix.OneToMany) load every tile in turn.
+"""
+
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+import lab
+import geo
+import compact
+import ingest
+from util import great_circle_distance
+
+
+MAGIC = b'GMAPTILE'
+FORMAT_VERSION = 1
+
+# Tile size in degrees of latitude and longitude
+DEFAULT_TILE_DEGREES = 0.02
+
+DEFAULT_MAX_BYTES = 64 << 20
+
+# A node handle keeps the node's position in its tile in the low bits
+LOCAL_BITS = 32
+LOCAL_MASK = (1 << LOCAL_BITS) - 1
+
+# Arrays of a tile, in file order, with their type codes and whether they
+# hold one entry per node, one per node plus one, one per outgoing edge or
+# one per incoming edge.  Every type is 8 bytes, so every array is aligned.
+TILE_FIELDS = (
+    ('ids', 'q', 'nodes'),
+    ('lats', 'd', 'nodes'),
+    ('lons', 'd', 'nodes'),
+    ('offsets', 'q', 'offsets'),
+    ('targets', 'q', 'edges'),
+    ('speeds', 'd', 'edges'),
+    ('lengths', 'd', 'edges'),
+    ('times', 'd', 'edges'),
+    ('reverseOffsets', 'q', 'offsets'),
+    ('sources', 'q', 'reverse'),
+    ('reverseLengths', 'd', 'reverse'),
+    ('reverseTimes', 'd', 'reverse'),
+)
+
+ITEM_BYTES = 8
+
+
+def _tile_bytes(nodes, edges, reverse):
+    """
+    Return the bytes taken by a tile's arrays
+    """
+    counts = {'nodes': nodes, 'offsets': nodes + 1, 'edges': edges, 'reverse': reverse}
+    return sum(counts[kind] for name, typecode, kind in TILE_FIELDS) * ITEM_BYTES
+
+
+class Tile:
+    """
+    The arrays of one tile, with nodes numbered 0 to n - 1 in the tile
+
+    Attributes:
+        number: the tile number
+        ids, lats, lons: OSM ID and location of every node
+        offsets, targets, speeds, lengths, times: CSR arrays of the edges
+                                                  leaving every node, whose
+                                                  targets are global handles
+        reverseOffsets, sources, reverseLengths, reverseTimes: CSR arrays of
+                                                               the edges
+                                                               coming in
+        nbytes: bytes held by the arrays
+    """
+
+    def __init__(self, number, fields):
+        self.number = number
+        for name, values in fields.items():
+            setattr(self, name, values)
+        self.forward = {'distance': self.lengths, 'time': self.times}
+        self.backward = {'distance': self.reverseLengths, 'time': self.reverseTimes}
+        self.nbytes = sum(len(values) * values.itemsize for values in fields.values())
+
+
+class TileCache:
+    """
+    Least recently used cache of tiles, kept within a byte budget
+
+    The tile asked for last is always kept, even when it alone is over the
+    budget.
+
+    Attributes:
+        max_bytes: most bytes of tiles kept
+        bytes: bytes of the tiles kept now
+        hits: tile lookups answered from memory
+        misses: tile lookups that read the tile from the file
+        evictions: tiles dropped to stay within the budget
+    """
+
+    def __init__(self, load, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Parameters:
+            load: function taking a tile number and returning its Tile
+            max_bytes: most bytes of tiles kept
+        """
+        self.load = load
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def get(self, number):
+        """
+        Return a tile, reading it from the file if it is not in memory
+        """
+        tile = self.tiles.get(number)
+        if tile is not None:
+            self.hits += 1
+            self.tiles.move_to_end(number)
+            return tile
+        self.misses += 1
+        tile = self.load(number)
+        self.tiles[number] = tile
+        self.bytes += tile.nbytes
+        while self.bytes > self.max_bytes and len(self.tiles) > 1:
+            number, evicted = self.tiles.popitem(last=False)
+            self.bytes -= evicted.nbytes
+            self.evictions += 1
+        return tile
+
+    def clear(self):
+        """
+        Drop every tile, keeping the counters
+        """
+        self.tiles.clear()
+        self.bytes = 0
+
+    def counters(self):
+        """
+        Return the counters as a dictionary
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'tiles': len(self.tiles),
+            'bytes': self.bytes,
+        }
+
+
+class TiledMap:
+    """
+    Map representation that reads its tiles from a tile file on demand
+
+    Node handles are integers holding the tile number above LOCAL_BITS and
+    the node's position in the tile below.  The map is read-only.
+
+    Attributes:
+        header: the header of the tile file
+        tile_cache: TileCache of the tiles in memory; lab._route reads its
+                    counters to report 'tile_hits' and 'tile_misses' per
+                    query
+        hierarchies, landmarks: empty dictionaries, as for
+                                lab.MapRepresentation
+        version: always 0
+    """
+
+    def __init__(self, mapped, header, dataStart, max_bytes=DEFAULT_MAX_BYTES):
+        self.mapped = mapped
+        self.header = header
+        self.dataStart = dataStart
+        self.tileDegrees = header['tile_degrees']
+        self.minLat, self.minLon = header['min_lat'], header['min_lon']
+        self.rows, self.columns = header['rows'], header['columns']
+        self.entries = {entry['number']: entry for entry in header['tiles']}
+        self.tile_cache = TileCache(self._load, max_bytes)
+        self.removed = set()
+        self.hierarchies = {}
+        self.landmarks = {}
+        self.version = 0
+
+        # Sorted OSM IDs and their handles, read through the memory map
+        view = memoryview(mapped)
+        ids = header['ids']
+        start = dataStart + ids['offset']
+        self.sortedIds = view[start:start + ids['count'] * ITEM_BYTES].cast('q')
+        start += ids['count'] * ITEM_BYTES
+        self.sortedHandles = view[start:start + ids['count'] * ITEM_BYTES].cast('q')
+
+        # Latitude furthest from the equator anywhere in the map, for the
+        # snapping bound
+        self.maxAbsLat = max(abs(self.minLat), abs(self.minLat + self.rows * self.tileDegrees))
+
+    def __len__(self):
+        return self.header['nodes']
+
+    def _load(self, number):
+        """
+        Copy a tile's arrays out of the mapped file
+        """
+        entry = self.entries[number]
+        counts = {'nodes': entry['nodes'], 'offsets': entry['nodes'] + 1, 'edges': entry['edges'],
+                  'reverse': entry['reverse']}
+        position = self.dataStart + entry['offset']
+        fields = {}
+        for name, typecode, kind in TILE_FIELDS:
+            values = array(typecode)
+            values.frombytes(self.mapped[position:position + counts[kind] * ITEM_BYTES])
+            position += counts[kind] * ITEM_BYTES
+            fields[name] = values
+        return Tile(number, fields)
+
+    def tile(self, node):
+        """
+        Return the Tile holding a node handle
+        """
+        return self.tile_cache.get(node >> LOCAL_BITS)
+
+    def boundary(self, number):
+        """
+        Return (number of edges leaving the tile, tile numbers they lead to)
+        for a tile number
+        """
+        entry = self.entries[number]
+        return entry['boundary_edges'], entry['neighbors']
+
+    def internal_id(self, node):
+        """
+        Return the handle of an OSM node ID
+        """
+        position = bisect_left(self.sortedIds, node)
+        if position == len(self.sortedIds) or self.sortedIds[position] != node:
+            raise KeyError(node)
+        return self.sortedHandles[position]
+
+    def external_id(self, node):
+        """
+        Return the OSM node ID of a handle
+        """
+        return self.tile(node).ids[node & LOCAL_MASK]
+
+    def node_handles(self):
+        """
+        Return the handles of every node in the map, tile by tile
+        """
+        return [(number << LOCAL_BITS) | local
+                for number in sorted(self.entries) for local in range(self.entries[number]['nodes'])]
+
+    def location(self, node):
+        """
+        Return the (latitude, longitude) of a handle
+        """
+        tile = self.tile(node)
+        local = node & LOCAL_MASK
+        return (tile.lats[local], tile.lons[local])
+
+    def edges(self, metric):
+        """
+        Return a function that gives the outgoing (child, cost) edges of a
+        handle, as for compact.CompactMap.edges
+        """
+        get = self.tile_cache.get
+
+        def edges(node):
+            tile = get(node >> LOCAL_BITS)
+            local = node & LOCAL_MASK
+            start, end = tile.offsets[local], tile.offsets[local + 1]
+            return zip(tile.targets[start:end], tile.forward[metric][start:end])
+
+        return edges
+
+    def reverse_edges(self, metric):
+        """
+        Return a function that gives the incoming (parent, cost) edges of a
+        handle
+        """
+        get = self.tile_cache.get
+
+        def edges(node):
+            tile = get(node >> LOCAL_BITS)
+            local = node & LOCAL_MASK
+            start, end = tile.reverseOffsets[local], tile.reverseOffsets[local + 1]
+            return zip(tile.sources[start:end], tile.backward[metric][start:end])
+
+        return edges
+
+    def edge_speed(self, node, child):
+        """
+        Return the speed of the edge from node to child in miles per hour, or
+        None if there is no such edge
+        """
+        tile = self.tile(node)
+        local = node & LOCAL_MASK
+        for edge in range(tile.offsets[local], tile.offsets[local + 1]):
+            if tile.targets[edge] == child:
+                return tile.speeds[edge]
+        return None
+
+    def build_spatial_index(self, kernel=None):
+        """
+        Snap to every node again; the tiles themselves are the spatial index
+        """
+        self.removed = set()
+
+    def unindex(self, nodes):
+        """
+        Stop snapping locations to some handles until build_spatial_index is
+        called
+        """
+        self.removed.update(nodes)
+
+    def _tile_of(self, loc):
+        return (int((loc[0] - self.minLat) // self.tileDegrees), int((loc[1] - self.minLon) // self.tileDegrees))
+
+    def nearest(self, loc, k=1):
+        """
+        Return a list of the (up to) k handles closest to loc, closest first
+
+        Tiles are searched in rings around the tile holding loc, as in
+        lab.NodeGrid, so only the tiles near loc are loaded.
+        """
+        if not self.entries or k <= 0:
+            return []
+        row, col = self._tile_of(loc)
+        firstRadius = max(-row, row - self.rows + 1, -col, col - self.columns + 1, 0)
+        lastRadius = max(row, self.rows - 1 - row, col, self.columns - 1 - col)
+
+        # Miles per degree of longitude anywhere between loc and the nodes,
+        # rounded down so it stays a lower bound
+        furthestLat = min(max(abs(loc[0]), self.maxAbsLat), 89.0)
+        milesPerDegreeLon = 0.99 * great_circle_distance((furthestLat, 0), (furthestLat, 1))
+
+        best = []
+        for radius in range(firstRadius, lastRadius + 1):
+            for i in range(row - radius, row + radius + 1):
+                step = 1 if i in (row - radius, row + radius) else 2 * radius
+                for j in range(col - radius, col + radius + 1, max(step, 1)):
+                    if not (0 <= i < self.rows and 0 <= j < self.columns):
+                        continue
+                    number = i * self.columns + j
+                    if number not in self.entries:
+                        continue
+                    tile = self.tile_cache.get(number)
+                    base = number << LOCAL_BITS
+                    for local, distance in enumerate(geo.distances_from(loc, tile.lats, tile.lons)):
+                        candidate = (float(distance), base | local)
+                        if (len(best) < k or candidate < best[-1]) and candidate[1] not in self.removed:
+                            best.append(candidate)
+                            best.sort()
+                            del best[k:]
+
+            # Gets the smallest distance from loc to a tile outside this ring
+            if len(best) == k:
+                south = self.minLat + (row - radius) * self.tileDegrees
+                west = self.minLon + (col - radius) * self.tileDegrees
+                span = (2 * radius + 1) * self.tileDegrees
+                latGap = min(loc[0] - south, south + span - loc[0])
+                lonGap = min(loc[1] - west, west + span - loc[1])
+                bound = min(latGap * lab.MILES_PER_DEGREE_LAT, lonGap * milesPerDegreeLon)
+                if best[-1][0] <= bound:
+                    break
+
+        return [node for distance, node in best]
+
+    def nbytes(self):
+        """
+        Return the number of bytes of tiles held in memory
+        """
+        return self.tile_cache.bytes
+
+
+def write_tiles(map_rep, filename, tile_degrees=DEFAULT_TILE_DEGREES):
+    """
+    Split a map into tiles and write them to a tile file
+
+    The file is written under a temporary name and renamed into place, so
+    readers never see a partly written file.
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation, or a
+                 compact.CompactMap
+        filename: path of the tile file
+        tile_degrees: size of a tile in degrees of latitude and longitude
+
+    Returns:
+        the number of tiles written
+    """
+    if not isinstance(map_rep, compact.CompactMap):
+        map_rep = compact.compact_representation(map_rep)
+    cmap = map_rep
+    n = len(cmap)
+    minLat = min(cmap.lats, default=0.0)
+    minLon = min(cmap.lons, default=0.0)
+    rows = int((max(cmap.lats, default=0.0) - minLat) // tile_degrees) + 1
+    columns = int((max(cmap.lons, default=0.0) - minLon) // tile_degrees) + 1
+
+    # Puts every node in its tile and gives it its handle
+    members = {}
+    for node in range(n):
+        row = int((cmap.lats[node] - minLat) // tile_degrees)
+        col = int((cmap.lons[node] - minLon) // tile_degrees)
+        members.setdefault(row * columns + col, []).append(node)
+    handles = array('q', [0]) * n
+    for number, nodes in members.items():
+        for local, node in enumerate(nodes):
+            handles[node] = (number << LOCAL_BITS) | local
+
+    if cmap.reverse is None:
+        cmap.build_reverse_edges()
+    reverseOffsets, sources, edgeNumbers = cmap.reverse
+
+    # Works out where every tile goes
+    entries = []
+    offset = 0
+    for number in sorted(members):
+        nodes = members[number]
+        edges = sum(cmap.offsets[node + 1] - cmap.offsets[node] for node in nodes)
+        reverse = sum(reverseOffsets[node + 1] - reverseOffsets[node] for node in nodes)
+        neighbors = set()
+        boundary = 0
+        for node in nodes:
+            for edge in range(cmap.offsets[node], cmap.offsets[node + 1]):
+                other = handles[cmap.targets[edge]] >> LOCAL_BITS
+                if other != number:
+                    boundary += 1
+                    neighbors.add(other)
+        entries.append({'number': number, 'offset': offset, 'nodes': len(nodes), 'edges': edges,
+                        'reverse': reverse, 'boundary_edges': boundary, 'neighbors': sorted(neighbors)})
+        offset += _tile_bytes(len(nodes), edges, reverse)
+
+    header = json.dumps({
+        'version': FORMAT_VERSION,
+        'byteorder': sys.byteorder,
+        'tile_degrees': tile_degrees,
+        'min_lat': minLat,
+        'min_lon': minLon,
+        'rows': rows,
+        'columns': columns,
+        'nodes': n,
+        'edges': len(cmap.targets),
+        'tiles': entries,
+        'ids': {'offset': offset, 'count': n},
+    }).encode()
+    prefix = len(MAGIC) + 8
+    dataStart = -(-(prefix + len(header)) // ITEM_BYTES) * ITEM_BYTES
+
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write(b'\0' * (dataStart - prefix - len(header)))
+        for entry in entries:
+            nodes = members[entry['number']]
+            fields = {name: array(typecode) for name, typecode, kind in TILE_FIELDS}
+            fields['offsets'].append(0)
+            fields['reverseOffsets'].append(0)
+            for node in nodes:
+                fields['ids'].append(cmap.ids[node])
+                fields['lats'].append(cmap.lats[node])
+                fields['lons'].append(cmap.lons[node])
+                for edge in range(cmap.offsets[node], cmap.offsets[node + 1]):
+                    fields['targets'].append(handles[cmap.targets[edge]])
+                    fields['speeds'].append(cmap.speeds[edge])
+                    fields['lengths'].append(cmap.lengths[edge])
+                    fields['times'].append(cmap.times[edge])
+                fields['offsets'].append(len(fields['targets']))
+                for slot in range(reverseOffsets[node], reverseOffsets[node + 1]):
+                    fields['sources'].append(handles[sources[slot]])
+                    fields['reverseLengths'].append(cmap.lengths[edgeNumbers[slot]])
+                    fields['reverseTimes'].append(cmap.times[edgeNumbers[slot]])
+                fields['reverseOffsets'].append(len(fields['sources']))
+            for name, typecode, kind in TILE_FIELDS:
+                f.write(fields[name].tobytes())
+
+        # The ID lookup table: sorted IDs, then the handle of every one
+        f.write(array('q', cmap.sortedIds).tobytes())
+        f.write(array('q', [handles[position] for position in cmap.sortedPositions]).tobytes())
+    os.replace(temporary, filename)
+    return len(entries)
+
+
+def build_tiles(nodes_filename, ways_filename, filename, tile_degrees=DEFAULT_TILE_DEGREES, max_bytes=None,
+                progress=None):
+    """
+    Build a tile file straight from OSM files, through
+    ingest.stream_compact_representation
+
+    Parameters:
+        nodes_filename: path to the .nodes file
+        ways_filename: path to the .ways file
+        filename: path of the tile file
+        tile_degrees: size of a tile in degrees
+        max_bytes, progress: passed on to
+                             ingest.stream_compact_representation
+
+    Returns:
+        the number of tiles written
+    """
+    compact_map = ingest.stream_compact_representation(nodes_filename, ways_filename, max_bytes, progress)
+    return write_tiles(compact_map, filename, tile_degrees)
+
+
+def open_tiles(filename, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Memory-map a tile file and return it as a TiledMap
+
+    Parameters:
+        filename: path of the tile file
+        max_bytes: most bytes of tiles kept in memory at once
+
+    Returns:
+        a TiledMap with no tile loaded yet
+    """
+    with open(filename, 'rb') as f:
+        prefix = f.read(len(MAGIC) + 8)
+        if len(prefix) < len(MAGIC) + 8 or prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError('not a tile file: %s' % filename)
+        headerLength = struct.unpack('<Q', prefix[len(MAGIC):])[0]
+        header = json.loads(f.read(headerLength))
+        if header.get('version') != FORMAT_VERSION or header.get('byteorder') != sys.byteorder:
+            raise ValueError('tile file %s has an unsupported format' % filename)
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    dataStart = -(-(len(prefix) + headerLength) // ITEM_BYTES) * ITEM_BYTES
+    return TiledMap(mapped, header, dataStart, max_bytes)
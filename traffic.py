@@ -0,0 +1,525 @@
+"""
+Time-dependent travel times from per-edge speed profiles
+
+find_fast_path drives every edge at one static speed, the way's maxspeed_mph
+or its DEFAULT_SPEED_LIMIT_MPH.  A speed profile instead gives an edge's
+speed at BUCKETS evenly spaced times of the day (every 15 minutes), with the
+speed in between interpolated linearly and the day wrapping around at
+midnight.  Edges without a profile keep their static speed.
+
+Travel times are found by driving along the edge at the speed of the moment
+until its whole length is covered, so leaving an edge later never means
+arriving earlier (the FIFO property).  That is what lets the search stay a
+label-setting Dijkstra (or A*) over arrival times.
+
+Profiles are stored compactly: every distinct profile once, as BUCKETS
+unsigned 16-bit speeds in tenths of a mile per hour (192 bytes), and every
+edge as its two node IDs and a profile number (20 bytes), plus 4 bytes per
+edge of the map once bound to it.  Edges of the same road class tend to
+share profiles, so a city-scale map with a profile on every edge needs
+about 24 bytes per edge rather than 96 speeds per edge.
+
+Profiles are read from a CSV file with one row per edge,
+
+    start_node_id,end_node_id,speed_0,...,speed_95
+
+(speeds in miles per hour, '#' comments and a header row allowed), or from
+the binary format written by save_profiles, which is memory-mapped.
+
+Typical use:
+
+    map_rep = lab.build_internal_representation(nodes_filename, ways_filename)
+    traffic.enable(map_rep, traffic.load_profiles('resources/cambridge.speeds'))
+    lab.find_fast_path(map_rep, loc1, loc2, departure=8.5)   # leaving 08:30
+    traffic.travel_time(map_rep, loc1, loc2, 8.5)             # hours
+"""
+
+import sys
+import csv
+import json
+import math
+import mmap
+import heapq
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+import lab
+from util import great_circle_distance
+
+
+HOURS_PER_DAY = 24.0
+BUCKETS = 96
+BUCKET_HOURS = HOURS_PER_DAY / BUCKETS
+
+# Stored speeds are in units of 1 / SPEED_SCALE miles per hour
+SPEED_SCALE = 10
+SPEED_TYPECODE = 'H'
+
+MAGIC = b'GMAPSPED'
+FORMAT_VERSION = 1
+ALIGNMENT = 8
+
+# Arrays of a SpeedProfiles that are stored in a binary file
+ARRAY_FIELDS = (
+    ('speeds', SPEED_TYPECODE),
+    ('starts', 'q'),
+    ('ends', 'q'),
+    ('indices', 'i'),
+)
+
+# Profile number of an edge without a profile
+NO_PROFILE = -1
+
+
+class SpeedProfiles:
+    """
+    Speed profiles of a set of edges, keyed by their OSM node IDs
+
+    Profile p is speeds[p * BUCKETS] to speeds[(p + 1) * BUCKETS - 1], the
+    speeds at 00:00, 00:15, ..., 23:45 in tenths of a mile per hour.  The
+    edges are sorted by (start, end) so they can be looked up by bisection.
+
+    Attributes:
+        speeds: the speeds of every distinct profile, one after the other
+        starts: OSM node ID of the start of every edge with a profile
+        ends: OSM node ID of the end of every edge with a profile
+        indices: profile number of every edge
+
+    As for compact.CompactMap, any sequence type supporting len, indexing
+    and slicing works for the attributes, such as memoryviews over a
+    memory-mapped file.
+    """
+
+    def __init__(self, speeds, starts, ends, indices):
+        self.speeds = speeds
+        self.starts = starts
+        self.ends = ends
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.starts)
+
+    def profile_count(self):
+        """
+        Return the number of distinct profiles
+        """
+        return len(self.speeds) // BUCKETS
+
+    def lookup(self, start, end):
+        """
+        Return the profile number of the edge between two OSM node IDs, or
+        NO_PROFILE if it has none
+        """
+        low = bisect_left(self.starts, start)
+        high = bisect_right(self.starts, start, low)
+        position = low + bisect_left(self.ends[low:high], end)
+        if position < high and self.ends[position] == end:
+            return self.indices[position]
+        return NO_PROFILE
+
+    def speed(self, profile, hour):
+        """
+        Return the speed in miles per hour of a profile at a time of day
+        given in hours (wrapping around every HOURS_PER_DAY)
+        """
+        clock = hour % HOURS_PER_DAY
+        bucket = min(int(clock / BUCKET_HOURS), BUCKETS - 1)
+        base = profile * BUCKETS
+        before = self.speeds[base + bucket]
+        after = self.speeds[base + (bucket + 1) % BUCKETS]
+        fraction = (clock - bucket * BUCKET_HOURS) / BUCKET_HOURS
+        return (before + (after - before) * fraction) / SPEED_SCALE
+
+    def max_speed(self):
+        """
+        Return the highest speed of any profile in miles per hour
+        """
+        return max(self.speeds, default=0) / SPEED_SCALE
+
+    def nbytes(self):
+        """
+        Return the number of bytes held by the arrays
+        """
+        return sum(len(values) * values.itemsize for values in (self.speeds, self.starts, self.ends, self.indices))
+
+
+def build_profiles(rows):
+    """
+    Build SpeedProfiles from (start ID, end ID, speeds) rows
+
+    Parameters:
+        rows: iterable of (start, end, speeds) where speeds is a sequence of
+              BUCKETS speeds in miles per hour.  A later row for the same
+              edge replaces an earlier one.
+
+    Returns:
+        a SpeedProfiles storing every distinct profile once
+    """
+    profileNumbers = {}
+    speeds = array(SPEED_TYPECODE)
+    edges = {}
+    limit = (1 << (8 * speeds.itemsize)) - 1
+    for start, end, values in rows:
+        if len(values) != BUCKETS:
+            raise ValueError('edge %r -> %r has %d speeds, not %d' % (start, end, len(values), BUCKETS))
+        quantized = array(SPEED_TYPECODE)
+        for value in values:
+            stored = int(round(value * SPEED_SCALE))
+            if not 0 < stored <= limit:
+                raise ValueError('edge %r -> %r has speed %r out of range' % (start, end, value))
+            quantized.append(stored)
+        key = quantized.tobytes()
+        if key not in profileNumbers:
+            profileNumbers[key] = len(profileNumbers)
+            speeds.extend(quantized)
+        edges[(start, end)] = profileNumbers[key]
+
+    order = sorted(edges)
+    return SpeedProfiles(speeds, array('q', [start for start, end in order]), array('q', [end for start, end in order]),
+                         array('i', [edges[edge] for edge in order]))
+
+
+def read_csv(filename):
+    """
+    Read speed profiles from a CSV file of start_node_id, end_node_id and
+    BUCKETS speeds per row
+
+    Returns:
+        a SpeedProfiles
+    """
+    def rows(f):
+        first = True
+        for lineNumber, row in enumerate(csv.reader(f), 1):
+            if not row or row[0].lstrip().startswith('#'):
+                continue
+            try:
+                start, end = int(row[0]), int(row[1])
+            except (ValueError, IndexError):
+                # The header row, which is the first row that is not a
+                # comment
+                if first:
+                    first = False
+                    continue
+                raise ValueError('%s:%d: bad edge IDs' % (filename, lineNumber))
+            first = False
+            try:
+                yield start, end, [float(value) for value in row[2:]]
+            except ValueError:
+                raise ValueError('%s:%d: bad speed' % (filename, lineNumber))
+
+    with open(filename, newline='') as f:
+        return build_profiles(rows(f))
+
+
+def save_profiles(profiles, filename):
+    """
+    Write speed profiles to a binary file that load_profiles memory-maps
+
+    The layout follows graph_cache: MAGIC, the length of a JSON header, the
+    header, then every array aligned to ALIGNMENT bytes.
+    """
+    layout = []
+    offset = 0
+    for name, typecode in ARRAY_FIELDS:
+        values = getattr(profiles, name)
+        layout.append({'name': name, 'typecode': typecode, 'offset': offset, 'count': len(values)})
+        offset += -(-len(values) * array(typecode).itemsize // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({
+        'version': FORMAT_VERSION,
+        'byteorder': sys.byteorder,
+        'buckets': BUCKETS,
+        'speed_scale': SPEED_SCALE,
+        'arrays': layout,
+    }).encode()
+    prefix = len(MAGIC) + 8
+    dataStart = -(-(prefix + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write(b'\0' * (dataStart - prefix - len(header)))
+        for entry in layout:
+            values = getattr(profiles, entry['name'])
+            if not isinstance(values, array) or values.typecode != entry['typecode']:
+                values = array(entry['typecode'], values)
+            data = values.tobytes()
+            f.write(data)
+            f.write(b'\0' * (-len(data) % ALIGNMENT))
+
+
+def load_profiles(filename):
+    """
+    Load speed profiles from a file written by save_profiles (memory-mapped)
+    or, failing that, from a CSV file
+
+    Returns:
+        a SpeedProfiles
+    """
+    with open(filename, 'rb') as f:
+        prefix = f.read(len(MAGIC) + 8)
+        if prefix[:len(MAGIC)] != MAGIC:
+            return read_csv(filename)
+        headerLength = struct.unpack('<Q', prefix[len(MAGIC):])[0]
+        header = json.loads(f.read(headerLength))
+        if (header.get('version') != FORMAT_VERSION or header.get('byteorder') != sys.byteorder
+                or header.get('buckets') != BUCKETS or header.get('speed_scale') != SPEED_SCALE):
+            raise ValueError('%s was written with incompatible settings' % (filename,))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    dataStart = -(-(len(prefix) + headerLength) // ALIGNMENT) * ALIGNMENT
+    view = memoryview(mapped)
+    fields = {}
+    for entry in header['arrays']:
+        start = dataStart + entry['offset']
+        end = start + entry['count'] * array(entry['typecode']).itemsize
+        fields[entry['name']] = view[start:end].cast(entry['typecode'])
+    return SpeedProfiles(**fields)
+
+
+def traverse(speeds, base, length, departure):
+    """
+    Return the time in hours at which an edge is left
+
+    The edge is driven at the speed of the moment, which changes linearly
+    within every bucket, so the distance covered in a bucket is a quadratic
+    in the time spent in it.  A later departure always gives a later (or
+    equal) arrival.
+
+    Parameters:
+        speeds: the speeds array of a SpeedProfiles
+        base: position of the edge's profile in speeds
+        length: length of the edge in miles
+        departure: time the edge is entered, in hours
+    """
+    clock = departure % HOURS_PER_DAY
+    bucket = min(int(clock / BUCKET_HOURS), BUCKETS - 1)
+    offset = clock - bucket * BUCKET_HOURS
+    now = departure
+    remaining = length
+    while True:
+        before = speeds[base + bucket] / SPEED_SCALE
+        after = speeds[base + (bucket + 1) % BUCKETS] / SPEED_SCALE
+        slope = (after - before) / BUCKET_HOURS
+        speed = before + slope * offset
+        span = BUCKET_HOURS - offset
+        covered = span * (speed + slope * span / 2)
+        if covered >= remaining:
+            # Solves speed * t + slope * t^2 / 2 = remaining for t, in the
+            # form that stays accurate when slope is close to 0
+            return now + 2 * remaining / (speed + math.sqrt(max(speed * speed + 2 * slope * remaining, 0.0)))
+        remaining -= covered
+        now += span
+        bucket = (bucket + 1) % BUCKETS
+        offset = 0.0
+
+
+class TimeDependentMap:
+    """
+    A map together with the speed profiles of its edges
+
+    The edges of every node are numbered in the order the map's edges
+    function gives them, starting at offsets[node], and edgeProfiles holds
+    the profile number of every edge.  For a compact.CompactMap these are
+    its own edge numbers, so its offsets array is reused and the profiles
+    only add 4 bytes per edge.  The numbering is redone whenever the map's
+    version changes.
+
+    Attributes:
+        graph: the map (a lab.MapRepresentation or compact.CompactMap)
+        profiles: the SpeedProfiles
+        offsets: the number of the first edge of every node
+        edgeProfiles: profile number of every edge, or NO_PROFILE
+        maxSpeed: highest speed on any edge, in miles per hour, used for the
+                  A* heuristic
+        version: the map version the numbering was built for
+    """
+
+    def __init__(self, graph, profiles):
+        if hasattr(graph, 'pin'):
+            raise ValueError('speed profiles need the full map, not a simplified one')
+        self.graph = graph
+        self.profiles = profiles
+        self.bind()
+
+    def bind(self):
+        """
+        Number the edges of the map and look up their profiles
+        """
+        graph = self.graph
+        profiles = self.profiles
+        distances, times = graph.edges('distance'), graph.edges('time')
+        external = graph.external_id
+
+        ownOffsets = getattr(graph, 'offsets', None)
+        offsets = {} if ownOffsets is None else ownOffsets
+        edgeProfiles = array('i')
+        maxSpeed = profiles.max_speed()
+        for node in graph.node_handles():
+            if ownOffsets is None:
+                offsets[node] = len(edgeProfiles)
+            start = external(node)
+            for (child, length), (_, time) in zip(distances(node), times(node)):
+                profile = profiles.lookup(start, external(child))
+                edgeProfiles.append(profile)
+                if time > 0:
+                    maxSpeed = max(maxSpeed, length / time)
+
+        self.offsets = offsets
+        self.edgeProfiles = edgeProfiles
+        self.maxSpeed = maxSpeed
+        self.version = getattr(graph, 'version', 0)
+
+    def profiled_edges(self):
+        """
+        Return the number of edges of the map that have a profile
+        """
+        return sum(1 for profile in self.edgeProfiles if profile != NO_PROFILE)
+
+    def nbytes(self):
+        """
+        Return the number of bytes the profiles add to the map
+        """
+        extra = self.profiles.nbytes() + len(self.edgeProfiles) * self.edgeProfiles.itemsize
+        if isinstance(self.offsets, dict):
+            extra += len(self.offsets) * 8
+        return extra
+
+    def route(self, node1, node2, departure, stats=None):
+        """
+        Find the earliest arrival path between two node handles
+
+        Parameters:
+            node1: handle of the start node
+            node2: handle of the end node
+            departure: time of departure in hours (8.5 is 08:30; values past
+                       HOURS_PER_DAY are later days)
+            stats: optional dictionary filled with the same keys as
+                   lab._search
+
+        Returns:
+            a tuple (path, arrival) where path is a list of node handles
+            (None if there is no path) and arrival the time node2 is reached
+            in hours (None if there is no path)
+        """
+        if getattr(self.graph, 'version', 0) != self.version:
+            self.bind()
+        graph = self.graph
+        components = getattr(graph, 'components', None)
+        if components is not None and not components.reachable(node1, node2):
+            if stats is not None:
+                stats.update(expanded=0, pushes=0, stale_pops=0, peak_agenda=0, peak_path_nodes=0)
+            return None, None
+        distances, times = graph.edges('distance'), graph.edges('time')
+        offsets, edgeProfiles, speeds = self.offsets, self.edgeProfiles, self.profiles.speeds
+
+        # A* towards node2: no edge is faster than maxSpeed, and edge lengths
+        # are straight lines, so this never overestimates and is consistent
+        if hasattr(graph, 'straight_line_heuristic'):
+            distanceTo = graph.straight_line_heuristic(node2)
+        else:
+            target = graph.location(node2)
+            location = graph.location
+
+            def distanceTo(node):
+                return great_circle_distance(location(node), target)
+        speedLimit = self.maxSpeed or 1.0
+
+        arrivals = {node1: departure}
+        parent = {node1: None}
+        expanded = set()
+        agenda = [(departure + distanceTo(node1) / speedLimit, 0, node1)]
+        pushes = 1
+        stalePops = 0
+        peakAgenda = 1
+        result = None
+
+        while agenda:
+            priority, order, node = heapq.heappop(agenda)
+            if node in expanded:
+                stalePops += 1
+                continue
+            if node == node2:
+                result = lab._rebuild_path(parent, node)
+                break
+            expanded.add(node)
+
+            now = arrivals[node]
+            first = offsets[node]
+            for index, ((child, length), (_, time)) in enumerate(zip(distances(node), times(node))):
+                if child in expanded:
+                    continue
+                profile = edgeProfiles[first + index]
+                if profile == NO_PROFILE:
+                    arrival = now + time
+                else:
+                    arrival = traverse(speeds, profile * BUCKETS, length, now)
+                if child in arrivals and arrivals[child] <= arrival:
+                    continue
+                arrivals[child] = arrival
+                parent[child] = node
+                heapq.heappush(agenda, (arrival + distanceTo(child) / speedLimit, pushes, child))
+                pushes += 1
+            if len(agenda) > peakAgenda:
+                peakAgenda = len(agenda)
+
+        if stats is not None:
+            stats['expanded'] = len(expanded)
+            stats['pushes'] = pushes
+            stats['stale_pops'] = stalePops
+            stats['peak_agenda'] = peakAgenda
+            stats['peak_path_nodes'] = len(parent)
+
+        if result is None:
+            return None, None
+        return result, arrivals[node2]
+
+
+def enable(map_rep, profiles):
+    """
+    Attach speed profiles to a map
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation, or a
+                 compact.CompactMap
+        profiles: a SpeedProfiles, or the name of a file for load_profiles
+
+    Returns:
+        the map with a TimeDependentMap attached as map_rep.traffic (a
+        MapRepresentation if a plain tuple was passed in), so that
+        lab.find_fast_path accepts a departure time
+    """
+    graph = lab._as_graph(map_rep)
+    if isinstance(profiles, str):
+        profiles = load_profiles(profiles)
+    graph.traffic = TimeDependentMap(graph, profiles)
+    return graph
+
+
+def disable(map_rep):
+    """
+    Detach the speed profiles of a map
+    """
+    if hasattr(map_rep, 'traffic'):
+        del map_rep.traffic
+
+
+def travel_time(map_rep, loc1, loc2, departure, stats=None):
+    """
+    Return the expected travel time in hours between two locations when
+    leaving at a given time, or None if there is no path
+
+    Parameters:
+        map_rep: a map with speed profiles attached by enable
+        loc1, loc2: (latitude, longitude) tuples of the start and end
+        departure: time of departure in hours since midnight
+        stats: as for lab.find_fast_path
+    """
+    graph = lab._as_graph(map_rep)
+    node1 = lab._timed(stats, 'snapping_time', graph.nearest, loc1)[0]
+    node2 = lab._timed(stats, 'snapping_time', graph.nearest, loc2)[0]
+    path, arrival = lab._timed(stats, 'search_time', graph.traffic.route, node1, node2, departure, stats)
+    if stats is not None:
+        stats['path_length'] = 0 if path is None else len(path)
+    return None if arrival is None else arrival - departure
@@ -0,0 +1,196 @@
+"""
+Incremental edge updates on a live map
+
+Closing a road or changing its speed used to mean running
+build_internal_representation over the full OSM files again.
+apply_updates instead applies a batch of edge changes to a map in place:
+
+    ('close', start_id, end_id)           the edge start -> end is closed
+    ('speed', start_id, end_id, mph)      the edge start -> end gets a speed
+    ('oneway', start_id, end_id)          traffic may only go start -> end,
+                                          so the edge end -> start is closed
+
+and repairs everything built from the edges:
+
+    edge weights         fixed up in place by the map's update_edges
+    spatial index        nodes left without any edge are no longer snapped to
+    chains               a simplify.SimplifiedMap repairs the travel times of
+                         the chains holding changed edges, and splits the
+                         chains holding closed edges, numbering the shape
+                         points it makes junctions after its other junctions
+    landmark tables      kept while every cost of their metric only went up
+                         (their bounds stay valid, if looser), with entries
+                         added for new junctions; rebuilt when a cost went
+                         down
+    hierarchies          contracted again for the metrics whose costs
+                         changed, in the node order of the old hierarchy
+                         (new junctions first)
+    components           strongly connected components are computed again
+                         when edges were closed (see components.py)
+    caches               the map's version is bumped, which empties query
+                         caches (see route_cache.py) and rebinds speed
+                         profiles (see traffic.py)
+
+Typical use:
+
+    report = updates.apply_updates(map_rep, [('close', 61325505, 61325512),
+                                             ('speed', 61325512, 61325518, 10)])
+    report['landmarks_rebuilt'], report['seconds']
+"""
+
+import time
+
+import lab
+import ch
+import landmarks
+import components
+
+
+CHANGE_KINDS = ('close', 'speed', 'oneway')
+
+
+def _edge_changes(graph, changes):
+    """
+    Turn a batch of changes into a dictionary mapping (node, child) handles
+    to a new speed, or None for edges to remove
+
+    Every change is checked before any is applied, so a bad batch leaves the
+    map untouched.  Closing an edge that a change in the same batch closed
+    already, or making a street one-way that already is, changes nothing.
+
+    Returns:
+        a tuple (edge changes, number of changes that changed nothing)
+    """
+    edgeChanges = {}
+    unchanged = 0
+    for change in changes:
+        kind, start, end = change[:3]
+        if kind not in CHANGE_KINDS:
+            raise ValueError('unknown change: %r' % (change,))
+        node, child = graph.internal_id(start), graph.internal_id(end)
+        if kind == 'oneway':
+            node, child = child, node
+        exists = graph.edge_speed(node, child) is not None and edgeChanges.get((node, child), 0) is not None
+        if kind == 'speed':
+            if not exists:
+                raise KeyError((start, end))
+            if not change[3] > 0:
+                raise ValueError('speed must be positive: %r' % (change,))
+            edgeChanges[(node, child)] = change[3]
+        elif exists:
+            edgeChanges[(node, child)] = None
+        elif kind == 'close':
+            raise KeyError((start, end))
+        else:
+            unchanged += 1
+    return edgeChanges, unchanged
+
+
+def _repair_preprocessing(graph, changed, decreased, report):
+    """
+    Rebuild or keep the hierarchies and landmark tables of a map after its
+    edge costs changed
+
+    Parameters:
+        graph: the map
+        changed: metrics with at least one changed cost
+        decreased: metrics with at least one cost that went down
+        report: dictionary whose counters are increased
+    """
+    for metric, table in list(graph.landmarks.items()):
+        if metric in decreased:
+            graph.landmarks[metric] = landmarks.LandmarkTable(graph, metric, table.count)
+            report['landmarks_rebuilt'] += 1
+        elif metric in changed:
+            report['landmarks_kept'] += 1
+
+    for metric, hierarchy in list(graph.hierarchies.items()):
+        if metric in changed:
+            graph.hierarchies[metric] = ch.ContractionHierarchy(graph, metric, hierarchy.rank)
+            report['hierarchies_recontracted'] += 1
+
+
+def apply_updates(map_rep, changes):
+    """
+    Apply a batch of edge changes to a map and repair what was built from it
+
+    Parameters:
+        map_rep: the result of calling build_internal_representation, a
+                 compact.CompactMap or a simplify.SimplifiedMap
+        changes: iterable of ('close', start, end), ('speed', start, end,
+                 mph) and ('oneway', start, end) tuples of OSM node IDs
+
+    Returns:
+        a dictionary of what was done:
+            changed: edges whose speed changed
+            closed: edges removed
+            unchanged: changes that had nothing left to do
+            unindexed: nodes taken out of the spatial index
+            chains_repaired: chains whose travel times were recomputed
+            chains_rebuilt: chains walked again after closures split them
+            junctions_added: shape points of a simplified map made junctions
+            landmarks_kept: landmark tables still valid as they were
+            landmarks_rebuilt: landmark tables computed again
+            hierarchies_recontracted: contraction hierarchies built again
+            components_recomputed: 1 if strongly connected components were
+                                   computed again (see components.py)
+            seconds: time spent
+    """
+    start = time.perf_counter()
+    graph = lab._as_graph(map_rep)
+    edgeChanges, unchanged = _edge_changes(graph, changes)
+    report = {
+        'changed': 0, 'closed': 0, 'unchanged': unchanged, 'unindexed': 0, 'chains_repaired': 0,
+        'chains_rebuilt': 0, 'landmarks_kept': 0, 'landmarks_rebuilt': 0, 'hierarchies_recontracted': 0,
+        'junctions_added': 0, 'components_recomputed': 0,
+    }
+    if not edgeChanges:
+        report['seconds'] = time.perf_counter() - start
+        return report
+
+    # Closing an edge makes its length and travel time infinite, and a speed
+    # change can make a travel time go either way
+    changed = {'time'}
+    decreased = set()
+    for (node, child), speed in edgeChanges.items():
+        if speed is None:
+            changed.add('distance')
+        elif speed > graph.edge_speed(node, child):
+            decreased.add('time')
+
+    counts = graph.update_edges(edgeChanges)
+    report['changed'] = counts['changed']
+    report['closed'] = counts['removed']
+    report['chains_repaired'] = counts.get('repaired', 0)
+    report['chains_rebuilt'] = counts.get('rebuilt', 0)
+    report['junctions_added'] = counts.get('promoted', 0)
+
+    # A simplified map's own hierarchies and tables are over its junctions,
+    # and its full map can have some of its own
+    base = getattr(graph, 'base', None)
+    if base is not None:
+        _repair_preprocessing(base, changed, decreased, report)
+    _repair_preprocessing(graph, changed, decreased, report)
+
+    # Nodes that lost their last edge can no longer be routed from or to
+    full = base if base is not None else graph
+    distances = full.edges('distance')
+    isolated = [node for node in {node for edge, speed in edgeChanges.items() if speed is None for node in edge}
+                if not any(True for _ in distances(node))
+                and not any(True for _ in full.reverse_edges('distance')(node))]
+    if isolated:
+        full.unindex(isolated)
+        report['unindexed'] = len(isolated)
+
+    # Closures can split strongly connected components; other changes leave
+    # them as they are
+    labels = getattr(graph, 'components', None)
+    if labels is not None:
+        if 'distance' in changed:
+            graph.components = components.Components(labels.graph)
+            report['components_recomputed'] = 1
+        else:
+            labels.version = getattr(labels.graph, 'version', 0)
+
+    report['seconds'] = time.perf_counter() - start
+    return report